@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Agrégation du dashboard sur une grosse table : un processus vs plages de
+dates lues et agrégées en parallèle (`parallel_stream_stats`).
+
+    python bench_agregation.py --lignes 2000000 --processus 2 4 8
+
+Utilise une base SQLite temporaire (jamais db.sqlite3), remplie de dépenses
+synthétiques sur plusieurs années. L'accélération attendue est proche du
+nombre de cœurs disponibles.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from datetime import date, timedelta
+
+QUARTIERS = ['Bacongo', 'Poto-Poto', 'Moungali', 'Ouenzé', 'Talangaï', 'Mfilou', 'Madibou', 'Djiri']
+
+
+def remplir(n, jours, lot=50_000):
+    import numpy as np
+    from core.models import Depense
+    types_depense = [t for t, _ in Depense.TYPE_DEPENSE_CHOICES]
+    rng = np.random.default_rng(0)
+    origine = date.today() - timedelta(days=jours)
+    for debut in range(0, n, lot):
+        taille = min(lot, n - debut)
+        prix = rng.lognormal(7, 0.8, taille).round()
+        decalages = rng.integers(0, jours, taille)
+        quartiers = rng.integers(0, len(QUARTIERS), taille)
+        types = rng.integers(0, len(types_depense), taille)
+        # bulk_create : pas de signaux (réservoir, partitions), inutiles ici
+        Depense.objects.bulk_create([
+            Depense(type_depense=types_depense[t], quartier=QUARTIERS[q], prix=int(p), lieu='Bench',
+                    date=origine + timedelta(days=int(j)))
+            for p, j, q, t in zip(prix, decalages, quartiers, types)
+        ], batch_size=5000)
+
+
+def mesurer(fn):
+    debut = time.perf_counter()
+    stats = fn()
+    return time.perf_counter() - debut, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lignes', type=int, default=500_000)
+    parser.add_argument('--processus', type=int, nargs='+', default=[2, 4])
+    parser.add_argument('--jours', type=int, default=3 * 365, help="étendue de l'historique")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='ecotrack-bench-')
+    os.environ['DJANGO_SQLITE_PATH'] = os.path.join(tmpdir, 'bench.sqlite3')
+    os.environ['ECOTRACK_SQLITE_PRODUCTION'] = 'True'
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ecotrack_env.settings')
+
+    import django
+    django.setup()
+    from django.core.management import call_command
+    from core.models import Depense
+    from core.streaming import _process_pool, daily_means, parallel_stream_stats, stream_stats
+
+    call_command('migrate', verbosity=0)
+    print(f"Remplissage de {args.lignes} lignes...", file=sys.stderr)
+    remplir(args.lignes, args.jours)
+    qs = Depense.objects.all()
+    daily = daily_means(qs)
+
+    print("=" * 60)
+    print(f"AGRÉGATION - {args.lignes} lignes sur {args.jours} jours ({os.cpu_count()} cœurs)")
+    print("=" * 60)
+    base, reference = mesurer(lambda: stream_stats(qs))
+    print(f"{'sans pool':20s} {args.lignes / base:10.0f} lignes/s  ({base:.2f}s)")
+    for processus in args.processus:
+        pool = _process_pool(processus)
+        list(pool.map(abs, range(processus)))  # démarrage des processus hors mesure
+        duree, stats = mesurer(lambda: parallel_stream_stats(qs, workers=processus, daily=daily))
+        assert stats.total.n == reference.total.n
+        print(f"{f'{processus} processus':20s} {args.lignes / duree:10.0f} lignes/s  "
+              f"({duree:.2f}s, x{base / duree:.2f})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Débit d'insertion concurrent sur SQLite : save() direct vs file d'écriture.
+
+    python bench_ecriture.py --threads 16 --insertions 50
+
+Utilise une base SQLite temporaire (jamais db.sqlite3). Ajouter
+--sans-pragmas pour mesurer sans le profil de production (WAL, etc.).
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('--threads', type=int, default=16)
+parser.add_argument('--insertions', type=int, default=50, help="insertions par thread")
+parser.add_argument('--sans-pragmas', action='store_true')
+args = parser.parse_args()
+
+tmpdir = tempfile.mkdtemp(prefix='ecotrack-bench-')
+os.environ['DJANGO_SQLITE_PATH'] = os.path.join(tmpdir, 'bench.sqlite3')
+os.environ['ECOTRACK_SQLITE_PRODUCTION'] = 'False' if args.sans_pragmas else 'True'
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ecotrack_env.settings')
+
+import django
+django.setup()
+
+from django.core.management import call_command
+from django.db import close_old_connections
+from django.utils import timezone
+from core.models import Depense
+from core.write_queue import write_queue
+
+call_command('migrate', verbosity=0)
+
+
+def nouvelle_depense(i):
+    return Depense(type_depense='alimentation', quartier='Bench', prix=100 + i % 50,
+                   lieu=f'Lieu {i}', date=timezone.now().date())
+
+
+def executer(inserer):
+    erreurs = []
+
+    def worker(t):
+        try:
+            for i in range(args.insertions):
+                inserer(nouvelle_depense(t * args.insertions + i))
+        except Exception as exc:
+            erreurs.append(exc)
+        finally:
+            close_old_connections()
+
+    threads = [threading.Thread(target=worker, args=(t,)) for t in range(args.threads)]
+    debut = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - debut, erreurs
+
+
+total = args.threads * args.insertions
+print("=" * 60)
+print(f"INSERTIONS CONCURRENTES - {args.threads} threads x {args.insertions} "
+      f"({'sans' if args.sans_pragmas else 'avec'} profil de production)")
+print("=" * 60)
+for nom, inserer in [('save() direct', lambda d: d.save()), ("file d'écriture", write_queue.save)]:
+    Depense.objects.all().delete()
+    duree, erreurs = executer(inserer)
+    print(f"{nom:20s} {total / duree:8.0f} insertions/s  ({duree:.2f}s, {len(erreurs)} erreurs)")
+    if erreurs:
+        print(f"  ex: {erreurs[0]}", file=sys.stderr)
+print(f"lots validés par la file : {write_queue.batches_committed}")
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Comparaison de latence entre le déploiement WSGI (gunicorn) et ASGI (uvicorn).
+
+Lancer le serveur à mesurer, puis :
+    python bench_latence.py http://127.0.0.1:8000 --requetes 200 --concurrence 20
+
+Refaire la mesure sur chaque mode de déploiement et comparer les percentiles.
+"""
+import argparse
+import statistics
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+PAGES = ['/', '/dashboard/', '/comparaison/?mode=campus_env']
+
+
+def mesurer(url):
+    debut = time.perf_counter()
+    with urllib.request.urlopen(url) as resp:
+        resp.read()
+    return time.perf_counter() - debut
+
+
+def percentile(valeurs, p):
+    valeurs = sorted(valeurs)
+    return valeurs[min(len(valeurs) - 1, int(len(valeurs) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base_url')
+    parser.add_argument('--requetes', type=int, default=100)
+    parser.add_argument('--concurrence', type=int, default=10)
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print(f"LATENCE - {args.base_url} ({args.requetes} requêtes, concurrence {args.concurrence})")
+    print("=" * 60)
+    for page in PAGES:
+        url = args.base_url.rstrip('/') + page
+        mesurer(url)  # préchauffage (cache, connexions)
+        with ThreadPoolExecutor(max_workers=args.concurrence) as pool:
+            durees = list(pool.map(mesurer, [url] * args.requetes))
+        print(f"{page:35s} p50={percentile(durees, 50) * 1000:7.1f} ms  "
+              f"p95={percentile(durees, 95) * 1000:7.1f} ms  "
+              f"moy={statistics.mean(durees) * 1000:7.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,171 @@
-from django.contrib import admin
-from .models import Depense
+"""
+Admin des dépenses, utilisable sur de grosses tables :
+
+- décomptes des filtres (type, anomalie, quartier) calculés par une requête
+  GROUP BY et mis en cache ECOTRACK_ADMIN_FACET_TTL secondes (comptes sur
+  toute la table) ;
+- filtre quartier en saisie avec suggestions, alimentées par ce cache, au
+  lieu d'un SELECT DISTINCT et de centaines de liens ;
+- pas de COUNT(*) du total (`show_full_result_count = False`) ; au-delà de
+  ECOTRACK_ADMIN_COUNT_THRESHOLD lignes, le nombre de résultats est estimé
+  et la recherche n'utilise plus que des préfixes (lieu) et l'égalité (quartier) ;
+- actions de re-détection des anomalies sur les seules lignes sélectionnées.
+"""
+from django.conf import settings
+from django.contrib import admin, messages
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Count, Max
+from django.http import JsonResponse
+from django.urls import path
+from django.utils.functional import cached_property
+
+from .anomalies import OUTLIER_METHODS, process_rows
+from .cities import current_city
+from .forms import DepenseAdminForm
+from .models import DetectionAnomalies, Depense
+from .views import _normalize_input
+
+SUGGESTIONS = 20
+
+
+def _count_threshold():
+    return getattr(settings, 'ECOTRACK_ADMIN_COUNT_THRESHOLD', 100_000)
+
+
+def estimated_count(queryset):
+    """
+    Nombre de lignes de la table sans la parcourir : statistiques du
+    planificateur sous PostgreSQL, plus grand identifiant sinon (lecture
+    d'index ; surestime après des suppressions).
+    """
+    model = queryset.model
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT reltuples FROM pg_class WHERE oid = %s::regclass", [model._meta.db_table])
+            row = cursor.fetchone()
+        if row and row[0] > 0:
+            return int(row[0])
+    return model._default_manager.using(queryset.db).aggregate(n=Max('pk'))['n'] or 0
+
+
+def facet_counts(queryset, field):
+    """{valeur: nombre de lignes} sur toute la table, en cache (une requête GROUP BY par expiration)."""
+    key = f"admin-facets:{queryset.db}:{current_city() or ''}:{queryset.model._meta.label_lower}:{field}"
+    counts = cache.get(key)
+    if counts is None:
+        counts = dict(queryset.model._default_manager.using(queryset.db).order_by()
+                      .values_list(field).annotate(n=Count('pk')))
+        cache.set(key, counts, getattr(settings, 'ECOTRACK_ADMIN_FACET_TTL', 300))
+    return counts
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Au-delà du seuil, la liste non filtrée reçoit une estimation et une liste
+    filtrée n'est comptée que jusqu'au seuil (COUNT sur une sous-requête
+    limitée) ; `estimated` précède alors le nombre affiché (« environ », « plus de »).
+    """
+    estimated = ''
+
+    @cached_property
+    def count(self):
+        threshold = _count_threshold()
+        queryset = self.object_list
+        total = estimated_count(queryset)
+        if total <= threshold:
+            return queryset.count()
+        if not queryset.query.where:
+            self.estimated = 'environ'
+            return total
+        borne = queryset.order_by()[:threshold + 1].count()
+        if borne > threshold:
+            self.estimated = 'plus de'
+            return threshold
+        return borne
+
+
+class FacetFilter(admin.SimpleListFilter):
+    """Filtre sur un champ à choix, avec le nombre de lignes de chaque valeur (en cache)."""
+    field = None
+
+    def lookups(self, request, model_admin):
+        counts = facet_counts(model_admin.get_queryset(request), self.field)
+        choices = model_admin.model._meta.get_field(self.field).flatchoices
+        return [(value, f"{label} ({counts.get(value, 0)})") for value, label in choices if value in counts]
+
+    def queryset(self, request, queryset):
+        if self.value() is not None:
+            return queryset.filter(**{self.field: self.value()})
+        return queryset
+
+
+class TypeDepenseFilter(FacetFilter):
+    title = 'type de dépense'
+    parameter_name = field = 'type_depense'
+
+
+class AnomalieKindFilter(FacetFilter):
+    title = "type d'anomalie"
+    parameter_name = field = 'anomalie_kind'
+
+    def lookups(self, request, model_admin):
+        # '' (aucune anomalie) n'est pas parmi les choix du champ
+        aucune = facet_counts(model_admin.get_queryset(request), self.field).get('', 0)
+        return [('', f"Aucune ({aucune})"), *super().lookups(request, model_admin)]
+
+
+class QuartierFilter(admin.SimpleListFilter):
+    """Quartier saisi (suggestions depuis les décomptes en cache) : aucun SELECT DISTINCT."""
+    title = 'quartier'
+    parameter_name = 'quartier'
+    template = 'admin/core/quartier_filter.html'
+
+    def lookups(self, request, model_admin):
+        return []
+
+    def has_output(self):
+        return True
+
+    def queryset(self, request, queryset):
+        if self.value():
+            # Même normalisation qu'à l'enregistrement (« poto-poto » -> « Poto Poto »)
+            return queryset.filter(quartier=_normalize_input(self.value()))
+        return queryset
+
+    def choices(self, changelist):
+        yield {
+            'value': self.value() or '',
+            'reset_query_string': changelist.get_query_string(remove=[self.parameter_name]),
+            'hidden': {k: v for k, v in changelist.params.items() if k not in (self.parameter_name, 'p', 'e')},
+        }
+
+
+def _redetection_action(method):
+    def action(modeladmin, request, queryset):
+        passe = process_rows(list(queryset.values_list('pk', flat=True)), method, queryset.db)
+        modeladmin.message_user(
+            request, f"Anomalies re-détectées ({method}) : {passe.lignes_analysees} ligne(s) analysée(s), "
+                     f"{passe.lignes_signalees} signalée(s), {passe.lignes_modifiees} annotation(s) modifiée(s).",
+            messages.SUCCESS)
+    action.__name__ = f'redetecter_anomalies_{method}'
+    return admin.action(description=f"Re-détecter les anomalies des lignes sélectionnées ({method})",
+                        permissions=['change'])(action)
 
 
 @admin.register(Depense)
 class DepenseAdmin(admin.ModelAdmin):
+    form = DepenseAdminForm
     list_display = ('type_depense', 'quartier', 'prix', 'lieu', 'date', 'anomalie')
-    list_filter = ('type_depense', 'quartier', 'date')
+    list_filter = (TypeDepenseFilter, QuartierFilter, 'date', AnomalieKindFilter)
     search_fields = ('lieu', 'commentaire', 'quartier')
+    # Au-delà du seuil : préfixe du lieu et quartier exact, sans commentaire
+    fast_search_fields = ('^lieu', '=quartier')
+    show_full_result_count = False
+    paginator = EstimatedCountPaginator
+    actions = [_redetection_action(method) for method in OUTLIER_METHODS]
     readonly_fields = ('date_creation', 'date_modification')
     fieldsets = (
         ('Informations principales', {
@@ -16,10 +175,42 @@ class DepenseAdmin(admin.ModelAdmin):
             'fields': ('commentaire', 'photo')
         }),
         ('Qualité des données', {
-            'fields': ('anomalie',)
+            'fields': ('anomalie', 'anomalie_kind', 'confirmer_doublon')
         }),
         ('Métadonnées', {
             'fields': ('date_creation', 'date_modification'),
             'classes': ('collapse',)
         }),
     )
+
+    def get_search_fields(self, request):
+        if estimated_count(self.get_queryset(request)) > _count_threshold():
+            return self.fast_search_fields
+        return self.search_fields
+
+    def get_urls(self):
+        return [
+            path('quartiers/', self.admin_site.admin_view(self.quartier_suggestions),
+                 name='core_depense_quartiers'),
+            *super().get_urls(),
+        ]
+
+    def quartier_suggestions(self, request):
+        """Quartiers contenant `term`, les plus renseignés d'abord (décomptes en cache)."""
+        term = request.GET.get('term', '').strip().lower()
+        counts = facet_counts(self.get_queryset(request), 'quartier')
+        matches = sorted(((n, q) for q, n in counts.items() if term in q.lower()), key=lambda m: (-m[0], m[1]))
+        return JsonResponse({'results': [{'id': q, 'text': f"{q} ({n})"} for n, q in matches[:SUGGESTIONS]]})
+
+
+@admin.register(DetectionAnomalies)
+class DetectionAnomaliesAdmin(admin.ModelAdmin):
+    list_display = ('debut', 'duree', 'methode', 'complete', 'partitions',
+                    'lignes_analysees', 'lignes_signalees', 'lignes_modifiees')
+    list_filter = ('methode', 'complete')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,298 @@
+"""
+Détection automatique des anomalies (doublons et valeurs aberrantes).
+
+Tout est calculé en une passe vectorisée sur un DataFrame : les seuils de
+chaque groupe (type, type × quartier, quartier) sont obtenus avec
+`groupby(...).transform`, ce qui donne une colonne de drapeaux pour toutes
+les lignes à la fois. Seules les lignes dont l'annotation change sont
+écrites en base.
+
+La détection ne tourne pas pendant les requêtes : `manage.py anomaly_worker`
+re-détecte les partitions marquées par core/signals.py (voir process_dirty).
+
+Méthodes de seuil (ECOTRACK_OUTLIER_METHOD) :
+- 'std' : moyenne ± 3 écarts-types (comportement historique) ;
+- 'mad' : médiane ± 3 × MAD normalisée, robuste aux valeurs extrêmes ;
+- 'iqr' : barrières de Tukey Q1 - 1,5 × IQR / Q3 + 1,5 × IQR.
+"""
+import time
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Min, Q
+from django.utils import timezone
+
+from .models import DetectionAnomalies, Depense, PartitionModifiee
+
+OUTLIER_METHODS = ('std', 'mad', 'iqr')
+# Besoin d'au moins 3 valeurs pour calculer une dispersion
+MIN_GROUP_SIZE = 3
+DOUBLON_TOLERANCE = 0.02
+# Au-delà de ce nombre de clés (dates + types + quartiers), la re-détection porte sur toute la table
+MAX_SCOPED_KEYS = 500
+# Annotations écrites par transaction (voir _relabel)
+RELABEL_BATCH = 500
+
+LABEL_DOUBLON = "[AUTO] Doublon détecté (même date, lieu et prix similaire)"
+
+COLUMNS = ['id', 'date', 'lieu', 'prix', 'quartier', 'type_depense', 'anomalie', 'anomalie_kind']
+
+
+def _load_frame(queryset):
+    df = pd.DataFrame(list(queryset.values(*COLUMNS)), columns=COLUMNS)
+    df['prix'] = df['prix'].astype(float)
+    return df
+
+
+def flag_doublons(df):
+    """Doublons : même date, même lieu (insensible à la casse), prix à moins de 2 %."""
+    if df.empty:
+        return pd.Series(False, index=df.index)
+    work = pd.DataFrame({
+        'date': df['date'],
+        'lieu': df['lieu'].astype(str).str.strip().str.lower(),
+        'prix': df['prix'],
+    }).sort_values(['date', 'lieu', 'prix'])
+    # Une fois les prix triés dans un groupe (date, lieu), une paire à moins de 2 %
+    # existe si et seulement si deux voisins sont à moins de 2 % : on ne compare
+    # donc que chaque ligne à la précédente.
+    meme_groupe = (work['date'] == work['date'].shift()) & (work['lieu'] == work['lieu'].shift())
+    prix_prec = work['prix'].shift()
+    proche = meme_groupe & ((work['prix'] - prix_prec).abs() / np.maximum(np.maximum(work['prix'], prix_prec), 0.01) < DOUBLON_TOLERANCE)
+    flags = proche | proche.shift(-1, fill_value=False)
+    return flags.reindex(df.index)
+
+
+def group_fences(df, by, method='std'):
+    """
+    Centre, dispersion et barrières basse/haute de chaque ligne selon son groupe.
+    Retourne un DataFrame aligné sur `df` ; `valide` est faux pour les groupes
+    trop petits ou sans dispersion.
+    """
+    keys = [df[c] for c in by]
+    prix = df['prix']
+    grouped = prix.groupby(keys, sort=False)
+    n = grouped.transform('size')
+
+    if method == 'mad':
+        center = grouped.transform('median')
+        spread = (prix - center).abs().groupby(keys, sort=False).transform('median') * 1.4826
+        low, high = center - 3 * spread, center + 3 * spread
+    elif method == 'iqr':
+        q1 = grouped.transform('quantile', 0.25)
+        q3 = grouped.transform('quantile', 0.75)
+        center = grouped.transform('median')
+        spread = q3 - q1
+        low, high = q1 - 1.5 * spread, q3 + 1.5 * spread
+    else:
+        center = grouped.transform('mean')
+        spread = grouped.transform('std')
+        low, high = center - 3 * spread, center + 3 * spread
+
+    valide = (n >= MIN_GROUP_SIZE) & spread.notna() & (spread != 0)
+    return pd.DataFrame({'center': center, 'spread': spread, 'low': low.clip(lower=0), 'high': high, 'valide': valide})
+
+
+def _describe(method, prix, center, spread, portee=''):
+    if method == 'std':
+        return f"prix: {prix:.0f} FCFA, moyenne{portee}: {center:.0f} FCFA, écart-type: {spread:.0f} FCFA"
+    nom = 'MAD' if method == 'mad' else 'IQR'
+    return f"prix: {prix:.0f} FCFA, médiane{portee}: {center:.0f} FCFA, {nom}: {spread:.0f} FCFA"
+
+
+def compute_labels(df, method=None):
+    """
+    Annotation automatique attendue pour chaque ligne : DataFrame aligné sur
+    `df` avec les colonnes `anomalie` (texte, '' si aucune) et `anomalie_kind`.
+
+    Priorité (la première qui s'applique l'emporte) : valeur aberrante par
+    type (haute puis basse), par type × quartier, par quartier, puis doublon.
+    """
+    method = method or getattr(settings, 'ECOTRACK_OUTLIER_METHOD', 'std')
+    if method not in OUTLIER_METHODS:
+        raise ValueError(f"Méthode de détection inconnue : {method}")
+
+    labels = pd.DataFrame({'anomalie': '', 'anomalie_kind': ''}, index=df.index, dtype=object)
+    if df.empty:
+        return labels
+
+    regles = []
+    par_type = group_fences(df, ['type_depense'], method)
+    regles.append((par_type['valide'] & (df['prix'] > par_type['high']), par_type,
+                   Depense.KIND_ABERRANT_HAUT, "[AUTO] Valeur aberrante élevée ({})", ''))
+    regles.append((par_type['valide'] & (par_type['low'] > 0) & (df['prix'] < par_type['low']) & (df['prix'] > 0),
+                   par_type, Depense.KIND_ABERRANT_BAS, "[AUTO] Valeur aberrante basse ({})", ''))
+    par_type_quartier = group_fences(df, ['type_depense', 'quartier'], method)
+    regles.append((par_type_quartier['valide'] & (df['prix'] > par_type_quartier['high']), par_type_quartier,
+                   Depense.KIND_ABERRANT_TYPE_QUARTIER, "[AUTO] Valeur aberrante par type et quartier ({})",
+                   ' type/quartier'))
+    par_quartier = group_fences(df, ['quartier'], method)
+    regles.append((par_quartier['valide'] & (df['prix'] > par_quartier['high']), par_quartier,
+                   Depense.KIND_ABERRANT_QUARTIER, "[AUTO] Valeur aberrante par quartier ({})", ' quartier'))
+
+    # Appliquées de la moins prioritaire à la plus prioritaire : chaque règle écrase les précédentes
+    doublons = flag_doublons(df)
+    labels.loc[doublons, 'anomalie'] = LABEL_DOUBLON
+    labels.loc[doublons, 'anomalie_kind'] = Depense.KIND_DOUBLON
+    for masque, fences, kind, modele, portee in reversed(regles):
+        for idx in masque[masque].index:
+            labels.at[idx, 'anomalie'] = modele.format(_describe(
+                method, df.at[idx, 'prix'], fences.at[idx, 'center'], fences.at[idx, 'spread'], portee))
+            labels.at[idx, 'anomalie_kind'] = kind
+    return labels
+
+
+def _relabel(df, scope, method, using):
+    """Écrit les annotations des lignes de `scope` ; retourne les compteurs de la passe."""
+    labels = compute_labels(df, method)
+    modifiable = scope & ((df['anomalie'] == '') | df['anomalie'].str.startswith('[AUTO]'))
+    differe = (df['anomalie'] != labels['anomalie']) | (df['anomalie_kind'] != labels['anomalie_kind'])
+    changes = df.loc[modifiable & differe, 'id']
+
+    # Écritures par lots, sans signaux (pas de nouveau marquage de partition) ;
+    # date_modification avance pour que le flux de changements publie l'annotation.
+    # Un lot = une transaction courte, horodatée juste avant : la validation suit
+    # l'horodatage de bien moins que ECOTRACK_FEED_LAG, sinon le curseur du flux
+    # pourrait déjà être passé au-delà (annotation jamais publiée)
+    objs = [Depense(id=int(pk), anomalie=labels.at[idx, 'anomalie'], anomalie_kind=labels.at[idx, 'anomalie_kind'])
+            for idx, pk in changes.items()]
+    for start in range(0, len(objs), RELABEL_BATCH):
+        lot = objs[start:start + RELABEL_BATCH]
+        now = timezone.now()
+        for obj in lot:
+            obj.date_modification = now
+        with transaction.atomic(using=using):
+            Depense.objects.using(using).bulk_update(lot, ['anomalie', 'anomalie_kind', 'date_modification'])
+    return {
+        'lignes_analysees': int(scope.sum()),
+        'lignes_signalees': int((labels.loc[modifiable, 'anomalie'] != '').sum()),
+        'lignes_modifiees': len(objs),
+    }
+
+
+def detect_anomalies(method=None, using=None):
+    """
+    Détection automatique des anomalies (doublons et valeurs aberrantes).
+    Les annotations manuelles (sans préfixe [AUTO]) ne sont jamais modifiées.
+    Retourne le nombre de lignes annotées automatiquement.
+    """
+    return _detect_all(method, using)['lignes_signalees']
+
+
+def _detect_all(method, using):
+    df = _load_frame(Depense.objects.using(using))
+    if df.empty:
+        return {'lignes_analysees': 0, 'lignes_signalees': 0, 'lignes_modifiees': 0}
+    return _relabel(df, pd.Series(True, index=df.index), method, using)
+
+
+def detect_partitions(partitions, method=None, using=None):
+    """
+    Re-détection limitée aux lignes touchées par des partitions (date, type, quartier) modifiées.
+
+    Une modification peut changer les seuils de son type et de son quartier
+    et les doublons de sa date : le périmètre réannoté est donc l'ensemble
+    des lignes partageant la date, le type ou le quartier d'une partition.
+    Pour que leurs seuils soient exacts, on charge en plus les groupes
+    complets (date, type, quartier) de ces lignes.
+
+    Les seuils par type portent sur tout le type : avec peu de types (5),
+    une passe relit en pratique presque toute la table. Le gain de la passe
+    incrémentale tient au regroupement des saisies (une passe par rafale)
+    et aux écritures limitées aux annotations modifiées, pas à la lecture.
+    """
+    dates = {p[0] for p in partitions}
+    types = {p[1] for p in partitions}
+    quartiers = {p[2] for p in partitions}
+    if len(dates) + len(types) + len(quartiers) > MAX_SCOPED_KEYS:
+        return _detect_all(method, using)
+
+    qs = Depense.objects.using(using)
+    scope_q = Q(date__in=dates) | Q(type_depense__in=types) | Q(quartier__in=quartiers)
+    cles = qs.filter(scope_q).values_list('date', 'type_depense', 'quartier').distinct()
+    dates2, types2, quartiers2 = set(dates), set(types), set(quartiers)
+    for d, t, q in cles:
+        dates2.add(d)
+        types2.add(t)
+        quartiers2.add(q)
+    if len(dates2) + len(types2) + len(quartiers2) > MAX_SCOPED_KEYS:
+        return _detect_all(method, using)
+
+    df = _load_frame(qs.filter(Q(date__in=dates2) | Q(type_depense__in=types2) | Q(quartier__in=quartiers2)))
+    if df.empty:
+        return {'lignes_analysees': 0, 'lignes_signalees': 0, 'lignes_modifiees': 0}
+    scope = df['date'].isin(dates) | df['type_depense'].isin(types) | df['quartier'].isin(quartiers)
+    return _relabel(df, scope, method, using)
+
+
+def detect_rows(ids, method=None, using=None):
+    """
+    Re-détection limitée aux lignes `ids` (actions de l'admin) : seules ces
+    lignes sont réannotées. Les seuils restent ceux de leurs groupes complets
+    (type, quartier, date) : toutes les lignes qui les partagent sont chargées.
+    """
+    qs = Depense.objects.using(using)
+    cles = list(qs.filter(id__in=ids).values_list('date', 'type_depense', 'quartier'))
+    if not cles:
+        return {'lignes_analysees': 0, 'lignes_signalees': 0, 'lignes_modifiees': 0}
+    dates, types, quartiers = (set(c) for c in zip(*cles))
+    if len(dates) + len(types) + len(quartiers) > MAX_SCOPED_KEYS:
+        df = _load_frame(qs)
+    else:
+        df = _load_frame(qs.filter(Q(date__in=dates) | Q(type_depense__in=types) | Q(quartier__in=quartiers)))
+    return _relabel(df, df['id'].isin(list(ids)), method, using)
+
+
+def process_rows(ids, method=None, using=None):
+    """`detect_rows` journalisée comme une passe de détection ; retourne l'entrée `DetectionAnomalies`."""
+    method = method or getattr(settings, 'ECOTRACK_OUTLIER_METHOD', 'std')
+    debut = timezone.now()
+    start = time.monotonic()
+    stats = detect_rows(ids, method, using)
+    return DetectionAnomalies.objects.using(using).create(
+        debut=debut, duree=time.monotonic() - start, methode=method, complete=False, partitions=0, **stats)
+
+
+# --- Planification en arrière-plan (manage.py anomaly_worker) ---
+
+def pending_since(using=None):
+    """(premier, dernier) marquage en attente, ou None si rien n'est à re-détecter."""
+    agg = PartitionModifiee.objects.using(using).aggregate(premier=Min('date_marquage'), dernier=Max('date_marquage'))
+    return (agg['premier'], agg['dernier']) if agg['premier'] else None
+
+
+def process_dirty(using=None, method=None, force=False, full=False):
+    """
+    Traite les partitions marquées d'une base et journalise la passe.
+
+    Sans `force`, attend que les saisies se calment : la passe n'a lieu que
+    si aucun marquage n'est plus récent que ECOTRACK_ANOMALY_DEBOUNCE
+    secondes, ou si le plus ancien attend depuis ECOTRACK_ANOMALY_MAX_DELAY.
+    Retourne l'entrée `DetectionAnomalies` créée, ou None si rien n'a été fait.
+    """
+    method = method or getattr(settings, 'ECOTRACK_OUTLIER_METHOD', 'std')
+    debut = timezone.now()
+    pending = pending_since(using)
+    if not full:
+        if pending is None:
+            return None
+        premier, dernier = pending
+        calme = (debut - dernier).total_seconds() >= getattr(settings, 'ECOTRACK_ANOMALY_DEBOUNCE', 5)
+        trop_attendu = (debut - premier).total_seconds() >= getattr(settings, 'ECOTRACK_ANOMALY_MAX_DELAY', 60)
+        if not (force or calme or trop_attendu):
+            return None
+
+    marques = list(PartitionModifiee.objects.using(using).filter(date_marquage__lte=debut)
+                   .values_list('id', 'date', 'type_depense', 'quartier'))
+    start = time.monotonic()
+    if full:
+        stats = _detect_all(method, using)
+    else:
+        stats = detect_partitions([m[1:] for m in marques], method, using)
+    # Une partition re-marquée pendant la passe garde son marqueur pour la passe suivante
+    PartitionModifiee.objects.using(using).filter(id__in=[m[0] for m in marques], date_marquage__lte=debut).delete()
+    return DetectionAnomalies.objects.using(using).create(
+        debut=debut, duree=time.monotonic() - start, methode=method, complete=full,
+        partitions=len(marques), **stats)
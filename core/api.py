@@ -0,0 +1,114 @@
+"""
+API JSON de synchronisation pour la collecte hors ligne.
+
+Un collecteur envoie en une requête toutes les dépenses saisies hors ligne :
+
+    POST /api/depenses/batch/
+    {"depenses": [{"cle": "<uuid généré sur le téléphone>", "type_depense": "transport",
+                   "quartier": "campus", "prix": 250, "lieu": "Moto", "date": "2025-03-01"}, ...]}
+
+Chaque dépense est validée avec les règles de `DepenseForm`, puis toutes
+les dépenses valides sont insérées par un seul `bulk_create` dans une
+transaction. La clé d'idempotence rend le renvoi d'un lot sans effet : une
+clé déjà connue renvoie la dépense existante au lieu d'en créer une autre.
+
+Réponse : {"resultats": [{"index", "cle", "statut": "cree" | "existant" | "invalide", "id", "erreurs"}]}
+"""
+import json
+
+from django.conf import settings
+from django.db import IntegrityError, router, transaction
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from .forms import DepenseApiForm
+from .models import Depense
+from .sampling import reservoir_add
+from .signals import mark_partitions
+
+MAX_CLE = 64
+
+
+def _erreur(message, status=400):
+    return JsonResponse({'erreur': message}, status=status)
+
+
+@csrf_exempt
+@require_POST
+def batch_depenses(request):
+    """Création groupée et idempotente de dépenses (JSON)."""
+    try:
+        payload = json.loads(request.body)
+    except (ValueError, UnicodeDecodeError):
+        return _erreur("Corps JSON invalide.")
+    items = payload.get('depenses') if isinstance(payload, dict) else payload
+    if not isinstance(items, list):
+        return _erreur("Attendu : une liste de dépenses (ou {\"depenses\": [...]}).")
+    limite = getattr(settings, 'ECOTRACK_API_BATCH_MAX', 500)
+    if len(items) > limite:
+        return _erreur(f"Lot trop grand : {len(items)} dépenses (maximum {limite}).", status=413)
+
+    try:
+        resultats = _enregistrer(items)
+    except IntegrityError:
+        # Lot concurrent avec les mêmes clés : elles existent maintenant, on relit
+        resultats = _enregistrer(items)
+    return JsonResponse({'resultats': resultats})
+
+
+def _valider(items):
+    """Valide chaque élément ; retourne (resultats, {index: Depense non sauvegardée})."""
+    resultats, a_creer = [], {}
+    for index, item in enumerate(items):
+        res = {'index': index, 'cle': None, 'statut': 'invalide', 'id': None, 'erreurs': {}}
+        resultats.append(res)
+        if not isinstance(item, dict):
+            res['erreurs'] = {'__all__': ["Chaque dépense doit être un objet JSON."]}
+            continue
+        cle = item.get('cle')
+        res['cle'] = cle
+        if not isinstance(cle, str) or not cle.strip() or len(cle) > MAX_CLE:
+            res['erreurs'] = {'cle': [f"Clé d'idempotence obligatoire (texte, {MAX_CLE} caractères maximum)."]}
+            continue
+        form = DepenseApiForm(data=item)
+        if not form.is_valid():
+            res['erreurs'] = {champ: list(messages) for champ, messages in form.errors.items()}
+            continue
+        depense = form.save(commit=False)
+        depense.cle_idempotence = cle
+        a_creer[index] = depense
+    return resultats, a_creer
+
+
+def _enregistrer(items):
+    resultats, a_creer = _valider(items)
+    alias = router.db_for_write(Depense)
+    with transaction.atomic(using=alias):
+        cles = {d.cle_idempotence for d in a_creer.values()}
+        existants = dict(Depense.objects.using(alias).filter(cle_idempotence__in=cles)
+                         .values_list('cle_idempotence', 'id'))
+        nouveaux = {}
+        for index, depense in a_creer.items():
+            cle = depense.cle_idempotence
+            if cle in existants or cle in nouveaux:
+                # Déjà enregistrée (renvoi) ou répétée dans ce lot
+                resultats[index]['statut'] = 'existant'
+                continue
+            depense.prepare_for_save()
+            nouveaux[cle] = (index, depense)
+        # bulk_create ne passe ni par save() ni par les signaux : champs dérivés
+        # calculés ci-dessus, partitions marquées explicitement pour le worker
+        # d'anomalies, réservoir d'échantillonnage mis à jour ici
+        crees = Depense.objects.using(alias).bulk_create([d for _, d in nouveaux.values()])
+        mark_partitions(alias, [(d.date, d.type_depense, d.quartier) for d in crees])
+        reservoir_add(alias, crees)
+
+    ids = {cle: depense.pk for cle, (_, depense) in nouveaux.items()}
+    ids.update(existants)
+    for index, depense in a_creer.items():
+        res = resultats[index]
+        res['id'] = ids.get(depense.cle_idempotence)
+        if res['statut'] == 'invalide':
+            res['statut'] = 'cree'
+    return resultats
@@ -3,3 +3,21 @@ from django.apps import AppConfig
 
 class CoreConfig(AppConfig):
     name = "core"
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+        from django.db.models.signals import post_delete, post_save, pre_save
+        from .db import configure_sqlite
+        from .models import Depense
+        from . import photos, sampling, signals
+
+        connection_created.connect(configure_sqlite, dispatch_uid='ecotrack_configure_sqlite')
+        pre_save.connect(signals.remember_old_partition, sender=Depense, dispatch_uid='ecotrack_old_partition')
+        post_save.connect(signals.mark_saved, sender=Depense, dispatch_uid='ecotrack_mark_saved')
+        pre_save.connect(photos.remember_photo_files, sender=Depense, dispatch_uid='ecotrack_old_photo_files')
+        post_save.connect(photos.delete_replaced_photo_files, sender=Depense,
+                          dispatch_uid='ecotrack_delete_replaced_photo_files')
+        post_save.connect(photos.schedule_photo, sender=Depense, dispatch_uid='ecotrack_schedule_photo')
+        post_save.connect(sampling.sample_saved, sender=Depense, dispatch_uid='ecotrack_sample_saved')
+        post_delete.connect(signals.mark_deleted, sender=Depense, dispatch_uid='ecotrack_mark_deleted')
+        post_delete.connect(photos.delete_photo_files, sender=Depense, dispatch_uid='ecotrack_delete_photo_files')
@@ -0,0 +1,98 @@
+"""
+Statistiques de boîte précalculées pour `Axes.bxp`.
+
+`Axes.boxplot` reçoit toutes les valeurs et les retrie à chaque rendu ; ici
+les résumés (quartiles, moustaches, moyenne, points isolés) sont calculés
+une fois par groupe, en un seul tri de toutes les valeurs, et le graphique
+est tracé à partir de ces résumés : le coût du rendu dépend du nombre de
+groupes, pas du nombre de dépenses.
+
+Mêmes conventions que `matplotlib.cbook.boxplot_stats` (percentiles
+linéaires, moustaches à 1,5 IQR sur les valeurs observées) ; les points
+isolés sont limités à ECOTRACK_BOX_MAX_FLIERS par groupe, répartis sur
+toute leur étendue (les extrêmes sont toujours gardés), et `nb_fliers`
+donne leur nombre réel.
+"""
+import numpy as np
+import pandas as pd
+from django.conf import settings
+
+WHIS = 1.5
+
+
+def _max_fliers():
+    return getattr(settings, 'ECOTRACK_BOX_MAX_FLIERS', 50)
+
+
+def _cap(fliers, limit):
+    if len(fliers) <= limit:
+        return fliers
+    return fliers[np.unique(np.linspace(0, len(fliers) - 1, limit).round().astype(int))]
+
+
+def from_quantiles(label, mean, q1, med, q3, whislo, whishi, n, fliers=()):
+    """Résumé au format `Axes.bxp` (aussi utilisé par les esquisses de `streaming`)."""
+    iqr = q3 - q1
+    notch = 1.57 * iqr / np.sqrt(n) if n else 0.0
+    fliers = np.asarray(fliers, dtype=float)
+    return {
+        'label': label, 'mean': float(mean), 'med': float(med), 'q1': float(q1), 'q3': float(q3),
+        'iqr': float(iqr), 'cilo': float(med - notch), 'cihi': float(med + notch),
+        'whislo': float(whislo), 'whishi': float(whishi), 'fliers': fliers, 'nb_fliers': len(fliers),
+    }
+
+
+def box_summaries(values, groups, labels=None, max_fliers=None):
+    """
+    {groupe: résumé} pour toutes les valeurs en une passe : un tri par
+    (groupe, valeur), puis quartiles et moyennes vectorisés sur les segments.
+    `labels` donne l'étiquette affichée de chaque groupe (par défaut le groupe).
+    """
+    values = np.asarray(values, dtype=float)
+    keep = ~np.isnan(values)
+    codes, uniques = pd.factorize(np.asarray(groups, dtype=object)[keep], sort=True)
+    values = values[keep]
+    if not len(values):
+        return {}
+    max_fliers = _max_fliers() if max_fliers is None else max_fliers
+    labels = labels or {}
+
+    # Tri des valeurs, puis tri stable (radix) des codes de groupe : plus rapide que lexsort
+    order = np.argsort(values)
+    order = order[np.argsort(codes[order].astype(np.min_scalar_type(len(uniques))), kind='stable')]
+    values = values[order]
+    sizes = np.bincount(codes, minlength=len(uniques))
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    means = np.add.reduceat(values, starts) / sizes
+
+    def quantile(p):
+        # Percentile linéaire (np.percentile) dans chaque segment trié
+        position = starts + p * (sizes - 1)
+        low = np.floor(position).astype(int)
+        high = np.minimum(low + 1, starts + sizes - 1)
+        return values[low] + (position - low) * (values[high] - values[low])
+
+    q1, med, q3 = quantile(0.25), quantile(0.5), quantile(0.75)
+    iqr = q3 - q1
+    summaries = {}
+    for g, group in enumerate(uniques):
+        segment = values[starts[g]:starts[g] + sizes[g]]
+        # Moustaches : valeurs observées les plus extrêmes dans [q1 - 1,5 IQR, q3 + 1,5 IQR]
+        lo = np.searchsorted(segment, q1[g] - WHIS * iqr[g], side='left')
+        hi = np.searchsorted(segment, q3[g] + WHIS * iqr[g], side='right')
+        whislo = segment[lo] if lo < len(segment) and segment[lo] <= q1[g] else q1[g]
+        whishi = segment[hi - 1] if hi > 0 and segment[hi - 1] >= q3[g] else q3[g]
+        low_fliers, high_fliers = segment[:lo], segment[hi:]
+        # Le quota inutilisé d'un côté profite à l'autre
+        n_low = min(len(low_fliers), max(max_fliers // 2, max_fliers - len(high_fliers)))
+        summary = from_quantiles(labels.get(group, group), means[g], q1[g], med[g], q3[g], whislo, whishi,
+                                 sizes[g], np.concatenate((_cap(low_fliers, n_low),
+                                                           _cap(high_fliers, max_fliers - n_low))))
+        summary['nb_fliers'] = len(low_fliers) + len(high_fliers)
+        summaries[group] = summary
+    return summaries
+
+
+def box_summary(values, label, max_fliers=None):
+    """Résumé d'un seul groupe."""
+    return box_summaries(values, np.zeros(len(values), dtype=int), {0: label}, max_fliers).get(0)
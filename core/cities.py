@@ -0,0 +1,152 @@
+"""
+Déploiement multi-villes : une base de données par ville.
+
+La ville est lue dans l'URL (`/ville/<slug>/...`) ou dans le sous-domaine
+(`<slug>.ecotrack.example`). `CityMiddleware` la mémorise pour la durée de
+la requête ; `CityRouter` (core/routers.py) envoie alors toutes les
+lectures et écritures de `core` vers la base de cette ville. Le préfixe
+d'URL est conservé par `reverse()`, donc les liens des templates restent
+dans la ville courante.
+
+Configuration : ECOTRACK_CITIES = {slug: alias de base}.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Count, ExpressionWrapper, F, FloatField, Max, Min, Sum
+from django.http import Http404
+from django.urls import get_script_prefix, set_script_prefix
+
+from .db import parallel_queries_enabled
+
+CITY_PREFIX = 'ville'
+
+_current_city = ContextVar('ecotrack_city', default=None)
+
+
+def cities():
+    return getattr(settings, 'ECOTRACK_CITIES', {})
+
+
+def current_city():
+    return _current_city.get()
+
+
+def city_alias(city=None):
+    """Alias de base de la ville (courante par défaut), ou None."""
+    city = city or current_city()
+    return cities().get(city) if city else None
+
+
+def city_label(city):
+    return city.replace('-', ' ').title()
+
+
+class CityMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        city, prefix = self._resolve(request)
+        request.city = city
+        if city is None:
+            return self.get_response(request)
+
+        token = _current_city.set(city)
+        old_prefix = get_script_prefix()
+        if prefix:
+            # /ville/douala/dashboard/ est résolu comme /dashboard/ ; reverse()
+            # produit à nouveau des URL préfixées par /ville/douala/
+            request.path_info = request.path_info[len(prefix):] or '/'
+            set_script_prefix(old_prefix.rstrip('/') + prefix + '/')
+        try:
+            return self.get_response(request)
+        finally:
+            set_script_prefix(old_prefix)
+            _current_city.reset(token)
+
+    def _resolve(self, request):
+        parts = request.path_info.split('/')
+        if len(parts) > 2 and parts[1] == CITY_PREFIX:
+            city = parts[2]
+            if city not in cities():
+                raise Http404(f"Ville inconnue : {city}")
+            return city, f"/{CITY_PREFIX}/{city}"
+        subdomain = request.get_host().split(':')[0].split('.')[0]
+        if subdomain in cities():
+            return subdomain, ''
+        return None, ''
+
+
+# --- Agrégats partiels et fusion (comparaison inter-villes) ---
+
+def grouped_partials(queryset, *fields):
+    """
+    Agrégats fusionnables par groupe, en une requête GROUP BY : n, somme,
+    somme des carrés, min, max. Clé : valeur du champ, ou tuple si plusieurs champs.
+    """
+    carre = ExpressionWrapper(F('prix') * F('prix'), output_field=FloatField())
+    rows = (queryset.order_by().values(*fields)
+            .annotate(n=Count('id'), somme=Sum('prix'), somme_carres=Sum(carre), min=Min('prix'), max=Max('prix')))
+    return {
+        (tuple(r[f] for f in fields) if len(fields) > 1 else r[fields[0]]): {
+            'n': r['n'],
+            'somme': float(r['somme'] or 0),
+            'somme_carres': float(r['somme_carres'] or 0),
+            'min': float(r['min']),
+            'max': float(r['max']),
+        }
+        for r in rows
+    }
+
+
+def partial_aggregates(alias):
+    """Agrégats fusionnables par type de dépense sur une base : n, somme, somme des carrés, min, max."""
+    from .models import Depense
+
+    return grouped_partials(Depense.objects.using(alias), 'type_depense')
+
+
+def merge_partials(parts):
+    """Fusionne plusieurs agrégats partiels d'un même groupe."""
+    merged = {'n': 0, 'somme': 0.0, 'somme_carres': 0.0, 'min': None, 'max': None}
+    for p in parts:
+        merged['n'] += p['n']
+        merged['somme'] += p['somme']
+        merged['somme_carres'] += p['somme_carres']
+        merged['min'] = p['min'] if merged['min'] is None else min(merged['min'], p['min'])
+        merged['max'] = p['max'] if merged['max'] is None else max(merged['max'], p['max'])
+    return merged
+
+
+def finalize(p):
+    """Statistiques affichables à partir d'un agrégat partiel."""
+    n = p['n']
+    moyenne = p['somme'] / n if n else 0.0
+    variance = (p['somme_carres'] - n * moyenne ** 2) / (n - 1) if n > 1 else 0.0
+    return {
+        'nombre': n,
+        'moyenne': moyenne,
+        'ecart_type': max(variance, 0.0) ** 0.5,
+        'min': p['min'] or 0.0,
+        'max': p['max'] or 0.0,
+    }
+
+
+def fan_out(fn, aliases):
+    """Exécute `fn(alias)` sur chaque base en parallèle ; retourne {alias: résultat}."""
+    aliases = list(dict.fromkeys(aliases))
+    if not all(parallel_queries_enabled(a) for a in aliases):
+        return {a: fn(a) for a in aliases}
+
+    def run(alias):
+        try:
+            return fn(alias)
+        finally:
+            # Threads éphémères : leurs connexions ne seront pas réutilisées
+            connections.close_all()
+
+    with ThreadPoolExecutor(max_workers=len(aliases) or 1) as pool:
+        return dict(zip(aliases, pool.map(run, aliases)))
@@ -0,0 +1,127 @@
+"""
+GET conditionnels (ETag / Last-Modified) pour les pages d'analyse, la liste
+et les exports.
+
+L'état des données est lu par une seule requête : nombre de lignes,
+`max(date_modification)`, date de la dernière suppression (pierres
+tombales) et nombre de photos en cours de traitement. L'ETag combine cet
+état, la vue, la ville, les paramètres de la requête et la date du jour
+(pages relatives à « aujourd'hui »). Si le navigateur détient déjà cette version, la vue n'est pas appelée : réponse
+304 avant tout calcul pandas/matplotlib.
+
+Les validateurs décrivent les données courantes : une page servie périmée
+(stale-while-revalidate) n'en reçoit aucun, sinon le navigateur la
+garderait indéfiniment. Les pages à fenêtre glissante (dashboard, 90
+derniers jours) n'envoient pas de `Last-Modified`, qui ne voit pas la
+fenêtre avancer : seul l'ETag, qui inclut la date du jour, les valide.
+
+Les réponses portent `Cache-Control: private, no-cache` : le navigateur
+garde la page mais revalide à chaque affichage (jamais de page périmée).
+"""
+import functools
+import hashlib
+from inspect import iscoroutinefunction
+
+from asgiref.sync import sync_to_async
+from django.db.models import Count, Max, Q, Subquery
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+from .models import Depense, DepenseSupprimee
+from .singleflight import make_key, track_stale
+
+
+def data_state(using=None):
+    """
+    (nombre de lignes, dernière modification ou suppression, photos en cours
+    de traitement) en une requête. Le traitement d'une photo ne touche pas
+    `date_modification` : c'est le nombre de photos en attente qui change
+    quand une photo devient prête (miniature à afficher).
+    """
+    derniere_suppression = (DepenseSupprimee.objects.db_manager(using).order_by('-date_suppression')
+                            .values('date_suppression')[:1])
+    en_traitement = Q(photo_statut__in=[Depense.PHOTO_EN_ATTENTE, Depense.PHOTO_EN_COURS])
+    agg = Depense.objects.db_manager(using).aggregate(n=Count('id'), last=Max('date_modification'),
+                                                      supp=Max(Subquery(derniere_suppression)),
+                                                      photos=Count('id', filter=en_traitement))
+    dates = [d for d in (agg['last'], agg['supp']) if d is not None]
+    return agg['n'], max(dates) if dates else None, agg['photos']
+
+
+def state_token(state):
+    """Représentation stable d'un `data_state()` (ETag, état enregistré avec l'archive d'export)."""
+    n, last, photos = state
+    return f"{n}|{last.timestamp() if last else 0:.6f}|{photos}"
+
+
+def _validators(name, request, state):
+    last = state[1]
+    last_ts = last.timestamp() if last else 0
+    key = make_key(name, request.GET)
+    digest = hashlib.sha1(f"{key}|{state_token(state)}|{timezone.localdate()}".encode()).hexdigest()[:20]
+    # ETag faible : la même version peut être servie compressée ou non (Vary: Accept-Encoding)
+    return f'W/"{digest}"', (int(last_ts) if last else None)
+
+
+def _not_modified(request, etag, last_modified):
+    return get_conditional_response(request, etag=etag, last_modified=last_modified)
+
+
+def _finalize(response, etag, last_modified):
+    if response.status_code not in (200, 304):
+        return response
+    if etag is not None and not response.has_header('ETag'):
+        response['ETag'] = etag
+    if last_modified is not None and not response.has_header('Last-Modified'):
+        response['Last-Modified'] = http_date(last_modified)
+    if not response.has_header('Cache-Control'):
+        patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def conditional_view(view=None, *, last_modified=True):
+    """
+    Décorateur de vue : 304 Not Modified si les données et les paramètres
+    n'ont pas changé. À placer sous `analytics_view` pour lire l'état sur la
+    même base que la vue. `last_modified=False` pour les pages relatives à
+    la date du jour (ETag seul).
+    """
+    if view is None:
+        return functools.partial(conditional_view, last_modified=last_modified)
+    name = view.__name__
+
+    def validators(request, state):
+        etag, modified = _validators(name, request, state)
+        return etag, (modified if last_modified else None)
+
+    if iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return await view(request, *args, **kwargs)
+            etag, modified = validators(request, await sync_to_async(data_state)())
+            response = _not_modified(request, etag, modified)
+            if response is not None:
+                return _finalize(response, etag, modified)
+            with track_stale() as stale:
+                response = await view(request, *args, **kwargs)
+            if stale:
+                return _finalize(response, None, None)
+            return _finalize(response, etag, modified)
+        return async_wrapper
+
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return view(request, *args, **kwargs)
+        etag, modified = validators(request, data_state())
+        response = _not_modified(request, etag, modified)
+        if response is not None:
+            return _finalize(response, etag, modified)
+        with track_stale() as stale:
+            response = view(request, *args, **kwargs)
+        if stale:
+            return _finalize(response, None, None)
+        return _finalize(response, etag, modified)
+    return wrapper
@@ -0,0 +1,10 @@
+from .cities import cities, city_label, current_city
+
+
+def ecotrack(request):
+    """Ville courante et liste des villes pour la barre de navigation"""
+    city = current_city()
+    return {
+        'ecotrack_cities': [{'slug': c, 'label': city_label(c)} for c in cities()],
+        'ville_courante': city_label(city) if city else '',
+    }
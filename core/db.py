@@ -0,0 +1,32 @@
+"""
+Réglages SQLite pour la production.
+
+Le hook `configure_sqlite` est branché sur `connection_created` (voir
+CoreConfig.ready) et applique les PRAGMA de ECOTRACK_SQLITE_PRAGMAS à chaque
+nouvelle connexion : journal WAL (lecteurs et écrivain ne se bloquent plus),
+synchronous=NORMAL, busy_timeout pour attendre le verrou au lieu d'échouer
+avec « database is locked », mmap et cache de pages plus grands.
+"""
+from django.conf import settings
+from django.db import connections
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite' or not getattr(settings, 'ECOTRACK_SQLITE_PRODUCTION', False):
+        return
+    # Les PRAGMA n'ont pas de sens pour une base en mémoire (tests)
+    if connection.is_in_memory_db():
+        return
+    with connection.cursor() as cursor:
+        for name, value in getattr(settings, 'ECOTRACK_SQLITE_PRAGMAS', {}).items():
+            # La réplique (refresh_replica) reste en journal classique : pas de -wal/-shm
+            if name == 'journal_mode' and connection.alias == getattr(settings, 'ECOTRACK_REPLICA_ALIAS', None):
+                continue
+            cursor.execute(f"PRAGMA {name}={value}")
+
+
+def parallel_queries_enabled(alias='default'):
+    """Les requêtes peuvent-elles partir en parallèle sur plusieurs connexions ?"""
+    # Une base SQLite en mémoire (tests) n'est pas partageable entre threads
+    connection = connections[alias]
+    return not (connection.vendor == 'sqlite' and connection.is_in_memory_db())
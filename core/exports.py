@@ -0,0 +1,420 @@
+"""
+Formats d'export (`?format=csv|ndjson|parquet|xlsx`) à mémoire bornée.
+
+Les vues d'export décrivent leurs colonnes (nom, type) et fournissent un
+itérateur de tuples, lu par morceaux (`QuerySet.iterator`) avec le prix
+déjà converti en flottant par la base. Chaque format consomme cet
+itérateur sans jamais matérialiser tout l'export :
+- csv / ndjson : réponse en streaming ligne par ligne ;
+- parquet : un groupe de lignes (row group) par morceau, envoyé dès qu'il est écrit ;
+- xlsx : classeur openpyxl en mode write-only, écrit dans un fichier
+  temporaire puis diffusé.
+
+Parquet et XLSX nécessitent les dépendances optionnelles pyarrow et openpyxl.
+
+Compression : les formats texte (csv, ndjson) sont compressés à la volée en
+gzip, ou en zstd si le client l'accepte et que `zstandard` est installé,
+selon l'en-tête Accept-Encoding. L'export complet non filtré est aussi
+pré-construit chaque nuit (`manage.py build_export_archive`) et servi tel
+quel depuis le disque.
+
+ZIP pour les audits : le CSV filtré et les photos justificatives, écrits au
+fil de l'eau dans un flux non positionnable (ni l'archive ni les photos ne
+sont chargées en entier, en mémoire comme sur disque).
+"""
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+import time
+import zipfile
+from itertools import islice
+
+from django.conf import settings
+from django.db.models import FloatField
+from django.db.models.functions import Cast
+from django.http import FileResponse, HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date
+from django.utils import timezone
+from django.utils.text import compress_sequence
+
+from .models import Depense
+
+CHUNK_SIZE = 2000
+# Lignes par row group Parquet (compromis mémoire / compression)
+PARQUET_ROW_GROUP = 50000
+
+TYPE_LABELS = dict(Depense.TYPE_DEPENSE_CHOICES)
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+# Colonnes communes des exports de dépenses : (nom, type)
+DEPENSE_COLUMNS = [
+    ('date', 'date'), ('type', 'str'), ('quartier', 'str'), ('lieu', 'str'),
+    ('prix', 'float'), ('commentaire', 'str'), ('anomalie', 'str'),
+]
+DEPENSE_FIELDS = {
+    'date': 'date', 'type': 'type_depense', 'quartier': 'quartier', 'lieu': 'lieu',
+    'prix': 'prix_float', 'commentaire': 'commentaire', 'anomalie': 'anomalie',
+    'id': 'id', 'photo': 'photo',
+}
+
+
+def depense_rows(queryset, columns, prefix=()):
+    """
+    Tuples des colonnes demandées, lus par morceaux. La base de données est
+    fixée dès maintenant : le corps d'une réponse en streaming est produit
+    après la sortie des middlewares (ville courante, réplique d'analyse).
+    """
+    queryset = queryset.using(queryset.db).annotate(prix_float=Cast('prix', FloatField()))
+    fields = [DEPENSE_FIELDS[name] for name, _ in columns]
+    type_index = fields.index('type_depense') if 'type_depense' in fields else None
+    for row in queryset.values_list(*fields).iterator(chunk_size=CHUNK_SIZE):
+        row = list(row)
+        if type_index is not None:
+            row[type_index] = TYPE_LABELS.get(row[type_index], row[type_index])
+        yield (*prefix, *('' if v is None else v for v in row))
+
+
+def _batched(rows, size):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+class _Echo:
+    def write(self, value):
+        return value
+
+
+def _csv(columns, rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow([name for name, _ in columns])
+    dates = [i for i, (_, kind) in enumerate(columns) if kind == 'date']
+    for row in rows:
+        row = list(row)
+        for i in dates:
+            row[i] = row[i].strftime('%Y-%m-%d')
+        yield writer.writerow(row)
+
+
+def _ndjson(columns, rows):
+    names = [name for name, _ in columns]
+    for row in rows:
+        record = {n: (v.isoformat() if hasattr(v, 'isoformat') else v) for n, v in zip(names, row)}
+        yield json.dumps(record, ensure_ascii=False) + '\n'
+
+
+class _ChunkSink(io.RawIOBase):
+    """Fichier en écriture seule dont on récupère (et vide) le contenu après chaque row group."""
+
+    def __init__(self):
+        super().__init__()
+        self._buffer = bytearray()
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def buffered(self):
+        return len(self._buffer)
+
+    def drain(self):
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+def _parquet(columns, rows):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    types = {'str': pa.string(), 'float': pa.float64(), 'date': pa.date32()}
+    schema = pa.schema([(name, types[kind]) for name, kind in columns])
+
+    def generate():
+        sink = _ChunkSink()
+        writer = pq.ParquetWriter(sink, schema, compression='snappy')
+        try:
+            for batch in _batched(rows, PARQUET_ROW_GROUP):
+                arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*batch), schema)]
+                writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+                yield sink.drain()
+        finally:
+            writer.close()
+        yield sink.drain()
+    return generate()
+
+
+def _xlsx(columns, rows):
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('export')
+    ws.append([name for name, _ in columns])
+    for row in rows:
+        ws.append(row)
+    # Le mode write-only écrit les lignes dans un fichier temporaire au fil de l'eau ;
+    # le classeur final est lui aussi sur disque, puis diffusé par morceaux
+    out = tempfile.TemporaryFile()
+    wb.save(out)
+    out.seek(0)
+    return out
+
+
+WRITERS = {'csv': _csv, 'ndjson': _ndjson, 'parquet': _parquet, 'xlsx': _xlsx}
+OPTIONAL_DEPENDENCIES = {'parquet': 'pyarrow', 'xlsx': 'openpyxl'}
+
+
+# --- Compression négociée (Accept-Encoding) ---
+
+def _zstd_module():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+def accepted_encodings(request):
+    """Encodages acceptés par le client (q > 0) d'après Accept-Encoding."""
+    accepted = set()
+    for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        token, _, params = part.strip().partition(';')
+        q = 1.0
+        if params.strip().startswith('q='):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if token and q > 0:
+            accepted.add(token.strip().lower())
+    return accepted
+
+
+def negotiate_encoding(request):
+    """'zstd', 'gzip' ou None (zstd préféré s'il est disponible)."""
+    accepted = accepted_encodings(request)
+    if 'zstd' in accepted and _zstd_module() is not None:
+        return 'zstd'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+
+def _zstd_sequence(sequence):
+    compressor = _zstd_module().ZstdCompressor(level=3).compressobj()
+    for item in sequence:
+        data = compressor.compress(item)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def compress_streaming(request, response):
+    """Compresse à la volée une réponse en streaming si le client l'accepte."""
+    patch_vary_headers(response, ('Accept-Encoding',))
+    encoding = negotiate_encoding(request)
+    if encoding is None or response.has_header('Content-Encoding'):
+        return response
+    content = response.streaming_content
+    response.streaming_content = _zstd_sequence(content) if encoding == 'zstd' else compress_sequence(content)
+    response['Content-Encoding'] = encoding
+    del response['Content-Length']
+    return response
+
+
+# --- Archive nocturne de l'export complet ---
+
+ARCHIVE_EXTENSIONS = {'gzip': 'gz', 'zstd': 'zst'}
+
+
+def archive_path(prefix, city, encoding):
+    directory = getattr(settings, 'ECOTRACK_EXPORT_ARCHIVE_DIR', os.path.join(settings.BASE_DIR, 'exports'))
+    name = f"{prefix}_{city}" if city else prefix
+    return os.path.join(directory, f"{name}.csv.{ARCHIVE_EXTENSIONS[encoding]}")
+
+
+def _state_path(path):
+    return f"{path}.etat"
+
+
+def _read_state(path):
+    try:
+        with open(_state_path(path), encoding='utf-8') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def build_archive(prefix, city, columns, rows_factory, state=None):
+    """
+    Écrit l'export CSV complet compressé (gzip, et zstd si disponible).
+    Fichier temporaire puis remplacement atomique : les téléchargements en
+    cours gardent l'ancienne version. `state` (état des données relevé avant
+    la lecture des lignes) est enregistré à côté, après l'archive : une
+    archive n'est jamais associée à un état plus récent que son contenu.
+    Retourne les chemins écrits.
+    """
+    written = []
+    for encoding in ('gzip', 'zstd'):
+        if encoding == 'zstd' and _zstd_module() is None:
+            continue
+        path = archive_path(prefix, city, encoding)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.tmp"
+        with open(tmp, 'wb') as raw:
+            if encoding == 'gzip':
+                out = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=9, mtime=0)
+            else:
+                out = _zstd_module().ZstdCompressor(level=19).stream_writer(raw)
+            with out:
+                for line in _csv(columns, rows_factory()):
+                    out.write(line.encode('utf-8'))
+        # L'ancien état est retiré avant de remplacer l'archive, le nouveau écrit après
+        if os.path.exists(_state_path(path)):
+            os.remove(_state_path(path))
+        os.replace(tmp, path)
+        if state is not None:
+            with open(f"{_state_path(path)}.tmp", 'w', encoding='utf-8') as f:
+                f.write(state)
+            os.replace(f"{_state_path(path)}.tmp", _state_path(path))
+        written.append(path)
+    return written
+
+
+def archived_response(request, prefix, city, filename, state=None):
+    """
+    Sert l'archive pré-construite si le client accepte son encodage, qu'elle
+    est récente et, avec `state`, qu'elle a été construite sur ce même état
+    des données (aucune saisie depuis) ; sinon None.
+    """
+    accepted = accepted_encodings(request)
+    candidates = [e for e in ('zstd', 'gzip') if e in accepted]
+    max_age = getattr(settings, 'ECOTRACK_EXPORT_ARCHIVE_MAX_AGE', 26 * 3600)
+    for candidate in candidates:
+        path = archive_path(prefix, city, candidate)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            continue
+        if time.time() - mtime > max_age:
+            continue
+        if state is not None and _read_state(path) != state:
+            continue
+        response = FileResponse(open(path, 'rb'), content_type=CONTENT_TYPES['csv'])
+        # FileResponse devine « gzip » d'après l'extension ; on fixe l'encodage et le nom explicitement
+        response['Content-Encoding'] = candidate
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        response['Last-Modified'] = http_date(mtime)
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+    return None
+
+
+# --- ZIP : CSV + photos justificatives ---
+
+ZIP_COLUMNS = [('id', 'int'), *DEPENSE_COLUMNS, ('photo', 'str')]
+# Taille des morceaux copiés depuis le stockage des photos
+ZIP_COPY_CHUNK = 64 * 1024
+
+
+def photo_archive_name(pk, name):
+    """Chemin de la photo dans le ZIP (préfixé par l'id : deux dépenses peuvent avoir le même nom de fichier)."""
+    return f"photos/{pk}-{os.path.basename(name)}"
+
+
+def _zip_entry(zf, name, compress_type):
+    info = zipfile.ZipInfo(name, date_time=timezone.localtime().timetuple()[:6])
+    info.compress_type = compress_type
+    # Taille inconnue à l'avance : Zip64 autorisé d'emblée (au-delà de 4 Go)
+    return zf.open(info, 'w', force_zip64=True)
+
+
+def _zip(csv_name, rows, files):
+    """
+    Le sink n'est pas positionnable : zipfile écrit alors la taille et le CRC
+    de chaque entrée après ses données (descripteur), sans revenir en arrière.
+    Seul le répertoire central (une entrée par fichier) reste en mémoire.
+    """
+    sink = _ChunkSink()
+    zf = zipfile.ZipFile(sink, 'w')
+    try:
+        with _zip_entry(zf, csv_name, zipfile.ZIP_DEFLATED) as dest:
+            for line in _csv(ZIP_COLUMNS, rows):
+                dest.write(line.encode('utf-8'))
+                if sink.buffered() >= ZIP_COPY_CHUNK:
+                    yield sink.drain()
+        for arcname, storage, name in files:
+            try:
+                source = storage.open(name, 'rb')
+            except OSError:
+                continue  # fichier absent du stockage : la ligne du CSV reste
+            # Photos déjà compressées (JPEG/WebP) : stockées telles quelles
+            with source, _zip_entry(zf, arcname, zipfile.ZIP_STORED) as dest:
+                for chunk in source.chunks(ZIP_COPY_CHUNK):
+                    dest.write(chunk)
+                    yield sink.drain()
+    finally:
+        zf.close()
+    yield sink.drain()
+
+
+def depenses_zip_response(queryset, filename):
+    """ZIP en streaming : `depenses.csv` (colonne photo = chemin dans l'archive) et les photos référencées."""
+    queryset = queryset.using(queryset.db)
+    storage = Depense._meta.get_field('photo').storage
+
+    def rows():
+        for row in depense_rows(queryset, ZIP_COLUMNS):
+            pk, photo = row[0], row[-1]
+            yield (*row[:-1], photo_archive_name(pk, photo) if photo else '')
+
+    def files():
+        photos = queryset.exclude(photo='').exclude(photo__isnull=True).order_by().values_list('id', 'photo')
+        for pk, name in photos.iterator(chunk_size=CHUNK_SIZE):
+            yield photo_archive_name(pk, name), storage, name
+
+    response = StreamingHttpResponse(_zip('depenses.csv', rows(), files()), content_type='application/zip')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+def export_response(request, filename_for, columns, rows):
+    """Réponse d'export au format demandé ; `filename_for(extension)` donne le nom du fichier."""
+    fmt = request.GET.get('format', 'csv')
+    if fmt not in WRITERS:
+        return HttpResponseBadRequest(f"Format d'export inconnu : {fmt} (csv, ndjson, parquet ou xlsx).")
+    try:
+        body = WRITERS[fmt](columns, rows)
+    except ImportError:
+        return HttpResponse(f"Export {fmt} indisponible : installer {OPTIONAL_DEPENDENCIES[fmt]}.",
+                            status=501, content_type='text/plain; charset=utf-8')
+    filename = filename_for(fmt)
+    if fmt == 'xlsx':
+        return FileResponse(body, as_attachment=True, filename=filename, content_type=CONTENT_TYPES[fmt])
+    response = StreamingHttpResponse(body, content_type=CONTENT_TYPES[fmt])
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    if fmt in ('csv', 'ndjson'):
+        # Parquet et XLSX sont déjà compressés
+        return compress_streaming(request, response)
+    return response
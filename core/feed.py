@@ -0,0 +1,164 @@
+"""
+Flux de changements pour la synchronisation incrémentale (BI, entrepôt...).
+
+    GET /export/changements/?curseur=<jeton>&format=ndjson|csv&limite=5000
+
+Renvoie, dans l'ordre (date, id), les dépenses créées ou modifiées et les
+suppressions (pierres tombales `DepenseSupprimee`) postérieures au curseur.
+Le curseur suivant est dans l'en-tête `X-Next-Cursor` ; `X-Has-More: true`
+indique qu'il faut rappeler immédiatement. Sans curseur, le flux part du
+début (chargement initial).
+
+La page est délimitée d'abord par une lecture d'index seule (clés
+date/id), ce qui donne le curseur avant d'envoyer le corps ; les lignes
+sont ensuite diffusées en streaming sans être chargées en mémoire.
+
+Les lignes modifiées depuis moins de ECOTRACK_FEED_LAG secondes ne sont
+pas encore publiées : une transaction plus lente peut encore valider une
+ligne avec une date antérieure, qui serait sinon sautée par le curseur.
+Lecture toujours sur la base principale (jamais sur la réplique).
+"""
+import base64
+import csv
+import heapq
+import json
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import router
+from django.db.models import Q
+from django.http import HttpResponseBadRequest, StreamingHttpResponse
+from django.utils import timezone
+from django.views.decorators.http import require_GET
+
+from .exports import compress_streaming
+from .models import Depense, DepenseSupprimee
+
+FIELDS = ['id', 'date_modification', 'date', 'type_depense', 'quartier', 'lieu', 'prix', 'commentaire', 'anomalie']
+CSV_HEADER = ['operation', *FIELDS]
+ORIGINE = (datetime.min.replace(tzinfo=dt_timezone.utc).isoformat(), 0)
+
+
+def encode_cursor(changes, suppressions):
+    data = json.dumps({'m': list(changes), 's': list(suppressions)}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """(position modifications, position suppressions) ; chaque position = (date iso, id)."""
+    if not token:
+        return ORIGINE, ORIGINE
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        positions = []
+        for key in ('m', 's'):
+            ts, pk = data[key]
+            datetime.fromisoformat(ts)
+            positions.append((ts, int(pk)))
+        return tuple(positions)
+    except (ValueError, TypeError, KeyError):
+        raise ValueError("Curseur invalide")
+
+
+def _after(field, position):
+    ts, pk = position
+    ts = datetime.fromisoformat(ts)
+    return Q(**{f'{field}__gt': ts}) | Q(**{field: ts, 'id__gt': pk})
+
+
+def _upto(field, position):
+    ts, pk = position
+    ts = datetime.fromisoformat(ts)
+    return Q(**{f'{field}__lt': ts}) | Q(**{field: ts, 'id__lte': pk})
+
+
+def _page_bounds(alias, pos_m, pos_s, limite, horizon):
+    """Fin de page de chaque flux, déterminée sur les seules clés (index date, id)."""
+    keys_m = list(Depense.objects.using(alias).filter(_after('date_modification', pos_m), date_modification__lt=horizon)
+                  .order_by('date_modification', 'id').values_list('date_modification', 'id')[:limite])
+    keys_s = list(DepenseSupprimee.objects.using(alias).filter(_after('date_suppression', pos_s), date_suppression__lt=horizon)
+                  .order_by('date_suppression', 'id').values_list('date_suppression', 'id')[:limite])
+    merged = list(heapq.merge(((k, 'm') for k in keys_m), ((k, 's') for k in keys_s)))
+    has_more = len(merged) > limite or len(keys_m) == limite or len(keys_s) == limite
+    merged = merged[:limite]
+    end = {'m': None, 's': None}
+    for (ts, pk), stream in merged:
+        end[stream] = (ts.isoformat(), pk)
+    return end['m'], end['s'], has_more
+
+
+def _changes(alias, pos_m, end_m):
+    if end_m is None:
+        return iter(())
+    qs = (Depense.objects.using(alias).filter(_after('date_modification', pos_m) & _upto('date_modification', end_m))
+          .order_by('date_modification', 'id').values_list(*FIELDS))
+    return ((row[1], row[0], 'upsert', row) for row in qs.iterator(chunk_size=2000))
+
+
+def _deletions(alias, pos_s, end_s):
+    if end_s is None:
+        return iter(())
+    qs = (DepenseSupprimee.objects.using(alias).filter(_after('date_suppression', pos_s) & _upto('date_suppression', end_s))
+          .order_by('date_suppression', 'id').values_list('date_suppression', 'id', 'depense_id'))
+    return ((ts, pk, 'delete', (depense_id, ts) + (None,) * (len(FIELDS) - 2))
+            for ts, pk, depense_id in qs.iterator(chunk_size=2000))
+
+
+def _serialize(value):
+    if value is None:
+        return None
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if hasattr(value, 'as_tuple'):  # Decimal
+        return float(value)
+    return value
+
+
+def _ndjson(events):
+    for _, _, op, row in events:
+        record = {'operation': op}
+        record.update((f, _serialize(v)) for f, v in zip(FIELDS, row) if not (op == 'delete' and v is None))
+        yield json.dumps(record, ensure_ascii=False) + '\n'
+
+
+class _Echo:
+    def write(self, value):
+        return value
+
+
+def _csv(events):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(CSV_HEADER)
+    for _, _, op, row in events:
+        yield writer.writerow([op, *('' if v is None else _serialize(v) for v in row)])
+
+
+@require_GET
+def changements(request):
+    """Flux des changements depuis un curseur (NDJSON ou CSV, en streaming)."""
+    fmt = request.GET.get('format', 'ndjson')
+    if fmt not in ('ndjson', 'csv'):
+        return HttpResponseBadRequest("Format inconnu (ndjson ou csv).")
+    try:
+        pos_m, pos_s = decode_cursor(request.GET.get('curseur', ''))
+        limite = min(int(request.GET.get('limite', 5000)), getattr(settings, 'ECOTRACK_FEED_MAX_PAGE', 50000))
+    except ValueError as exc:
+        return HttpResponseBadRequest(str(exc))
+    if limite < 1:
+        return HttpResponseBadRequest("La limite doit être positive.")
+
+    # Base résolue maintenant : le corps est produit après la sortie des middlewares (ville courante)
+    alias = router.db_for_write(Depense)
+    horizon = timezone.now() - timedelta(seconds=getattr(settings, 'ECOTRACK_FEED_LAG', 2))
+    end_m, end_s, has_more = _page_bounds(alias, pos_m, pos_s, limite, horizon)
+
+    # Fusion des deux flux triés, dans l'ordre (date, id)
+    events = heapq.merge(_changes(alias, pos_m, end_m), _deletions(alias, pos_s, end_s), key=lambda e: (e[0], e[1]))
+    if fmt == 'csv':
+        response = StreamingHttpResponse(_csv(events), content_type='text/csv; charset=utf-8')
+    else:
+        response = StreamingHttpResponse(_ndjson(events), content_type='application/x-ndjson; charset=utf-8')
+    response['X-Next-Cursor'] = encode_cursor(end_m or pos_m, end_s or pos_s)
+    response['X-Has-More'] = 'true' if has_more else 'false'
+    response['Cache-Control'] = 'no-store'
+    return compress_streaming(request, response)
@@ -1,4 +1,5 @@
 from django import forms
+from django.conf import settings
 from .models import Depense
 from django.utils import timezone
 import re
@@ -14,7 +15,47 @@ def normalize_quartier(value: str) -> str:
     return s.title()
 
 
-class DepenseForm(forms.ModelForm):
+def confirmer_doublon_field():
+    return forms.BooleanField(
+        required=False, label="Enregistrer quand même (ce n'est pas un doublon)",
+        widget=forms.CheckboxInput(attrs={'class': 'form-check-input'}))
+
+
+class DuplicateGuardMixin:
+    """
+    Vérifie à la saisie qu'une dépense quasi identique (même date, même lieu,
+    prix à moins de 2 %) n'existe pas déjà : double clic, double envoi...
+    ECOTRACK_DUPLICATE_POLICY : 'warn' (confirmation demandée), 'reject' ou 'off'.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.doublons = []
+
+    duplicate_guard = True
+
+    def clean(self):
+        cleaned = super().clean()
+        policy = getattr(settings, 'ECOTRACK_DUPLICATE_POLICY', 'warn') if self.duplicate_guard else 'off'
+        date, lieu, prix = cleaned.get('date'), cleaned.get('lieu'), cleaned.get('prix')
+        if policy == 'off' or not (date and lieu and prix):
+            return cleaned
+        self.doublons = Depense.probable_duplicates(date, lieu, prix, exclude_pk=self.instance.pk)
+        if not self.doublons:
+            return cleaned
+        existant = self.doublons[0]
+        message = (f"Une dépense similaire existe déjà : {existant.lieu}, {existant.prix} FCFA "
+                   f"le {existant.date:%d/%m/%Y}.")
+        if policy == 'reject':
+            raise forms.ValidationError(message, code='doublon')
+        if not cleaned.get('confirmer_doublon'):
+            raise forms.ValidationError(f"{message} Cochez la confirmation pour l'enregistrer quand même.",
+                                        code='doublon')
+        return cleaned
+
+
+class DepenseForm(DuplicateGuardMixin, forms.ModelForm):
+    confirmer_doublon = confirmer_doublon_field()
+
     class Meta:
         model = Depense
         fields = ['type_depense', 'quartier', 'prix', 'lieu', 'date', 'commentaire', 'photo']
@@ -55,4 +96,25 @@ class DepenseForm(forms.ModelForm):
         # Normalize user input early to ensure consistent storage
         if quartier:
             return normalize_quartier(quartier)
-        return quartier
\ No newline at end of file
+        return quartier
+
+class DepenseAdminForm(DuplicateGuardMixin, forms.ModelForm):
+    confirmer_doublon = confirmer_doublon_field()
+
+    class Meta:
+        model = Depense
+        fields = '__all__'
+
+
+class DepenseApiForm(DepenseForm):
+    """
+    Validation d'une dépense reçue par l'API de synchronisation : mêmes règles
+    que la saisie, sans photo ni confirmation de doublon (les renvois sont
+    dédoublonnés par clé d'idempotence, les vrais doublons signalés par le
+    worker d'anomalies).
+    """
+    duplicate_guard = False
+    confirmer_doublon = None
+
+    class Meta(DepenseForm.Meta):
+        fields = ['type_depense', 'quartier', 'prix', 'lieu', 'date', 'commentaire']
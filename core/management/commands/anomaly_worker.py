@@ -0,0 +1,46 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from core.anomalies import OUTLIER_METHODS, process_dirty
+from core.cities import cities
+
+
+class Command(BaseCommand):
+    help = ("Détection des anomalies en arrière-plan : re-détecte les partitions de dépenses "
+            "modifiées (date, type, quartier) après un délai de calme")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help="Traiter immédiatement les partitions en attente puis s'arrêter (mode cron)")
+        parser.add_argument('--full', action='store_true',
+                            help="Re-détecter toute la table (première mise en service, changement de méthode)")
+        parser.add_argument('--interval', type=float, default=2,
+                            help="Intervalle de scrutation en secondes (défaut : 2)")
+        parser.add_argument('--database', action='append', dest='databases',
+                            help="Base à traiter (répétable ; défaut : base principale et bases des villes)")
+        parser.add_argument('--method', choices=OUTLIER_METHODS,
+                            help="Méthode de seuil (défaut : ECOTRACK_OUTLIER_METHOD)")
+
+    def handle(self, *args, **options):
+        aliases = options['databases'] or list(dict.fromkeys(['default', *cities().values()]))
+        unknown = [a for a in aliases if a not in settings.DATABASES]
+        if unknown:
+            raise CommandError(f"Base inconnue : {', '.join(unknown)}")
+
+        full = options['full']
+        while True:
+            for alias in aliases:
+                run = process_dirty(alias, method=options['method'], force=options['once'], full=full)
+                if run is not None:
+                    self.stdout.write(
+                        f"[{alias}] {run.partitions} partition(s), {run.lignes_analysees} lignes analysées, "
+                        f"{run.lignes_signalees} signalées, {run.lignes_modifiees} modifiées "
+                        f"en {run.duree:.2f}s")
+            if options['once']:
+                return
+            full = False
+            close_old_connections()
+            time.sleep(options['interval'])
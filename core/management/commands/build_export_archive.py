@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.cities import cities
+from core.conditional import data_state, state_token
+from core.exports import DEPENSE_COLUMNS, build_archive
+from core.models import Depense
+from core.views import export_depenses_rows
+
+
+class Command(BaseCommand):
+    help = ("Pré-construit l'export CSV complet compressé (gzip, zstd si disponible), "
+            "servi tel quel par export/csv/ sans filtre. À lancer chaque nuit (cron)")
+
+    def handle(self, *args, **options):
+        # Base principale, puis une archive par ville
+        targets = [(None, 'default'), *cities().items()]
+        for city, alias in targets:
+            start = time.monotonic()
+            # État relevé avant la lecture : l'archive n'est servie que tant qu'il n'a pas changé
+            state = state_token(data_state(alias))
+            paths = build_archive('depenses', city, DEPENSE_COLUMNS,
+                                  lambda: export_depenses_rows(Depense.objects.using(alias)), state)
+            for path in paths:
+                self.stdout.write(f"{path} ({time.monotonic() - start:.1f}s)")
@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.cities import cities
+from core.models import Depense
+from core.photos import process_photo
+
+
+class Command(BaseCommand):
+    help = "Produit les versions web et les miniatures des photos en attente (pool saturé, photos existantes)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', action='append', dest='databases',
+                            help="Base à traiter (répétable ; défaut : base principale et bases des villes)")
+        parser.add_argument('--retry-errors', action='store_true',
+                            help="Retenter aussi les photos marquées illisibles")
+        parser.add_argument('--reprendre', action='store_true',
+                            help="Reprendre aussi les photos restées « en cours » (processus interrompu)")
+
+    def handle(self, *args, **options):
+        aliases = options['databases'] or list(dict.fromkeys(['default', *cities().values()]))
+        unknown = [a for a in aliases if a not in settings.DATABASES]
+        if unknown:
+            raise CommandError(f"Base inconnue : {', '.join(unknown)}")
+
+        statuts = [Depense.PHOTO_EN_ATTENTE]
+        if options['retry_errors']:
+            statuts.append(Depense.PHOTO_ERREUR)
+        if options['reprendre']:
+            statuts.append(Depense.PHOTO_EN_COURS)
+        for alias in aliases:
+            pks = list(Depense.objects.using(alias).filter(photo_statut__in=statuts).values_list('pk', flat=True))
+            resultats = [process_photo(pk, alias, statuts) for pk in pks]
+            self.stdout.write(f"[{alias}] {resultats.count(Depense.PHOTO_PRETE)} photo(s) traitée(s), "
+                              f"{resultats.count(Depense.PHOTO_ERREUR)} illisible(s)")
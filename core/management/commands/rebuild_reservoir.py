@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core.cities import cities
+from core.sampling import rebuild_reservoir
+
+
+class Command(BaseCommand):
+    help = "Refait le tirage de l'échantillon réservoir du mode approximatif (par quartier et type)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', action='append', dest='databases',
+                            help="Base à traiter (répétable ; défaut : base principale et bases des villes)")
+
+    def handle(self, *args, **options):
+        aliases = options['databases'] or list(dict.fromkeys(['default', *cities().values()]))
+        unknown = [a for a in aliases if a not in settings.DATABASES]
+        if unknown:
+            raise CommandError(f"Base inconnue : {', '.join(unknown)}")
+
+        for alias in aliases:
+            total = rebuild_reservoir(alias)
+            self.stdout.write(f"[{alias}] {total} dépense(s) échantillonnée(s)")
@@ -0,0 +1,55 @@
+import os
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+
+class Command(BaseCommand):
+    help = "Rafraîchit la réplique SQLite de lecture par copie en ligne (API backup) de la base principale"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=0,
+                            help="Rafraîchir en boucle toutes les N secondes (0 = une seule fois)")
+
+    def handle(self, *args, **options):
+        alias = settings.ECOTRACK_REPLICA_ALIAS
+        config = settings.DATABASES.get(alias)
+        if not config or 'sqlite3' not in config['ENGINE']:
+            raise CommandError(f"Aucune réplique SQLite configurée (alias '{alias}', voir ECOTRACK_SQLITE_REPLICA)")
+        if connections['default'].vendor != 'sqlite':
+            raise CommandError("La copie en ligne nécessite une base principale SQLite")
+
+        while True:
+            start = time.monotonic()
+            self.refresh(str(config['NAME']))
+            self.stdout.write(f"Réplique {alias} rafraîchie en {time.monotonic() - start:.2f}s")
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
+
+    def refresh(self, target):
+        source = connections['default']
+        source.ensure_connection()
+        # Copie dans un fichier temporaire puis remplacement atomique :
+        # les lecteurs en cours gardent l'ancienne version jusqu'à la fin.
+        tmp = f"{target}.tmp"
+        dest = sqlite3.connect(tmp)
+        try:
+            source.connection.backup(dest)
+            # La copie hérite du mode WAL de la base principale ; en lecture
+            # seule, un journal classique n'a pas de fichiers -wal/-shm liés
+            # au chemin de la réplique.
+            dest.execute('PRAGMA journal_mode=DELETE')
+        finally:
+            dest.close()
+        # -wal/-shm d'une ancienne réplique en WAL : SQLite les appliquerait
+        # au nouveau fichier. Les lecteurs ouverts gardent leurs descripteurs.
+        for suffix in ('-wal', '-shm'):
+            try:
+                os.remove(target + suffix)
+            except FileNotFoundError:
+                pass
+        os.replace(tmp, target)
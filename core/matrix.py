@@ -0,0 +1,71 @@
+"""
+Comparaison de N quartiers (et, au choix, de types) en une passe.
+
+Une seule requête GROUP BY (quartier, type) donne, pour chaque cellule, les
+agrégats fusionnables de `cities` (n, somme, somme des carrés, min, max).
+Les totaux par quartier sont des fusions de cellules, et les écarts de
+moyenne de toutes les paires de quartiers sont calculés d'un bloc (numpy) :
+aucun DataFrame par groupe, quel que soit le nombre de quartiers comparés.
+"""
+import numpy as np
+
+from .cities import finalize, grouped_partials, merge_partials
+
+Z_95 = 1.96
+
+
+def cell_partials(queryset):
+    """{(quartier, type): agrégat partiel} en une requête."""
+    return grouped_partials(queryset, 'quartier', 'type_depense')
+
+
+def matrix_stats(cells):
+    """
+    Tableau quartiers × types à partir des cellules : retourne (quartiers
+    triés par moyenne décroissante, types triés, moyennes (Q, T) avec NaN
+    pour les cellules vides, effectifs (Q, T), statistiques par quartier).
+    """
+    quartiers = sorted({q for q, _ in cells})
+    types = sorted({t for _, t in cells})
+    totaux = {q: finalize(merge_partials(p for (cq, _), p in cells.items() if cq == q)) for q in quartiers}
+    quartiers.sort(key=lambda q: totaux[q]['moyenne'], reverse=True)
+    index_q = {q: i for i, q in enumerate(quartiers)}
+    index_t = {t: j for j, t in enumerate(types)}
+    sommes = np.zeros((len(quartiers), len(types)))
+    effectifs = np.zeros((len(quartiers), len(types)), dtype=int)
+    for (q, t), p in cells.items():
+        sommes[index_q[q], index_t[t]] = p['somme']
+        effectifs[index_q[q], index_t[t]] = p['n']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        moyennes = np.where(effectifs > 0, sommes / effectifs, np.nan)
+    return quartiers, types, moyennes, effectifs, [totaux[q] for q in quartiers]
+
+
+def pairwise_differences(stats):
+    """
+    Écarts de moyenne de toutes les paires (i, j), le plus cher en premier,
+    triés par écart décroissant. `z` = écart / erreur type (Welch) ; une
+    paire est significative au seuil de 5 % si z > 1,96.
+    """
+    if len(stats) < 2:
+        return []
+    moyennes = np.array([s['moyenne'] for s in stats])
+    n = np.array([s['nombre'] for s in stats], dtype=float)
+    variances = np.array([s['ecart_type'] for s in stats]) ** 2
+    i, j = np.triu_indices(len(stats), k=1)
+    ecarts = moyennes[i] - moyennes[j]
+    a = np.where(ecarts >= 0, i, j)
+    b = np.where(ecarts >= 0, j, i)
+    ecarts = np.abs(ecarts)
+    erreur = np.sqrt(variances[a] / n[a] + variances[b] / n[b])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = np.where(erreur > 0, ecarts / erreur, np.nan)
+        relatif = np.where(moyennes[b] > 0, 100 * ecarts / moyennes[b], np.nan)
+    order = np.argsort(-ecarts, kind='stable')
+    return [
+        {'a': int(a[k]), 'b': int(b[k]), 'ecart': float(ecarts[k]),
+         'ecart_relatif': None if np.isnan(relatif[k]) else float(relatif[k]),
+         'z': None if np.isnan(z[k]) else float(z[k]),
+         'significatif': bool(z[k] > Z_95) if not np.isnan(z[k]) else False}
+        for k in order
+    ]
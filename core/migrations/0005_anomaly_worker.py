@@ -0,0 +1,51 @@
+# Generated by Django 4.2.30 on 2026-10-19 05:23
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_allow_quartier_freetext'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DetectionAnomalies',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('debut', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Début')),
+                ('duree', models.FloatField(verbose_name='Durée (s)')),
+                ('methode', models.CharField(max_length=10, verbose_name='Méthode')),
+                ('complete', models.BooleanField(default=False, verbose_name='Détection complète')),
+                ('partitions', models.PositiveIntegerField(default=0, verbose_name='Partitions traitées')),
+                ('lignes_analysees', models.PositiveIntegerField(default=0, verbose_name='Lignes analysées')),
+                ('lignes_signalees', models.PositiveIntegerField(default=0, verbose_name='Lignes signalées')),
+                ('lignes_modifiees', models.PositiveIntegerField(default=0, verbose_name='Annotations modifiées')),
+            ],
+            options={
+                'verbose_name': "Détection d'anomalies",
+                'verbose_name_plural': "Détections d'anomalies",
+                'ordering': ['-debut'],
+            },
+        ),
+        migrations.CreateModel(
+            name='PartitionModifiee',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('type_depense', models.CharField(max_length=50)),
+                ('quartier', models.CharField(max_length=100)),
+                ('date_marquage', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+            options={
+                'verbose_name': 'Partition à re-détecter',
+                'verbose_name_plural': 'Partitions à re-détecter',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='partitionmodifiee',
+            constraint=models.UniqueConstraint(fields=('date', 'type_depense', 'quartier'), name='partition_modifiee_unique'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 4.2.30 on 2026-10-19 05:25
+
+from django.db import migrations, models
+
+# Ordre = priorité de classement (voir core.models.classify_anomalie)
+AUTO_KINDS = [
+    ('doublon', 'Doublon'),
+    ('aberrant_type_quartier', 'par type et quartier'),
+    ('aberrant_quartier', 'par quartier'),
+    ('aberrant_bas', 'aberrante basse'),
+    ('aberrant_haut', 'Valeur aberrante'),
+]
+
+
+def backfill_kind(apps, schema_editor):
+    """Classe les annotations existantes d'après leur texte (quelques UPDATE, sans charger les lignes)."""
+    Depense = apps.get_model('core', 'Depense')
+    db = schema_editor.connection.alias
+    annotees = Depense.objects.using(db).exclude(anomalie='')
+    annotees.exclude(anomalie__startswith='[AUTO]').update(anomalie_kind='manuelle')
+    auto = annotees.filter(anomalie__startswith='[AUTO]')
+    for kind, fragment in AUTO_KINDS:
+        auto.filter(anomalie_kind='', anomalie__contains=fragment).update(anomalie_kind=kind)
+    auto.filter(anomalie_kind='').update(anomalie_kind='autre')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_anomaly_worker'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='depense',
+            name='anomalie_kind',
+            field=models.CharField(blank=True, choices=[('', 'Aucune'), ('doublon', 'Doublon'), ('aberrant_haut', 'Valeur aberrante élevée'), ('aberrant_bas', 'Valeur aberrante basse'), ('aberrant_type_quartier', 'Valeur aberrante par type et quartier'), ('aberrant_quartier', 'Valeur aberrante par quartier'), ('manuelle', 'Manuelle'), ('autre', 'Autre')], db_index=True, default='', max_length=30, verbose_name="Type d'anomalie"),
+        ),
+        migrations.RunPython(backfill_kind, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 4.2.30 on 2026-10-19 05:27
+
+import hashlib
+import math
+import re
+
+from django.db import migrations, models
+
+
+# Copies figées de core.models.prix_bucket / depense_fingerprint au moment de
+# la migration : une modification ultérieure du modèle ne doit pas la changer
+def prix_bucket(prix):
+    return math.floor(math.log(max(float(prix), 0.01)) / math.log(1.02))
+
+
+def depense_fingerprint(date, lieu, bucket):
+    lieu = re.sub(r"\s+", " ", (lieu or '').strip().lower())
+    return hashlib.sha1(f"{date}|{lieu}|{bucket}".encode('utf-8')).hexdigest()
+
+
+def backfill_empreinte(apps, schema_editor):
+    Depense = apps.get_model('core', 'Depense')
+    qs = Depense.objects.using(schema_editor.connection.alias)
+    lot = []
+    for dep in qs.only('id', 'date', 'lieu', 'prix').iterator(chunk_size=2000):
+        dep.empreinte = depense_fingerprint(dep.date, dep.lieu, prix_bucket(dep.prix))
+        lot.append(dep)
+        if len(lot) >= 2000:
+            qs.bulk_update(lot, ['empreinte'])
+            lot = []
+    qs.bulk_update(lot, ['empreinte'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_depense_anomalie_kind'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='depense',
+            name='empreinte',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=40),
+        ),
+        migrations.RunPython(backfill_empreinte, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.2.30 on 2026-10-19 05:28
+
+from django.db import migrations, models
+
+
+def mark_existing_photos(apps, schema_editor):
+    """Les photos déjà présentes seront traitées par `manage.py process_photos`."""
+    Depense = apps.get_model('core', 'Depense')
+    (Depense.objects.using(schema_editor.connection.alias)
+     .exclude(photo='').exclude(photo__isnull=True).update(photo_statut='en_attente'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_depense_empreinte'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='depense',
+            name='photo_hauteur',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True, verbose_name='Hauteur (px)'),
+        ),
+        migrations.AddField(
+            model_name='depense',
+            name='photo_largeur',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True, verbose_name='Largeur (px)'),
+        ),
+        migrations.AddField(
+            model_name='depense',
+            name='photo_miniature',
+            field=models.ImageField(blank=True, editable=False, null=True, upload_to='photos/miniatures/', verbose_name='Miniature'),
+        ),
+        migrations.AddField(
+            model_name='depense',
+            name='photo_statut',
+            field=models.CharField(blank=True, choices=[('', 'Aucune photo'), ('en_attente', 'En cours de traitement'), ('prete', 'Prête'), ('erreur', 'Image illisible')], default='', editable=False, max_length=12, verbose_name='Traitement de la photo'),
+        ),
+        migrations.RunPython(mark_existing_photos, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 05:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_photo_pipeline'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='depense',
+            name='cle_idempotence',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True, verbose_name="Clé d'idempotence"),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.30 on 2026-10-19 05:31
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_depense_cle_idempotence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DepenseSupprimee',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depense_id', models.BigIntegerField(verbose_name='Dépense')),
+                ('date_suppression', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Date de suppression')),
+            ],
+            options={
+                'verbose_name': 'Dépense supprimée',
+                'verbose_name_plural': 'Dépenses supprimées',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='depense',
+            index=models.Index(fields=['date_modification', 'id'], name='depense_modif_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='depensesupprimee',
+            index=models.Index(fields=['date_suppression', 'id'], name='suppression_date_id_idx'),
+        ),
+    ]
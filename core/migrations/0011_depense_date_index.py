@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-19 05:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_change_feed'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='depense',
+            index=models.Index(fields=['date', 'type_depense', 'quartier'], name='depense_date_type_q_idx'),
+        ),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 4.2.30 on 2026-10-19 05:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.conf import settings
+from django.db.models import Count
+
+
+def build_reservoir(apps, schema_editor):
+    """Tirage initial : jusqu'à ECOTRACK_RESERVOIR_SIZE dépenses au hasard par (quartier, type)."""
+    Depense = apps.get_model('core', 'Depense')
+    StrateEchantillon = apps.get_model('core', 'StrateEchantillon')
+    EchantillonDepense = apps.get_model('core', 'EchantillonDepense')
+    alias = schema_editor.connection.alias
+    taille = getattr(settings, 'ECOTRACK_RESERVOIR_SIZE', 500)
+    effectifs = (Depense.objects.using(alias).order_by().values_list('quartier', 'type_depense')
+                 .annotate(n=Count('id')))
+    for quartier, type_depense, n in effectifs:
+        strate = StrateEchantillon.objects.using(alias).create(quartier=quartier, type_depense=type_depense, vues=n)
+        ids = (Depense.objects.using(alias).filter(quartier=quartier, type_depense=type_depense)
+               .order_by('?').values_list('id', flat=True)[:taille])
+        EchantillonDepense.objects.using(alias).bulk_create(
+            [EchantillonDepense(strate=strate, emplacement=i, depense_id=pk) for i, pk in enumerate(ids)])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_depense_date_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EchantillonDepense',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('emplacement', models.PositiveIntegerField()),
+            ],
+            options={
+                'verbose_name': 'Dépense échantillonnée',
+                'verbose_name_plural': 'Dépenses échantillonnées',
+            },
+        ),
+        migrations.CreateModel(
+            name='StrateEchantillon',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quartier', models.CharField(max_length=100)),
+                ('type_depense', models.CharField(max_length=50)),
+                ('vues', models.PositiveBigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': "Strate d'échantillon",
+                'verbose_name_plural': "Strates d'échantillon",
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='strateechantillon',
+            constraint=models.UniqueConstraint(fields=('quartier', 'type_depense'), name='strate_echantillon_unique'),
+        ),
+        migrations.AddField(
+            model_name='echantillondepense',
+            name='depense',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='echantillon', to='core.depense'),
+        ),
+        migrations.AddField(
+            model_name='echantillondepense',
+            name='strate',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='emplacements', to='core.strateechantillon'),
+        ),
+        migrations.AddConstraint(
+            model_name='echantillondepense',
+            constraint=models.UniqueConstraint(fields=('strate', 'emplacement'), name='echantillon_emplacement_unique'),
+        ),
+        migrations.RunPython(build_reservoir, migrations.RunPython.noop),
+    ]
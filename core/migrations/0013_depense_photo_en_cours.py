@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 06:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_reservoir_sample'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='depense',
+            name='photo_statut',
+            field=models.CharField(blank=True, choices=[('', 'Aucune photo'), ('en_attente', 'En cours de traitement'), ('en_cours', 'Traitement en cours'), ('prete', 'Prête'), ('erreur', 'Image illisible')], default='', editable=False, max_length=12, verbose_name='Traitement de la photo'),
+        ),
+    ]
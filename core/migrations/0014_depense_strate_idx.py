@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-19 06:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_depense_photo_en_cours'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='depense',
+            index=models.Index(fields=['quartier', 'type_depense'], name='depense_strate_idx'),
+        ),
+    ]
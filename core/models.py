@@ -1,9 +1,50 @@
 # Create your models here.
+import hashlib
+import math
+import re
+
 from django.db import models
 from django.core.validators import MinValueValidator
 from django.utils import timezone
 
 
+# Largeur relative d'une tranche de prix. La règle des 2 % (|a - b| / max < 0,02)
+# admet un rapport jusqu'à 1 / 0,98 ≈ 1,0204 > 1,02 : deux doublons peuvent
+# donc être à deux tranches l'un de l'autre (jamais plus, 1,0204 < 1,02²)
+PRIX_BUCKET_RATIO = 1.02
+DUPLICATE_BUCKET_SPAN = 2
+
+
+def prix_bucket(prix):
+    """Tranche logarithmique du prix (tranches de 2 %)."""
+    return math.floor(math.log(max(float(prix), 0.01)) / math.log(PRIX_BUCKET_RATIO))
+
+
+def depense_fingerprint(date, lieu, bucket):
+    """Empreinte (date, lieu normalisé, tranche de prix) utilisée pour repérer les doublons à la saisie."""
+    lieu = re.sub(r"\s+", " ", (lieu or '').strip().lower())
+    return hashlib.sha1(f"{date}|{lieu}|{bucket}".encode('utf-8')).hexdigest()
+
+
+def classify_anomalie(texte):
+    """Type d'anomalie déduit du texte libre (annotations manuelles et anciennes lignes)."""
+    if not texte:
+        return ''
+    if not texte.startswith('[AUTO]'):
+        return Depense.KIND_MANUELLE
+    if 'Doublon' in texte:
+        return Depense.KIND_DOUBLON
+    if 'par type et quartier' in texte:
+        return Depense.KIND_ABERRANT_TYPE_QUARTIER
+    if 'par quartier' in texte:
+        return Depense.KIND_ABERRANT_QUARTIER
+    if 'aberrante basse' in texte:
+        return Depense.KIND_ABERRANT_BAS
+    if 'Valeur aberrante' in texte:
+        return Depense.KIND_ABERRANT_HAUT
+    return Depense.KIND_AUTRE
+
+
 class Depense(models.Model):
     TYPE_DEPENSE_CHOICES = [
         ('alimentation', 'Alimentation'),
@@ -13,6 +54,36 @@ class Depense(models.Model):
         ('autre', 'Autre'),
     ]
     
+    KIND_DOUBLON = 'doublon'
+    KIND_ABERRANT_HAUT = 'aberrant_haut'
+    KIND_ABERRANT_BAS = 'aberrant_bas'
+    KIND_ABERRANT_TYPE_QUARTIER = 'aberrant_type_quartier'
+    KIND_ABERRANT_QUARTIER = 'aberrant_quartier'
+    KIND_MANUELLE = 'manuelle'
+    KIND_AUTRE = 'autre'
+    ANOMALIE_KIND_CHOICES = [
+        ('', 'Aucune'),
+        (KIND_DOUBLON, 'Doublon'),
+        (KIND_ABERRANT_HAUT, 'Valeur aberrante élevée'),
+        (KIND_ABERRANT_BAS, 'Valeur aberrante basse'),
+        (KIND_ABERRANT_TYPE_QUARTIER, 'Valeur aberrante par type et quartier'),
+        (KIND_ABERRANT_QUARTIER, 'Valeur aberrante par quartier'),
+        (KIND_MANUELLE, 'Manuelle'),
+        (KIND_AUTRE, 'Autre'),
+    ]
+
+    PHOTO_EN_ATTENTE = 'en_attente'
+    PHOTO_EN_COURS = 'en_cours'
+    PHOTO_PRETE = 'prete'
+    PHOTO_ERREUR = 'erreur'
+    PHOTO_STATUT_CHOICES = [
+        ('', 'Aucune photo'),
+        (PHOTO_EN_ATTENTE, 'En cours de traitement'),
+        (PHOTO_EN_COURS, 'Traitement en cours'),
+        (PHOTO_PRETE, 'Prête'),
+        (PHOTO_ERREUR, 'Image illisible'),
+    ]
+
     QUARTIER_CHOICES = [
         ('campus', 'Campus'),
         ('centre_ville', 'Centre-ville'),
@@ -30,7 +101,22 @@ class Depense(models.Model):
     date = models.DateField(default=timezone.now, verbose_name="Date")
     commentaire = models.TextField(blank=True, verbose_name="Commentaire")
     photo = models.ImageField(upload_to='photos/', blank=True, null=True, verbose_name="Photo justificative")
+    # Dérivés produits hors requête par core/photos.py
+    photo_miniature = models.ImageField(upload_to='photos/miniatures/', blank=True, null=True, editable=False,
+                                        verbose_name="Miniature")
+    photo_largeur = models.PositiveIntegerField(null=True, blank=True, editable=False, verbose_name="Largeur (px)")
+    photo_hauteur = models.PositiveIntegerField(null=True, blank=True, editable=False, verbose_name="Hauteur (px)")
+    photo_statut = models.CharField(max_length=12, choices=PHOTO_STATUT_CHOICES, blank=True, default='',
+                                    editable=False, verbose_name="Traitement de la photo")
     anomalie = models.TextField(blank=True, verbose_name="Anomalie détectée")
+    # Écrit par le détecteur (core/anomalies.py) ; 'manuelle' pour les annotations saisies à la main
+    anomalie_kind = models.CharField(max_length=30, choices=ANOMALIE_KIND_CHOICES, blank=True, default='',
+                                     db_index=True, verbose_name="Type d'anomalie")
+    # Empreinte de doublon (voir depense_fingerprint), calculée à l'enregistrement
+    empreinte = models.CharField(max_length=40, db_index=True, editable=False, default='')
+    # Clé fournie par le client de l'API de synchronisation (core/api.py) : un renvoi ne crée pas de doublon
+    cle_idempotence = models.CharField(max_length=64, unique=True, null=True, blank=True, editable=False,
+                                       verbose_name="Clé d'idempotence")
     date_creation = models.DateTimeField(auto_now_add=True, verbose_name="Date de création")
     date_modification = models.DateTimeField(auto_now=True, verbose_name="Date de modification")
 
@@ -45,6 +131,11 @@ class Depense(models.Model):
 
     def save(self, *args, **kwargs):
         """Normalize the `quartier` field on save to maintain consistent values."""
+        self.prepare_for_save()
+        super().save(*args, **kwargs)
+
+    def prepare_for_save(self):
+        """Champs dérivés calculés avant écriture (aussi appelé avant un bulk_create, qui ne passe pas par save())."""
         if self.quartier:
             # Inline normalization: strip, collapse spaces, replace -/_ with spaces, title case
             import re
@@ -52,9 +143,128 @@ class Depense(models.Model):
             s = re.sub(r"[\-_]+", " ", s)
             s = re.sub(r"\s+", " ", s)
             self.quartier = s.title()
-        super().save(*args, **kwargs)
+        if self.photo and not self.photo._committed:
+            # Nouvelle photo : les dérivés seront produits après l'enregistrement
+            self.photo_statut = self.PHOTO_EN_ATTENTE
+            self.photo_miniature = None
+            self.photo_largeur = self.photo_hauteur = None
+        elif not self.photo:
+            self.photo_statut = ''
+            self.photo_miniature = None
+        if self.date and self.prix is not None:
+            self.empreinte = depense_fingerprint(self.date, self.lieu, prix_bucket(self.prix))
+        if not self.anomalie or not self.anomalie.startswith('[AUTO]') or not self.anomalie_kind:
+            self.anomalie_kind = classify_anomalie(self.anomalie)
+
+    @classmethod
+    def probable_duplicates(cls, date, lieu, prix, exclude_pk=None, using=None):
+        """
+        Dépenses déjà enregistrées avec la même date, le même lieu et un prix
+        à moins de 2 % : une recherche indexée sur cinq empreintes (la
+        tranche du prix et les deux tranches de chaque côté), puis
+        vérification exacte.
+        """
+        bucket = prix_bucket(prix)
+        empreintes = [depense_fingerprint(date, lieu, b)
+                      for b in range(bucket - DUPLICATE_BUCKET_SPAN, bucket + DUPLICATE_BUCKET_SPAN + 1)]
+        candidats = cls.objects.using(using).filter(empreinte__in=empreintes)
+        if exclude_pk is not None:
+            candidats = candidats.exclude(pk=exclude_pk)
+        prix = float(prix)
+        return [d for d in candidats if abs(float(d.prix) - prix) / max(float(d.prix), prix) < 0.02]
 
     class Meta:
         ordering = ['-date']
         verbose_name = "Dépense"
-        verbose_name_plural = "Dépenses"
\ No newline at end of file
+        verbose_name_plural = "Dépenses"
+        indexes = [
+            # Flux de changements (core/feed.py) : parcours par (date_modification, id)
+            models.Index(fields=['date_modification', 'id'], name='depense_modif_id_idx'),
+            # Fenêtre de dates du dashboard (filtres type / quartier en suffixe)
+            models.Index(fields=['date', 'type_depense', 'quartier'], name='depense_date_type_q_idx'),
+            # Effectifs par strate du mode approximatif (core/sampling.py) : GROUP BY sur l'index seul
+            models.Index(fields=['quartier', 'type_depense'], name='depense_strate_idx'),
+        ]
+
+
+class DepenseSupprimee(models.Model):
+    """Pierre tombale d'une dépense supprimée, publiée par le flux de changements."""
+    depense_id = models.BigIntegerField(verbose_name="Dépense")
+    date_suppression = models.DateTimeField(default=timezone.now, verbose_name="Date de suppression")
+
+    class Meta:
+        verbose_name = "Dépense supprimée"
+        verbose_name_plural = "Dépenses supprimées"
+        indexes = [
+            models.Index(fields=['date_suppression', 'id'], name='suppression_date_id_idx'),
+        ]
+
+class PartitionModifiee(models.Model):
+    """
+    Marqueur « à re-détecter » : une ligne par (date, type, quartier) touché
+    depuis la dernière détection. Posé par les signaux de `Depense`
+    (core/signals.py), consommé par `manage.py anomaly_worker`.
+    """
+    date = models.DateField()
+    type_depense = models.CharField(max_length=50)
+    quartier = models.CharField(max_length=100)
+    date_marquage = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        verbose_name = "Partition à re-détecter"
+        verbose_name_plural = "Partitions à re-détecter"
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'type_depense', 'quartier'], name='partition_modifiee_unique'),
+        ]
+
+
+class DetectionAnomalies(models.Model):
+    """Journal des passes de détection d'anomalies."""
+    debut = models.DateTimeField(default=timezone.now, verbose_name="Début")
+    duree = models.FloatField(verbose_name="Durée (s)")
+    methode = models.CharField(max_length=10, verbose_name="Méthode")
+    complete = models.BooleanField(default=False, verbose_name="Détection complète")
+    partitions = models.PositiveIntegerField(default=0, verbose_name="Partitions traitées")
+    lignes_analysees = models.PositiveIntegerField(default=0, verbose_name="Lignes analysées")
+    lignes_signalees = models.PositiveIntegerField(default=0, verbose_name="Lignes signalées")
+    lignes_modifiees = models.PositiveIntegerField(default=0, verbose_name="Annotations modifiées")
+
+    def __str__(self):
+        return f"Détection du {self.debut:%d/%m/%Y %H:%M} ({self.lignes_signalees} signalées)"
+
+    class Meta:
+        ordering = ['-debut']
+        verbose_name = "Détection d'anomalies"
+        verbose_name_plural = "Détections d'anomalies"
+
+
+class StrateEchantillon(models.Model):
+    """
+    Strate (quartier, type) de l'échantillon réservoir utilisé par le mode
+    approximatif (core/sampling.py). `vues` compte les dépenses insérées
+    dans la strate depuis la construction du réservoir (algorithme R).
+    """
+    quartier = models.CharField(max_length=100)
+    type_depense = models.CharField(max_length=50)
+    vues = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Strate d'échantillon"
+        verbose_name_plural = "Strates d'échantillon"
+        constraints = [
+            models.UniqueConstraint(fields=['quartier', 'type_depense'], name='strate_echantillon_unique'),
+        ]
+
+
+class EchantillonDepense(models.Model):
+    """Emplacement du réservoir d'une strate, occupé par une dépense."""
+    strate = models.ForeignKey(StrateEchantillon, on_delete=models.CASCADE, related_name='emplacements')
+    emplacement = models.PositiveIntegerField()
+    depense = models.OneToOneField(Depense, on_delete=models.CASCADE, related_name='echantillon')
+
+    class Meta:
+        verbose_name = "Dépense échantillonnée"
+        verbose_name_plural = "Dépenses échantillonnées"
+        constraints = [
+            models.UniqueConstraint(fields=['strate', 'emplacement'], name='echantillon_emplacement_unique'),
+        ]
@@ -0,0 +1,175 @@
+"""
+Traitement des photos justificatives hors requête.
+
+Le fichier envoyé est écrit sur disque par morceaux pendant l'upload
+(FILE_UPLOAD_HANDLERS = TemporaryFileUploadHandler) puis simplement déplacé
+dans MEDIA_ROOT. Après la validation de la transaction, un pool de threads
+borné produit :
+- une version web redimensionnée (WebP si Pillow le permet, sinon JPEG)
+  qui remplace l'original ;
+- une miniature affichée dans les listes.
+Les deux sont réencodées sans métadonnées EXIF (orientation appliquée avant).
+
+Si le pool est plein, la photo reste `en_attente` et sera traitée par
+`python manage.py process_photos`.
+
+Quand une photo est remplacée ou retirée, ou la dépense supprimée, les
+fichiers précédents (original ou version web, miniature) sont supprimés du
+stockage après la validation de la transaction.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connections, router, transaction
+from PIL import Image, ImageOps, UnidentifiedImageError, features
+
+from .models import Depense
+
+
+def _format():
+    if features.check('webp'):
+        return 'WEBP', 'webp'
+    return 'JPEG', 'jpg'
+
+
+def _encode(img, max_size, quality):
+    img = img.copy()
+    img.thumbnail((max_size, max_size), Image.LANCZOS)
+    fmt, ext = _format()
+    buf = BytesIO()
+    # Pas de paramètre exif : l'image réencodée ne contient aucune métadonnée
+    img.save(buf, fmt, quality=quality, method=4) if fmt == 'WEBP' else img.save(buf, fmt, quality=quality, optimize=True)
+    return ContentFile(buf.getvalue()), ext, img.size
+
+
+def process_photo(pk, using=None, statuts=(Depense.PHOTO_EN_ATTENTE,)):
+    """
+    Produit la version web et la miniature d'une dépense ; retourne le statut
+    final, ou None si la ligne n'est pas à traiter.
+
+    La ligne est d'abord réservée (statut `en_cours`, mise à jour
+    conditionnelle) : deux passes sur la même dépense (pool et
+    `process_photos`, nouvel enregistrement d'une ligne en attente) ne
+    traitent pas deux fois le même original. Le résultat n'est écrit que si
+    la photo n'a pas changé entre-temps ; l'original n'est supprimé qu'alors.
+    """
+    depense = Depense.objects.using(using).filter(pk=pk).only('id', 'photo').first()
+    if depense is None or not depense.photo:
+        return None
+    storage = depense.photo.storage
+    original = depense.photo.name
+    qs = Depense.objects.using(using).filter(pk=pk, photo=original)
+    if not qs.filter(photo_statut__in=statuts).update(photo_statut=Depense.PHOTO_EN_COURS):
+        return None
+    reservee = qs.filter(photo_statut=Depense.PHOTO_EN_COURS)
+    web_size = getattr(settings, 'ECOTRACK_PHOTO_WEB_SIZE', 1600)
+    try:
+        try:
+            with storage.open(original, 'rb') as f:
+                img = Image.open(f)
+                # JPEG : décodage directement à une résolution réduite (bien plus rapide sur 12 Mpx)
+                img.draft('RGB', (web_size, web_size))
+                img = ImageOps.exif_transpose(img)
+                img.load()
+        except (OSError, UnidentifiedImageError, Image.DecompressionBombError):
+            reservee.update(photo_statut=Depense.PHOTO_ERREUR)
+            return Depense.PHOTO_ERREUR
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+
+        stem = os.path.splitext(os.path.basename(original))[0]
+        web, ext, (largeur, hauteur) = _encode(img, web_size, 82)
+        miniature, _, _ = _encode(img, getattr(settings, 'ECOTRACK_PHOTO_THUMB_SIZE', 320), 70)
+        web_name = storage.save(f"photos/web/{stem}.{ext}", web)
+        thumb_name = storage.save(f"photos/miniatures/{stem}.{ext}", miniature)
+    except Exception:
+        # Erreur inattendue : la ligne redevient à traiter
+        reservee.update(photo_statut=Depense.PHOTO_EN_ATTENTE)
+        raise
+    # update() : ni signaux, ni date_modification (le contenu de la dépense ne change pas)
+    if not reservee.update(photo=web_name, photo_miniature=thumb_name, photo_largeur=largeur,
+                           photo_hauteur=hauteur, photo_statut=Depense.PHOTO_PRETE):
+        # Photo remplacée pendant le traitement : les copies produites sont orphelines
+        storage.delete(web_name)
+        storage.delete(thumb_name)
+        return None
+    storage.delete(original)
+    return Depense.PHOTO_PRETE
+
+
+class PhotoPipeline:
+    def __init__(self, workers=None, max_pending=None):
+        self.workers = workers or getattr(settings, 'ECOTRACK_PHOTO_WORKERS', 2)
+        self._slots = threading.BoundedSemaphore(max_pending or getattr(settings, 'ECOTRACK_PHOTO_MAX_PENDING', 32))
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def submit(self, pk, using):
+        """Planifie le traitement ; False si le pool est saturé (la photo reste en attente)."""
+        if not getattr(settings, 'ECOTRACK_PHOTO_ASYNC', True):
+            process_photo(pk, using)
+            return True
+        if not self._slots.acquire(blocking=False):
+            return False
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='ecotrack-photos')
+        self._pool.submit(self._run, pk, using)
+        return True
+
+    def _run(self, pk, using):
+        try:
+            process_photo(pk, using)
+        finally:
+            connections.close_all()
+            self._slots.release()
+
+
+photo_pipeline = PhotoPipeline()
+
+
+def _photo_files(depense):
+    return {f.name for f in (depense.photo, depense.photo_miniature) if f}
+
+
+def _delete_after_commit(storage, names, using):
+    def delete():
+        for name in names:
+            storage.delete(name)
+    if names:
+        transaction.on_commit(delete, using=using)
+
+
+def remember_photo_files(sender, instance, raw=False, using=None, update_fields=None, **kwargs):
+    """pre_save : fichiers de la photo enregistrée, à supprimer s'ils ne servent plus."""
+    instance._ecotrack_old_photo_files = set()
+    if raw or instance.pk is None or (update_fields is not None and 'photo' not in update_fields):
+        return
+    old = Depense.objects.using(using).filter(pk=instance.pk).only('photo', 'photo_miniature').first()
+    if old is not None:
+        instance._ecotrack_old_photo_files = _photo_files(old)
+
+
+def delete_replaced_photo_files(sender, instance, raw=False, using=None, **kwargs):
+    """post_save : supprime l'ancienne photo et sa miniature après remplacement ou retrait."""
+    old = getattr(instance, '_ecotrack_old_photo_files', set())
+    if raw or not old:
+        return
+    _delete_after_commit(instance.photo.storage, old - _photo_files(instance), using)
+
+
+def delete_photo_files(sender, instance, using=None, **kwargs):
+    """post_delete : fichiers de la dépense supprimée."""
+    _delete_after_commit(instance.photo.storage, _photo_files(instance), using)
+
+
+def schedule_photo(sender, instance, using=None, raw=False, **kwargs):
+    """post_save : traite la nouvelle photo une fois la transaction validée."""
+    if raw or instance.photo_statut != Depense.PHOTO_EN_ATTENTE:
+        return
+    alias = using or router.db_for_write(Depense, instance=instance)
+    transaction.on_commit(lambda: photo_pipeline.submit(instance.pk, alias), using=alias)
@@ -0,0 +1,118 @@
+"""
+Routage base de données des lectures d'analyse.
+
+Les vues d'analyse (dashboard, comparaisons, anomalies, exports) sont
+décorées par `analytics_view` : pendant leur exécution, les lectures des
+modèles de `core` partent vers la réplique ECOTRACK_REPLICA_ALIAS si elle
+est configurée et suffisamment fraîche. Les écritures, sessions et
+messages restent toujours sur la base principale.
+
+`CityRouter` passe avant : pour une requête rattachée à une ville, tout
+`core` est servi par la base de cette ville (voir core/cities.py).
+
+En local, la réplique est une copie SQLite rafraîchie par
+`python manage.py refresh_replica` ; son âge est celui du fichier.
+"""
+import functools
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+
+from .cities import cities, city_alias
+
+_analytics_reads = ContextVar('ecotrack_analytics_reads', default=False)
+
+
+@contextmanager
+def analytics_reads():
+    """Oriente les lectures de `core` vers la réplique dans ce bloc."""
+    token = _analytics_reads.set(True)
+    try:
+        yield
+    finally:
+        _analytics_reads.reset(token)
+
+
+def analytics_view(view):
+    """Décorateur de vue : lectures d'analyse sur la réplique."""
+    if iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def async_wrapper(*args, **kwargs):
+            with analytics_reads():
+                return await view(*args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        with analytics_reads():
+            return view(*args, **kwargs)
+    return wrapper
+
+
+def replica_age(alias):
+    """Âge en secondes de la réplique (0 si inconnu, ex: réplique PostgreSQL gérée ailleurs)."""
+    config = settings.DATABASES.get(alias, {})
+    if 'sqlite3' not in config.get('ENGINE', ''):
+        return 0
+    try:
+        return time.time() - os.path.getmtime(config['NAME'])
+    except OSError:
+        return None
+
+
+def replica_alias():
+    """Alias de la réplique utilisable maintenant, ou None."""
+    alias = getattr(settings, 'ECOTRACK_REPLICA_ALIAS', None)
+    if not alias or alias not in settings.DATABASES:
+        return None
+    age = replica_age(alias)
+    if age is None or age > getattr(settings, 'ECOTRACK_REPLICA_MAX_STALENESS', 300):
+        # Réplique absente ou trop ancienne : repli sur la base principale
+        return None
+    return alias
+
+
+class CityRouter:
+    """Envoie les modèles de `core` vers la base de la ville courante."""
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == 'core':
+            return city_alias()
+        return None
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label == 'core':
+            return city_alias()
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in cities().values() and db != 'default':
+            # Les bases de ville ne contiennent que les données de `core`
+            return app_label == 'core'
+        return None
+
+
+class AnalyticsReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != 'core' or not _analytics_reads.get():
+            return None
+        return replica_alias()
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # La réplique est une copie de la base principale : jamais migrée directement
+        if db == getattr(settings, 'ECOTRACK_REPLICA_ALIAS', None):
+            return False
+        return None
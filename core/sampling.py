@@ -0,0 +1,167 @@
+"""
+Mode approximatif des pages d'analyse : échantillon réservoir stratifié.
+
+Chaque strate (quartier, type) garde au plus ECOTRACK_RESERVOIR_SIZE
+dépenses tirées uniformément parmi celles insérées (algorithme R de
+Vitter). Le réservoir est tenu à jour à chaque insertion (signal
+post_save, API par lots) et persisté en base (`StrateEchantillon`,
+`EchantillonDepense`). Une suppression libère son emplacement (cascade),
+réoccupé par la prochaine insertion de la strate. `manage.py
+rebuild_reservoir` refait un tirage complet.
+
+Avec `?approx=1`, ou automatiquement au-delà de ECOTRACK_APPROX_THRESHOLD
+lignes, dashboard et comparaison lisent l'échantillon au lieu de la table :
+- effectifs exacts par strate (GROUP BY sur l'index quartier, type) pour pondérer ;
+- moyennes par estimateur stratifié, avec intervalle de confiance à 95 % ;
+- médianes et box plots sur un rééchantillonnage pondéré.
+"""
+import random
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q
+
+from .models import Depense, EchantillonDepense, StrateEchantillon
+
+Z_95 = 1.96
+STRATE = ['quartier', 'type_depense']
+
+
+def reservoir_size():
+    return getattr(settings, 'ECOTRACK_RESERVOIR_SIZE', 500)
+
+
+def reservoir_add(using, depenses):
+    """
+    Propose des dépenses nouvellement insérées au réservoir de leur strate
+    (algorithme R). Requêtes groupées : un lot de l'API coûte autant qu'une
+    seule dépense. Les strates sont verrouillées (`select_for_update`)
+    jusqu'à la fin de la transaction : deux lots simultanés ne perdent pas
+    d'incrément de `vues`, dont dépend le tirage.
+    """
+    taille = reservoir_size()
+    par_strate = defaultdict(list)
+    for depense in depenses:
+        par_strate[(depense.quartier, depense.type_depense)].append(depense)
+    if not par_strate:
+        return
+    strates_qs = StrateEchantillon.objects.using(using)
+    with transaction.atomic(using=using):
+        cles = Q()
+        for quartier, type_depense in par_strate:
+            cles |= Q(quartier=quartier, type_depense=type_depense)
+        verrouillees = strates_qs.select_for_update().filter(cles).order_by('pk')
+        strates = {(s.quartier, s.type_depense): s for s in verrouillees}
+        manquantes = [StrateEchantillon(quartier=q, type_depense=t) for q, t in par_strate if (q, t) not in strates]
+        if manquantes:
+            strates_qs.bulk_create(manquantes, ignore_conflicts=True)
+            strates = {(s.quartier, s.type_depense): s for s in verrouillees.all()}
+        occupes = defaultdict(set)
+        for strate_id, emplacement in (EchantillonDepense.objects.using(using)
+                                       .filter(strate__in=strates.values()).values_list('strate_id', 'emplacement')):
+            occupes[strate_id].add(emplacement)
+
+        remplacements = []
+        for key, items in par_strate.items():
+            strate = strates[key]
+            pris = occupes[strate.pk]
+            for depense in items:
+                strate.vues += 1
+                if len(pris) < taille:
+                    # Remplissage initial, ou emplacement libéré par une suppression
+                    slot = min(set(range(taille)) - pris)
+                else:
+                    slot = random.randrange(strate.vues)
+                    if slot >= taille:
+                        continue
+                pris.add(slot)
+                remplacements.append(EchantillonDepense(strate=strate, emplacement=slot, depense=depense))
+        # Upsert : un emplacement déjà occupé change de dépense
+        EchantillonDepense.objects.using(using).bulk_create(
+            remplacements, update_conflicts=True, unique_fields=['strate', 'emplacement'], update_fields=['depense'])
+        strates_qs.bulk_update(strates.values(), ['vues'])
+
+
+def sample_saved(sender, instance, created=False, raw=False, using=None, **kwargs):
+    """post_save : nouvelle dépense, ou dépense passée dans une autre strate."""
+    if raw:
+        return
+    if not created:
+        old = getattr(instance, '_ecotrack_old_partition', None)
+        if not old or (old[2], old[1]) == (instance.quartier, instance.type_depense):
+            return
+        EchantillonDepense.objects.using(using).filter(depense_id=instance.pk).delete()
+    reservoir_add(using, [instance])
+
+
+def rebuild_reservoir(using=None):
+    """Nouveau tirage uniforme dans chaque strate ; retourne le nombre de dépenses échantillonnées."""
+    taille = reservoir_size()
+    total = 0
+    with transaction.atomic(using=using):
+        StrateEchantillon.objects.using(using).all().delete()
+        effectifs = Depense.objects.using(using).order_by().values_list(*STRATE).annotate(n=Count('id'))
+        for quartier, type_depense, n in effectifs:
+            strate = StrateEchantillon.objects.using(using).create(quartier=quartier, type_depense=type_depense, vues=n)
+            ids = (Depense.objects.using(using).filter(quartier=quartier, type_depense=type_depense)
+                   .order_by('?').values_list('id', flat=True)[:taille])
+            EchantillonDepense.objects.using(using).bulk_create(
+                [EchantillonDepense(strate=strate, emplacement=i, depense_id=pk) for i, pk in enumerate(ids)])
+            total += min(n, taille)
+    return total
+
+
+def approx_mode(param, queryset):
+    """`approx=1` / `approx=0` explicites ; sinon approximatif au-delà de ECOTRACK_APPROX_THRESHOLD lignes."""
+    if param in ('0', '1'):
+        return param == '1'
+    return queryset.count() > getattr(settings, 'ECOTRACK_APPROX_THRESHOLD', 1_000_000)
+
+
+def sample_frame(queryset, columns):
+    """
+    Lignes échantillonnées de `queryset` avec le poids de leur strate
+    (effectif / taille de l'échantillon), et l'effectif exact du queryset.
+    Échantillon None si le réservoir est vide (pas encore construit).
+    """
+    effectifs = {(q, t): n for q, t, n in queryset.order_by().values_list(*STRATE).annotate(n=Count('id'))}
+    population = sum(effectifs.values())
+    fields = list(dict.fromkeys([*columns, *STRATE]))
+    sample = pd.DataFrame(list(queryset.filter(echantillon__isnull=False).order_by().values(*fields)), columns=fields)
+    if sample.empty:
+        return None, population
+    sample['prix'] = sample['prix'].astype(float)
+    strates = list(zip(sample['quartier'], sample['type_depense']))
+    sample['effectif'] = [effectifs.get(k, 0) for k in strates]
+    sample['poids'] = sample['effectif'] / sample.groupby(STRATE)['prix'].transform('size')
+    return sample, population
+
+
+def stratified_mean(sample):
+    """(moyenne estimée, demi-largeur de l'IC à 95 %) par l'estimateur stratifié."""
+    groups = sample.groupby(STRATE)
+    N = groups['effectif'].first()
+    n = groups.size()
+    total = N.sum()
+    if not total:
+        return 0.0, 0.0
+    moyenne = (N * groups['prix'].mean()).sum() / total
+    # Variance de l'estimateur stratifié, avec correction de population finie
+    s2 = groups['prix'].var(ddof=1).fillna(0.0)
+    variance = ((N / total) ** 2 * (1 - n / N).clip(lower=0) * s2 / n).sum()
+    return float(moyenne), float(Z_95 * np.sqrt(variance))
+
+
+def population_of(sample):
+    return int(sample.groupby(STRATE)['effectif'].first().sum())
+
+
+def weighted_resample(sample, seed=0):
+    """Tirage avec remise proportionnel aux poids : distribution représentative (médianes, box plots)."""
+    rng = np.random.default_rng(seed)
+    p = sample['poids'].to_numpy(dtype=float)
+    picks = rng.choice(len(sample), size=len(sample), p=p / p.sum())
+    return sample.iloc[picks].reset_index(drop=True)
@@ -0,0 +1,64 @@
+"""
+Signaux de `Depense`.
+
+Marquage des partitions modifiées pour la détection d'anomalies en arrière-plan.
+
+Chaque enregistrement ou suppression d'une `Depense` marque sa partition
+(date, type, quartier) dans `PartitionModifiee`, dans la même base que la
+dépense. Une modification qui change de partition marque aussi l'ancienne.
+Les annotations écrites par le détecteur passent par `bulk_update` et ne
+déclenchent donc pas de nouveau marquage.
+
+Chaque suppression laisse aussi une pierre tombale (`DepenseSupprimee`) pour
+le flux de changements (core/feed.py).
+"""
+from django.utils import timezone
+
+from .models import Depense, DepenseSupprimee, PartitionModifiee
+
+# Champs dont dépend la détection ; une sauvegarde limitée à d'autres champs ne marque rien
+DETECTION_FIELDS = {'date', 'type_depense', 'quartier', 'prix', 'lieu'}
+
+
+def mark_partitions(using, partitions):
+    """Marque (ou re-marque) des partitions (date, type_depense, quartier) comme modifiées."""
+    now = timezone.now()
+    objs = [PartitionModifiee(date=d, type_depense=t, quartier=q, date_marquage=now)
+            for d, t, q in set(partitions)]
+    if objs:
+        # Upsert : une partition déjà marquée voit seulement sa date de marquage avancer (debounce)
+        PartitionModifiee.objects.using(using).bulk_create(
+            objs, update_conflicts=True, unique_fields=['date', 'type_depense', 'quartier'],
+            update_fields=['date_marquage'])
+
+
+def _partition(depense):
+    return depense.date, depense.type_depense, depense.quartier
+
+
+def _touches_detection(update_fields):
+    return update_fields is None or bool(DETECTION_FIELDS & set(update_fields))
+
+
+def remember_old_partition(sender, instance, raw=False, using=None, update_fields=None, **kwargs):
+    instance._ecotrack_old_partition = None
+    if raw or instance.pk is None or not _touches_detection(update_fields):
+        return
+    old = (Depense.objects.using(using).filter(pk=instance.pk)
+           .values_list('date', 'type_depense', 'quartier').first())
+    instance._ecotrack_old_partition = old
+
+
+def mark_saved(sender, instance, raw=False, using=None, update_fields=None, **kwargs):
+    if raw or not _touches_detection(update_fields):
+        return
+    partitions = [_partition(instance)]
+    old = getattr(instance, '_ecotrack_old_partition', None)
+    if old:
+        partitions.append(old)
+    mark_partitions(using, partitions)
+
+
+def mark_deleted(sender, instance, using=None, **kwargs):
+    mark_partitions(using, [_partition(instance)])
+    DepenseSupprimee.objects.using(using).create(depense_id=instance.pk)
@@ -0,0 +1,211 @@
+"""
+Coalescence des calculs coûteux (single-flight).
+
+Quand plusieurs requêtes demandent la même page d'analyse au même moment
+(ex: lien du dashboard partagé à toute une classe), une seule exécute le
+calcul pendant que les autres attendent son résultat.
+
+- dans un même worker : un verrou `threading.Lock` par clé, retiré dès que
+  plus aucun thread ne l'attend ;
+- entre workers : un verrou fichier (`fcntl.flock`) dans ECOTRACK_LOCK_DIR,
+  parmi LOCK_BUCKETS fichiers fixes choisis par empreinte de la clé (deux
+  clés d'un même fichier s'attendent l'une l'autre entre workers, mais le
+  répertoire ne grossit pas avec les paramètres et les générations).
+
+Le résultat est stocké dans le cache Django, indexé par la « génération »
+des données (nombre de lignes + dernière modification). Pour partager les
+résultats entre workers, configurer un cache commun (DJANGO_CACHE_DIR).
+
+Un résultat périmé servi par stale-while-revalidate est signalé à
+`track_stale` (les GET conditionnels ne lui donnent alors pas l'ETag des
+données courantes).
+"""
+import contextvars
+import hashlib
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import Count, Max
+
+from .cities import current_city
+from .models import DetectionAnomalies, Depense
+
+try:
+    import fcntl
+except ImportError:  # Windows : verrouillage limité au processus courant
+    fcntl = None
+
+
+LOCK_BUCKETS = 256
+
+# clé -> [verrou, nombre de threads qui le détiennent ou l'attendent]
+_locks = {}
+_locks_guard = threading.Lock()
+
+_stale_marks = contextvars.ContextVar('ecotrack_stale_marks', default=None)
+
+
+def data_generation():
+    """
+    Identifiant de l'état courant des données : nombre de lignes, dernière
+    modification et dernière passe de détection d'anomalies.
+    """
+    agg = Depense.objects.aggregate(n=Count('id'), last=Max('date_modification'))
+    last = agg['last'].timestamp() if agg['last'] else 0
+    run = DetectionAnomalies.objects.aggregate(id=Max('id'))['id'] or 0
+    return f"{agg['n']}-{last:.6f}-{run}"
+
+
+def make_key(name, params=None):
+    """Clé stable à partir du nom de la vue, de la ville et des paramètres de requête."""
+    items = [f"ville={current_city() or ''}"]
+    if params:
+        for k in sorted(params.keys()):
+            values = params.getlist(k) if hasattr(params, 'getlist') else [params[k]]
+            items.append(f"{k}={','.join(str(v) for v in values)}")
+    digest = hashlib.sha1('&'.join(items).encode('utf-8')).hexdigest()[:16]
+    return f"{name}:{digest}"
+
+
+@contextmanager
+def _local_lock(key):
+    """Verrou de `key` dans ce processus, supprimé au départ du dernier utilisateur."""
+    with _locks_guard:
+        entry = _locks.get(key)
+        if entry is None:
+            entry = _locks[key] = [threading.Lock(), 0]
+        entry[1] += 1
+    try:
+        yield entry[0]
+    finally:
+        with _locks_guard:
+            entry[1] -= 1
+            if not entry[1]:
+                del _locks[key]
+
+
+def _lock_path(key):
+    lock_dir = getattr(settings, 'ECOTRACK_LOCK_DIR', None) or os.path.join(tempfile.gettempdir(), 'ecotrack-locks')
+    os.makedirs(lock_dir, exist_ok=True)
+    bucket = int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16) % LOCK_BUCKETS
+    return os.path.join(lock_dir, f"{bucket:02x}.lock")
+
+
+@contextmanager
+def flight_lock(key, blocking=True):
+    """Verrou exclusif (thread + processus) sur `key`. Produit False si non acquis."""
+    with _local_lock(key) as lock:
+        if not lock.acquire(blocking=blocking):
+            yield False
+            return
+        try:
+            with _file_lock(key, blocking) as acquired:
+                yield acquired
+        finally:
+            lock.release()
+
+
+@contextmanager
+def _file_lock(key, blocking):
+    fh = None
+    try:
+        if fcntl is not None:
+            fh = open(_lock_path(key), 'a')
+            flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            try:
+                fcntl.flock(fh, flags)
+            except BlockingIOError:
+                yield False
+                return
+        yield True
+    finally:
+        if fh is not None:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+            fh.close()
+
+
+@contextmanager
+def track_stale():
+    """Produit une liste, non vide à la sortie si un résultat périmé a été servi dans le bloc."""
+    marks = []
+    token = _stale_marks.set(marks)
+    try:
+        yield marks
+    finally:
+        _stale_marks.reset(token)
+
+
+def mark_stale():
+    """Signale au `track_stale` englobant qu'un résultat périmé a été servi."""
+    marks = _stale_marks.get()
+    if marks is not None:
+        marks.append(True)
+
+
+def _run_in_background(fn):
+    # Le thread hérite du contexte de la requête (ville, routage des lectures)
+    t = threading.Thread(target=contextvars.copy_context().run, args=(fn,), daemon=True)
+    t.start()
+    return t
+
+
+def _refresh(key, generation, compute, ttl):
+    with flight_lock(key, blocking=False) as acquired:
+        if not acquired:
+            # Un autre worker rafraîchit déjà ce résultat
+            return
+        if cache.get(f"sf:{key}:{generation}") is None:
+            value = compute()
+            cache.set(f"sf:{key}:{generation}", value, ttl)
+            cache.set(f"sf:{key}:latest", value, None)
+
+
+def coalesce(name, params, compute, ttl=None, stale_while_revalidate=None):
+    """
+    Retourne `compute()` en garantissant qu'un seul calcul tourne à la fois
+    pour une même clé (vue + paramètres) et une même génération de données.
+
+    Avec `stale_while_revalidate`, le résultat précédent est servi
+    immédiatement pendant qu'un thread recalcule la nouvelle version.
+    """
+    if ttl is None:
+        ttl = getattr(settings, 'ECOTRACK_SINGLEFLIGHT_TTL', 300)
+    if stale_while_revalidate is None:
+        stale_while_revalidate = getattr(settings, 'ECOTRACK_STALE_WHILE_REVALIDATE', False)
+
+    key = make_key(name, params)
+    generation = data_generation()
+    fresh_key = f"sf:{key}:{generation}"
+    latest_key = f"sf:{key}:latest"
+
+    value = cache.get(fresh_key)
+    if value is not None:
+        return value
+
+    if stale_while_revalidate:
+        stale = cache.get(latest_key)
+        if stale is not None:
+            def refresh():
+                try:
+                    _refresh(key, generation, compute, ttl)
+                finally:
+                    # Le thread a ouvert ses propres connexions
+                    connections.close_all()
+            _run_in_background(refresh)
+            mark_stale()
+            return stale
+
+    with flight_lock(key):
+        # Un autre worker a pu calculer le résultat pendant l'attente
+        value = cache.get(fresh_key)
+        if value is not None:
+            return value
+        value = compute()
+        cache.set(fresh_key, value, ttl)
+        cache.set(latest_key, value, None)
+    return value
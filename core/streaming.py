@@ -0,0 +1,342 @@
+"""
+Statistiques en flux à mémoire bornée.
+
+Le queryset est parcouru par morceaux (`QuerySet.iterator`) ; chaque
+morceau met à jour, par groupe (quartier, type) et au global :
+- effectif, moyenne et variance (Welford, combinaison par lots de Chan) ;
+- min et max ;
+- une esquisse de quantiles fusionnable (DDSketch) : erreur relative
+  bornée (ECOTRACK_SKETCH_ACCURACY, 1 % par défaut), taille proportionnelle
+  au logarithme de l'étendue des prix et non au nombre de lignes.
+
+La mémoire ne dépend donc que de la taille d'un morceau et du nombre de
+groupes. Les états se fusionnent (`merge`) : avec
+ECOTRACK_AGGREGATION_WORKERS > 1, la table est découpée en plages de dates
+d'effectifs voisins, chaque plage est lue et agrégée dans un processus
+séparé (`ProcessPoolExecutor`) et les états partiels sont fusionnés
+ensuite.
+"""
+import math
+import multiprocessing
+import os
+import threading
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db import connections
+from django.db.models import Avg, Count, FloatField
+from django.db.models.functions import Cast
+
+from .boxplots import WHIS, from_quantiles
+
+
+class QuantileSketch:
+    """
+    Esquisse de quantiles à erreur relative bornée (DDSketch) : les valeurs
+    sont rangées dans des seaux logarithmiques de raison gamma. Les valeurs
+    nulles ou négatives sont comptées à part (estimées à 0).
+    """
+    __slots__ = ('gamma', 'log_gamma', 'bins', 'zeros', 'count')
+
+    def __init__(self, accuracy=None):
+        if accuracy is None:
+            accuracy = getattr(settings, 'ECOTRACK_SKETCH_ACCURACY', 0.01)
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = Counter()
+        self.zeros = 0
+        self.count = 0
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        positive = values[values > 0]
+        self.zeros += len(values) - len(positive)
+        self.count += len(values)
+        if len(positive):
+            keys, counts = np.unique(np.ceil(np.log(positive) / self.log_gamma).astype(np.int64), return_counts=True)
+            self.bins.update(dict(zip(keys.tolist(), counts.tolist())))
+
+    def merge(self, other):
+        self.bins.update(other.bins)
+        self.zeros += other.zeros
+        self.count += other.count
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * (self.count - 1)
+        cumul = self.zeros
+        if rank < cumul:
+            return 0.0
+        for key in sorted(self.bins):
+            cumul += self.bins[key]
+            if cumul > rank:
+                # Milieu (relatif) du seau ]gamma^(k-1), gamma^k]
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+
+class RunningStats:
+    """Effectif, moyenne, variance, min, max et quantiles d'un groupe, fusionnables."""
+    __slots__ = ('n', 'mean', 'm2', 'min', 'max', 'sketch')
+
+    def __init__(self, accuracy=None):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.sketch = QuantileSketch(accuracy)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        if not len(values):
+            return
+        mean = float(values.mean())
+        self._combine(len(values), mean, float(((values - mean) ** 2).sum()), float(values.min()), float(values.max()))
+        self.sketch.add(values)
+
+    def merge(self, other):
+        if other.n:
+            self._combine(other.n, other.mean, other.m2, other.min, other.max)
+            self.sketch.merge(other.sketch)
+
+    def _combine(self, n_b, mean_b, m2_b, min_b, max_b):
+        # Combinaison de deux états (Chan et al.) ; un lot d'une valeur redonne Welford
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        self.mean += delta * n_b / n
+        self.m2 += m2_b + delta ** 2 * self.n * n_b / n
+        self.n = n
+        self.min = min(self.min, min_b)
+        self.max = max(self.max, max_b)
+
+    def variance(self):
+        return self.m2 / (self.n - 1) if self.n > 1 else 0.0
+
+    def summary(self):
+        """Clés des tableaux du dashboard (moyenne, médiane, min, max, nombre, écart-type)."""
+        return {
+            'moyenne': self.mean if self.n else 0.0,
+            'min': self.min if self.n else 0.0,
+            'max': self.max if self.n else 0.0,
+            'mediane': self.sketch.quantile(0.5),
+            'nombre': self.n,
+            'ecart_type': math.sqrt(self.variance()) if self.n > 1 else 0.0,
+        }
+
+    def box_stats(self, label):
+        """Statistiques de boîte pour `Axes.bxp` (moustaches à 1,5 IQR, bornées par min/max, sans points isolés)."""
+        q1, med, q3 = (self.sketch.quantile(q) for q in (0.25, 0.5, 0.75))
+        iqr = q3 - q1
+        return from_quantiles(label, self.mean, q1, med, q3, max(self.min, q1 - WHIS * iqr),
+                              min(self.max, q3 + WHIS * iqr), self.n)
+
+
+class DashboardStats:
+    """États par quartier, par type et global."""
+
+    def __init__(self, accuracy=None):
+        self.accuracy = accuracy
+        self.total = RunningStats(accuracy)
+        self.quartier = defaultdict(lambda: RunningStats(self.accuracy))
+        self.type = defaultdict(lambda: RunningStats(self.accuracy))
+
+    def update(self, rows):
+        """Un morceau de tuples (quartier, type_depense, prix)."""
+        self.update_codes(*encode_rows(rows))
+
+    def update_codes(self, prix, quartier, type_depense):
+        """Morceau déjà encodé : prix et, par dimension, (codes entiers, libellés)."""
+        self.total.update(prix)
+        for (codes, labels), groups in ((quartier, self.quartier), (type_depense, self.type)):
+            order = np.argsort(codes, kind='stable')
+            for part in np.split(order, np.flatnonzero(np.diff(codes[order])) + 1):
+                if len(part) and codes[part[0]] >= 0:
+                    groups[labels[codes[part[0]]]].update(prix[part])
+
+    def merge(self, other):
+        self.total.merge(other.total)
+        for mine, theirs in ((self.quartier, other.quartier), (self.type, other.type)):
+            for key, stats in theirs.items():
+                mine[key].merge(stats)
+
+    def __getstate__(self):
+        # defaultdict(lambda) n'est pas sérialisable (pool de processus)
+        return {'accuracy': self.accuracy, 'total': self.total,
+                'quartier': dict(self.quartier), 'type': dict(self.type)}
+
+    def __setstate__(self, state):
+        self.__init__(state['accuracy'])
+        self.total = state['total']
+        self.quartier.update(state['quartier'])
+        self.type.update(state['type'])
+
+
+def encode_rows(rows):
+    """Tuples (quartier, type_depense, prix) en tableaux compacts (codes entiers + libellés)."""
+    frame = pd.DataFrame(rows, columns=['quartier', 'type_depense', 'prix'])
+    codes_q, quartiers = pd.factorize(frame['quartier'])
+    codes_t, types = pd.factorize(frame['type_depense'])
+    return (frame['prix'].to_numpy(dtype=float),
+            (codes_q, list(quartiers)), (codes_t, list(types)))
+
+
+def _batched(rows, size):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _rows(queryset, chunk_size):
+    return (queryset.order_by().annotate(prix_float=Cast('prix', FloatField()))
+            .values_list('quartier', 'type_depense', 'prix_float').iterator(chunk_size=chunk_size))
+
+
+def stream_stats(queryset, chunk_size=None, accuracy=None):
+    """Parcourt `queryset` par morceaux et retourne un `DashboardStats`."""
+    if chunk_size is None:
+        chunk_size = getattr(settings, 'ECOTRACK_STREAM_CHUNK', 5000)
+    rows = _rows(queryset, chunk_size)
+    stats = DashboardStats(accuracy)
+    for batch in _batched(rows, chunk_size):
+        stats.update(batch)
+    return stats
+
+
+def daily_means(queryset):
+    """Prix moyen et effectif par jour, agrégés en SQL (une ligne par jour, pas par dépense)."""
+    rows = (queryset.order_by().values('date')
+            .annotate(prix=Avg(Cast('prix', FloatField())), n=Count('id')).order_by('date'))
+    frame = pd.DataFrame(list(rows), columns=['date', 'prix', 'n'])
+    frame['date'] = pd.to_datetime(frame['date'])
+    return frame
+
+
+# --- Agrégation parallèle par plages de dates ---
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _available_cpus():
+    # Cœurs attribués au processus (conteneur, taskset), pas ceux de l'hôte
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def aggregation_workers():
+    """Taille du pool : ECOTRACK_AGGREGATION_WORKERS (1 par défaut), bornée aux cœurs disponibles."""
+    return max(1, min(getattr(settings, 'ECOTRACK_AGGREGATION_WORKERS', 1), _available_cpus()))
+
+
+def _init_worker(databases):
+    """Démarrage d'un processus du pool : Django configuré, mêmes bases que le serveur."""
+    import django
+    settings.DATABASES = databases
+    django.setup()
+
+
+def _process_pool(workers):
+    """Pool de processus partagé, créé à la première utilisation."""
+    global _pool
+    # Réglages effectifs des connexions (noms de base résolus, y compris en test)
+    databases = {alias: dict(connections[alias].settings_dict) for alias in connections}
+    key = (workers, repr(sorted((a, str(d.get('NAME'))) for a, d in databases.items())))
+    with _pool_lock:
+        if _pool is None or _pool[0] != key:
+            if _pool is not None:
+                _pool[1].shutdown(wait=False)
+            # spawn : pas de fork d'un serveur multi-threadé (connexions, verrous)
+            _pool = (key, ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                              initializer=_init_worker, initargs=(databases,)))
+        return _pool[1]
+
+
+def aggregate_range(query, alias, debut, fin, accuracy, chunk_size):
+    """Exécuté dans un processus du pool : lit et agrège une plage de dates."""
+    from .models import Depense
+    queryset = Depense.objects.using(alias).all()
+    queryset.query = query
+    try:
+        return stream_stats(queryset.filter(date__gte=debut, date__lte=fin), chunk_size, accuracy)
+    finally:
+        connections.close_all()
+
+
+def aggregate_partition(accuracy, prix, quartier, type_depense):
+    """Exécuté dans un processus du pool : état partiel de lignes déjà lues (aucun accès base)."""
+    stats = DashboardStats(accuracy)
+    stats.update_codes(prix, quartier, type_depense)
+    return stats
+
+
+def _shared_database(alias):
+    """Base lisible depuis un autre processus (toute base sauf SQLite en mémoire)."""
+    connection = connections[alias]
+    return not (connection.vendor == 'sqlite' and connection.is_in_memory_db())
+
+
+def partition_bounds(daily, partitions):
+    """
+    Plages de dates [début, fin] d'effectifs voisins, à partir des effectifs
+    par jour (`daily_means`) : un jour n'est jamais coupé entre deux plages.
+    """
+    target = daily['n'].sum() / max(partitions, 1)
+    bounds, start, cumul = [], None, 0
+    for day, n in zip(daily['date'].dt.date, daily['n']):
+        start = start or day
+        cumul += n
+        if cumul >= target and len(bounds) < partitions - 1:
+            bounds.append((start, day))
+            start, cumul = None, 0
+    if start is not None:
+        bounds.append((start, daily['date'].iloc[-1].date()))
+    return bounds
+
+
+def parallel_stream_stats(queryset, workers=None, accuracy=None, daily=None):
+    """
+    `stream_stats` réparti sur `workers` processus, une plage de dates par
+    tâche (index sur la date). Chaque processus lit sa plage sur sa propre
+    connexion ; pour une base SQLite en mémoire (tests), le processus
+    courant lit les plages et les envoie encodées. Au plus deux plages par
+    processus sont en attente et chaque plage compte au plus
+    ECOTRACK_PARTITION_ROWS lignes : la mémoire reste bornée.
+    """
+    workers = workers or aggregation_workers()
+    if accuracy is None:
+        accuracy = getattr(settings, 'ECOTRACK_SKETCH_ACCURACY', 0.01)
+    if daily is None:
+        daily = daily_means(queryset)
+    stats = DashboardStats(accuracy)
+    if daily.empty:
+        return stats
+    max_rows = getattr(settings, 'ECOTRACK_PARTITION_ROWS', 100_000)
+    partitions = max(workers * 4, math.ceil(daily['n'].sum() / max_rows))
+    chunk_size = getattr(settings, 'ECOTRACK_STREAM_CHUNK', 5000)
+    alias = queryset.db
+    shared = _shared_database(alias)
+    pool = _process_pool(workers)
+    pending = deque()
+    for debut, fin in partition_bounds(daily, partitions):
+        if shared:
+            pending.append(pool.submit(aggregate_range, queryset.query, alias, debut, fin, accuracy, chunk_size))
+        else:
+            rows = list(_rows(queryset.filter(date__gte=debut, date__lte=fin), chunk_size))
+            pending.append(pool.submit(aggregate_partition, accuracy, *encode_rows(rows)))
+            del rows
+        if len(pending) >= 2 * workers:
+            stats.merge(pending.popleft().result())
+    # Fusion dans l'ordre des dates : résultat déterministe
+    while pending:
+        stats.merge(pending.popleft().result())
+    return stats
@@ -1,13 +1,40 @@
-from django.test import TestCase, Client
+import importlib.util
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from io import BytesIO, StringIO
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.test import TestCase, TransactionTestCase, Client, RequestFactory, override_settings
 from django.urls import reverse
 from django.utils import timezone
-from .models import Depense
-from .views import _normalize_input
+from .models import DetectionAnomalies, Depense, PartitionModifiee
+from .views import _normalize_input, _dashboard_context
+from . import singleflight, views, views_async
+from .anomalies import detect_anomalies, flag_doublons, process_dirty
+from .cities import CityMiddleware, current_city, finalize, merge_partials
+from .routers import AnalyticsReplicaRouter, CityRouter, analytics_reads
+from .write_queue import DepenseWriteQueue
 
 
 class DepenseFreeQuartierTests(TestCase):
     def setUp(self):
         self.client = Client()
+        cache.clear()
 
     def test_create_depense_with_free_quartier(self):
         data = {
@@ -45,7 +72,7 @@ class DepenseFreeQuartierTests(TestCase):
         resp = self.client.get(reverse('export_csv'), {'quartier': ' q1 '})
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(resp['Content-Type'], 'text/csv')
-        content = resp.content.decode('utf-8')
+        content = b''.join(resp.streaming_content).decode('utf-8')
         self.assertIn('date,type,quartier,lieu,prix,commentaire,anomalie', content)
         # Should contain Q1 rows but not Q2
         self.assertIn('Q1', content)
@@ -56,7 +83,7 @@ class DepenseFreeQuartierTests(TestCase):
         resp = self.client.get(reverse('export_anomalies_csv'))
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(resp['Content-Type'], 'text/csv')
-        content = resp.content.decode('utf-8')
+        content = b''.join(resp.streaming_content).decode('utf-8')
         self.assertIn('[AUTO] Test', content)
 
     def test_dashboard_median_calculation(self):
@@ -115,7 +142,7 @@ class DepenseFreeQuartierTests(TestCase):
         resp = self.client.get(reverse('export_comparaison_csv'), {'q1': ' qx ', 'q2': ' qy '})
         self.assertEqual(resp.status_code, 200)
         self.assertEqual(resp['Content-Type'], 'text/csv')
-        content = resp.content.decode('utf-8')
+        content = b''.join(resp.streaming_content).decode('utf-8')
         lines = [l for l in content.splitlines() if l.strip()]
         # header
         self.assertEqual(lines[0], 'groupe,date,type,quartier,lieu,prix,commentaire,anomalie')
@@ -135,7 +162,7 @@ class DepenseFreeQuartierTests(TestCase):
         Depense.objects.create(type_depense='alimentation', quartier='autre', prix=150, lieu='Le', date=timezone.now().date())
         resp = self.client.get(reverse('export_comparaison_csv'), {'mode': 'campus_env'})
         self.assertEqual(resp.status_code, 200)
-        content = resp.content.decode('utf-8')
+        content = b''.join(resp.streaming_content).decode('utf-8')
         lines = [l for l in content.splitlines() if l.strip()]
         self.assertEqual(lines[0], 'groupe,date,type,quartier,lieu,prix,commentaire,anomalie')
         rows = lines[1:]
@@ -146,7 +173,7 @@ class DepenseFreeQuartierTests(TestCase):
         # Also accept explicit campus parameter with variant spacing/casing
         resp2 = self.client.get(reverse('export_comparaison_csv'), {'mode': 'campus_env', 'campus': ' campus '})
         self.assertEqual(resp2.status_code, 200)
-        content2 = resp2.content.decode('utf-8')
+        content2 = b''.join(resp2.streaming_content).decode('utf-8')
         lines2 = [l for l in content2.splitlines() if l.strip()]
         rows2 = lines2[1:]
         self.assertEqual(sum(1 for r in rows2 if r.startswith('campus,')), 2)
@@ -158,10 +185,1459 @@ class DepenseFreeQuartierTests(TestCase):
         Depense.objects.create(type_depense='alimentation', quartier='X', prix=200, lieu='L3', date=timezone.now().date())
         resp = self.client.get(reverse('export_comparaison_csv'), {'mode': 'quartier_ville', 'quartier': ' qv '})
         self.assertEqual(resp.status_code, 200)
-        content = resp.content.decode('utf-8')
+        content = b''.join(resp.streaming_content).decode('utf-8')
         lines = [l for l in content.splitlines() if l.strip()]
         self.assertEqual(lines[0], 'groupe,date,type,quartier,lieu,prix,commentaire,anomalie')
         rows = lines[1:]
         # Should contain 'quartier' rows and 'ville' rows
         self.assertTrue(any(r.startswith('quartier,') for r in rows))
         self.assertTrue(any(r.startswith('ville,') for r in rows))
+
+
+class SingleFlightTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_concurrent_calls_compute_once(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return {'valeur': 42}
+
+        results = []
+        with mock.patch.object(singleflight, 'data_generation', return_value='g1'):
+            threads = [
+                threading.Thread(target=lambda: results.append(singleflight.coalesce('vue', {'a': '1'}, compute)))
+                for _ in range(8)
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'valeur': 42}] * 8)
+
+    def test_stale_while_revalidate_serves_previous_result(self):
+        refreshes = []
+        with mock.patch.object(singleflight, 'data_generation', return_value='g1'):
+            singleflight.coalesce('vue', {}, lambda: 'ancien')
+        with mock.patch.object(singleflight, 'data_generation', return_value='g2'), \
+                mock.patch.object(singleflight, '_run_in_background', side_effect=refreshes.append):
+            value = singleflight.coalesce('vue', {}, lambda: 'nouveau', stale_while_revalidate=True)
+            self.assertEqual(value, 'ancien')
+            self.assertEqual(len(refreshes), 1)
+            refreshes[0]()
+            self.assertEqual(singleflight.coalesce('vue', {}, lambda: 'autre'), 'nouveau')
+
+    def test_locks_do_not_accumulate_per_key(self):
+        with tempfile.TemporaryDirectory() as lock_dir, self.settings(ECOTRACK_LOCK_DIR=lock_dir):
+            for i in range(600):
+                with mock.patch.object(singleflight, 'data_generation', return_value=f'g{i}'):
+                    singleflight.coalesce('vue', {'page': str(i)}, lambda: i)
+            self.assertEqual(singleflight._locks, {})
+            self.assertLessEqual(len(os.listdir(lock_dir)), singleflight.LOCK_BUCKETS)
+
+    def test_dashboard_reuses_result_until_data_changes(self):
+        Depense.objects.create(type_depense='alimentation', quartier='SF', prix=100, lieu='L', date=timezone.now().date())
+        with mock.patch('core.views._dashboard_resultats', wraps=views._dashboard_resultats) as compute:
+            self.client.get(reverse('dashboard'))
+            self.client.get(reverse('dashboard'))
+            self.assertEqual(compute.call_count, 1)
+            Depense.objects.create(type_depense='alimentation', quartier='SF', prix=200, lieu='L', date=timezone.now().date())
+            resp = self.client.get(reverse('dashboard'))
+            self.assertEqual(compute.call_count, 2)
+        self.assertEqual(resp.context['stats_globales']['total_depenses'], 2)
+
+
+class AsyncViewsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        Depense.objects.create(type_depense='alimentation', quartier='A1', prix=100, lieu='L', date=timezone.now().date())
+        Depense.objects.create(type_depense='transport', quartier='A1', prix=300, lieu='L', date=timezone.now().date())
+        Depense.objects.create(type_depense='transport', quartier='A2', prix=500, lieu='L', date=timezone.now().date())
+
+    def test_accueil_async(self):
+        resp = async_to_sync(views_async.accueil)(self.factory.get('/'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertContains(resp, '3')
+
+    def test_dashboard_async_matches_sync_stats(self):
+        resp = async_to_sync(views_async.dashboard)(self.factory.get('/dashboard/'))
+        self.assertEqual(resp.status_code, 200)
+        cache.clear()
+        sync_context = _dashboard_context()
+        cache.clear()
+        async_context = async_to_sync(views_async._dashboard_context)()
+        self.assertEqual(async_context['stats_quartier'], sync_context['stats_quartier'])
+        self.assertEqual(set(async_context['graphs']), set(sync_context['graphs']))
+
+    def test_comparaison_async(self):
+        request = self.factory.get('/comparaison/', {'q1': 'a1', 'q2': 'a2'})
+        resp = async_to_sync(views_async.comparaison)(request)
+        self.assertEqual(resp.status_code, 200)
+        context = async_to_sync(views_async._comparaison_context)(request.GET)
+        self.assertEqual(context['mode'], 'quartier_vs_quartier')
+        self.assertAlmostEqual(context['stats_q1']['mediane'], 200.0)
+
+
+    def test_concurrent_async_dashboards_do_not_starve_the_executor(self):
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        contexte = _dashboard_context()
+        calls = []
+
+        async def slow_context(filtres=None):
+            calls.append(1)
+            # Requête lente, puis une autre après l'arrivée des requêtes en attente
+            await views_async._db(time.sleep, 0.5)
+            await views_async._db(time.sleep, 0.01)
+            return contexte
+
+        async def run_all():
+            # Exécuteur par défaut plus petit que le nombre de requêtes simultanées
+            asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=4))
+            requests = [self.factory.get('/dashboard/') for _ in range(8)]
+            return await asyncio.wait_for(asyncio.gather(*(views_async.dashboard(r) for r in requests)), 10)
+
+        with mock.patch.object(views_async, '_dashboard_context', slow_context), \
+                mock.patch.object(views_async, 'parallel_queries_enabled', return_value=True), \
+                mock.patch.object(singleflight, 'data_generation', return_value='g1'):
+            responses = async_to_sync(run_all)()
+        self.assertEqual([r.status_code for r in responses], [200] * 8)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(views_async._inflight, {})
+
+
+class WriteQueueTests(TestCase):
+    def test_concurrent_submissions_are_grouped_into_transactions(self):
+        wq = DepenseWriteQueue(batch_size=25)
+        futures = []
+
+        def submit(t):
+            for i in range(10):
+                futures.append(wq.submit(Depense(
+                    type_depense='alimentation', quartier=f' wq-{t} ', prix=100 + i, lieu='L',
+                    date=timezone.now().date()), autostart=False))
+
+        threads = [threading.Thread(target=submit, args=(t,)) for t in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        wq.flush()
+
+        self.assertEqual(Depense.objects.filter(quartier__startswith='Wq ').count(), 80)
+        self.assertEqual(wq.batches_committed, 4)
+        self.assertTrue(all(f.result().pk for f in futures))
+
+    def test_failed_item_reports_error_only_to_its_submitter(self):
+        wq = DepenseWriteQueue(batch_size=10)
+        ok = wq.submit(Depense(type_depense='alimentation', quartier='Q', prix=10, lieu='L'), autostart=False)
+        bad = wq.submit(Depense(type_depense='alimentation', quartier='Q', prix=None, lieu='L'), autostart=False)
+        ok2 = wq.submit(Depense(type_depense='alimentation', quartier='Q', prix=20, lieu='M'), autostart=False)
+        wq.flush()
+        self.assertIsNone(ok.exception())
+        self.assertIsNotNone(bad.exception())
+        self.assertIsNone(ok2.exception())
+        self.assertEqual(wq.batches_committed, 1)
+        self.assertEqual(sorted(Depense.objects.filter(quartier='Q').values_list('prix', flat=True)), [10, 20])
+
+
+class AnalyticsReplicaRouterTests(TestCase):
+    def setUp(self):
+        self.router = AnalyticsReplicaRouter()
+        self.tmpdir = tempfile.mkdtemp()
+        self.replica_path = os.path.join(self.tmpdir, 'replica.sqlite3')
+        self.replica_config = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': self.replica_path}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_reads_stay_on_primary_without_replica(self):
+        with analytics_reads():
+            self.assertIsNone(self.router.db_for_read(Depense))
+
+    def test_analytics_reads_go_to_fresh_replica(self):
+        open(self.replica_path, 'w').close()
+        with mock.patch.dict(settings.DATABASES, {'replica': self.replica_config}):
+            self.assertIsNone(self.router.db_for_read(Depense))
+            with analytics_reads():
+                self.assertEqual(self.router.db_for_read(Depense), 'replica')
+                # Sessions/auth are never routed to the replica
+                self.assertIsNone(self.router.db_for_read(User))
+            self.assertEqual(self.router.db_for_write(Depense), 'default')
+
+    @override_settings(ECOTRACK_REPLICA_MAX_STALENESS=60)
+    def test_stale_replica_falls_back_to_primary(self):
+        open(self.replica_path, 'w').close()
+        old = time.time() - 120
+        os.utime(self.replica_path, (old, old))
+        with mock.patch.dict(settings.DATABASES, {'replica': self.replica_config}):
+            with analytics_reads():
+                self.assertIsNone(self.router.db_for_read(Depense))
+
+
+class RefreshReplicaCommandTests(TransactionTestCase):
+    # The online backup needs committed data on the primary connection
+    def test_refresh_replica_copies_primary(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir, ignore_errors=True)
+        self.replica_path = os.path.join(tmpdir, 'replica.sqlite3')
+        self.replica_config = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': self.replica_path}
+        Depense.objects.create(type_depense='alimentation', quartier='R', prix=10, lieu='L', date=timezone.now().date())
+        with mock.patch.dict(settings.DATABASES, {'replica': self.replica_config}):
+            call_command('refresh_replica', stdout=StringIO())
+        with sqlite3.connect(self.replica_path) as conn:
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM core_depense').fetchone()[0], 1)
+
+        # Ancienne réplique en WAL encore ouverte par un lecteur : ses -wal/-shm ne survivent pas
+        lecteur = sqlite3.connect(self.replica_path)
+        self.addCleanup(lecteur.close)
+        lecteur.execute('PRAGMA journal_mode=WAL')
+        lecteur.execute("UPDATE core_depense SET lieu = 'ancien'")
+        lecteur.commit()
+        self.assertTrue(os.path.exists(self.replica_path + '-wal'))
+        Depense.objects.create(type_depense='alimentation', quartier='R', prix=20, lieu='L', date=timezone.now().date())
+        with mock.patch.dict(settings.DATABASES, {'replica': self.replica_config}):
+            call_command('refresh_replica', stdout=StringIO())
+        self.assertFalse(os.path.exists(self.replica_path + '-wal'))
+        self.assertFalse(os.path.exists(self.replica_path + '-shm'))
+        with sqlite3.connect(self.replica_path) as conn:
+            self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM core_depense WHERE lieu = 'L'").fetchone()[0], 2)
+
+
+@override_settings(ECOTRACK_CITIES={'douala': 'default', 'yaounde': 'default'})
+class CityShardingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_city_prefix_is_stripped_and_kept_by_reverse(self):
+        seen = {}
+
+        def get_response(request):
+            seen['path_info'] = request.path_info
+            seen['city'] = current_city()
+            seen['url'] = reverse('dashboard')
+            seen['alias'] = CityRouter().db_for_write(Depense)
+            return HttpResponse()
+
+        request = RequestFactory().get('/ville/douala/dashboard/')
+        CityMiddleware(get_response)(request)
+        self.assertEqual(seen['path_info'], '/dashboard/')
+        self.assertEqual(seen['city'], 'douala')
+        self.assertEqual(seen['url'], '/ville/douala/dashboard/')
+        self.assertEqual(seen['alias'], 'default')
+        # Context is reset after the request
+        self.assertIsNone(current_city())
+        self.assertEqual(reverse('dashboard'), '/dashboard/')
+
+    def test_city_from_subdomain(self):
+        request = RequestFactory().get('/dashboard/', HTTP_HOST='yaounde.testserver')
+        with override_settings(ALLOWED_HOSTS=['.testserver']):
+            CityMiddleware(lambda r: HttpResponse())(request)
+        self.assertEqual(request.city, 'yaounde')
+
+    def test_unknown_city_is_404(self):
+        resp = self.client.get('/ville/atlantis/dashboard/')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_city_scoped_pages_render(self):
+        Depense.objects.create(type_depense='alimentation', quartier='C1', prix=100, lieu='L', date=timezone.now().date())
+        resp = self.client.get('/ville/douala/depenses/')
+        self.assertEqual(resp.status_code, 200)
+        self.assertContains(resp, 'href="/ville/douala/dashboard/"')
+        resp = self.client.get('/ville/douala/export/csv/')
+        self.assertIn('depenses_douala_', resp['Content-Disposition'])
+
+    def test_comparaison_villes_merges_partials(self):
+        Depense.objects.create(type_depense='alimentation', quartier='C1', prix=100, lieu='L', date=timezone.now().date())
+        Depense.objects.create(type_depense='alimentation', quartier='C1', prix=300, lieu='L', date=timezone.now().date())
+        resp = self.client.get(reverse('comparaison_villes'))
+        self.assertEqual(resp.status_code, 200)
+        villes = {s['ville']: s for s in resp.context['stats_villes']}
+        self.assertEqual(set(villes), {'douala', 'yaounde'})
+        self.assertAlmostEqual(villes['douala']['moyenne'], 200.0)
+        self.assertAlmostEqual(villes['douala']['ecart_type'], 141.42, places=2)
+
+    def test_merge_partials_matches_single_pass(self):
+        a = {'n': 2, 'somme': 300.0, 'somme_carres': 100.0 ** 2 + 200.0 ** 2, 'min': 100.0, 'max': 200.0}
+        b = {'n': 1, 'somme': 600.0, 'somme_carres': 600.0 ** 2, 'min': 600.0, 'max': 600.0}
+        stats = finalize(merge_partials([a, b]))
+        self.assertEqual(stats['nombre'], 3)
+        self.assertAlmostEqual(stats['moyenne'], 300.0)
+        self.assertAlmostEqual(stats['ecart_type'], 264.575, places=3)
+        self.assertEqual((stats['min'], stats['max']), (100.0, 600.0))
+
+
+class DepenseFactoryMixin:
+    """Création de dépenses de test : lieu dérivé du prix, date du jour par défaut."""
+    type_par_defaut = 'alimentation'
+
+    def _create(self, prix, type_depense=None, quartier='Q', lieu=None, date=None, **kwargs):
+        return Depense.objects.create(type_depense=type_depense or self.type_par_defaut, quartier=quartier,
+                                      prix=prix, lieu=lieu or f'L{prix}', date=date or timezone.now().date(),
+                                      **kwargs)
+
+
+class AnomalyDetectionTests(DepenseFactoryMixin, TestCase):
+    def test_doublons_match_pairwise_definition(self):
+        rng = np.random.default_rng(0)
+        df = pd.DataFrame({
+            'date': rng.choice(pd.date_range('2025-01-01', periods=3).date, 200),
+            'lieu': rng.choice(['Marché', ' marché ', 'Gare', 'Campus'], 200),
+            'prix': rng.choice([100.0, 101.0, 103.0, 150.0, 151.5, 400.0], 200) * rng.uniform(0.99, 1.01, 200),
+        })
+        expected = pd.Series(False, index=df.index)
+        for i in df.index:
+            for j in df.index:
+                if i < j and df.at[i, 'date'] == df.at[j, 'date'] \
+                        and df.at[i, 'lieu'].strip().lower() == df.at[j, 'lieu'].strip().lower() \
+                        and abs(df.at[i, 'prix'] - df.at[j, 'prix']) / max(df.at[i, 'prix'], df.at[j, 'prix']) < 0.02:
+                    expected[i] = expected[j] = True
+        pd.testing.assert_series_equal(flag_doublons(df), expected, check_names=False)
+
+    def test_type_flag_takes_priority_and_manual_is_kept(self):
+        for i in range(30):
+            self._create(100 + i, quartier=f'Q{i % 3}')
+        haut = self._create(5000)
+        manuel = self._create(100, anomalie='Ticket illisible')
+        detect_anomalies()
+        haut.refresh_from_db()
+        manuel.refresh_from_db()
+        self.assertTrue(haut.anomalie.startswith('[AUTO] Valeur aberrante élevée'))
+        self.assertEqual(manuel.anomalie, 'Ticket illisible')
+
+    def test_type_quartier_grouping(self):
+        # Cheap in Q1 but normal for the type overall: only the (type x quartier) group catches it
+        for i in range(12):
+            self._create(1000 + i * 10, quartier='Q1')
+            self._create(3000 + i * 10, quartier='Q2')
+        cible = self._create(2500, quartier='Q1')
+        detect_anomalies()
+        cible.refresh_from_db()
+        self.assertIn('par type et quartier', cible.anomalie)
+
+    def test_robust_methods_resist_masking(self):
+        # Two huge values inflate the std so much that 3-sigma misses them
+        for i in range(10):
+            self._create(100 + i)
+        self._create(100000)
+        self._create(100000, lieu='Autre lieu')
+        detect_anomalies(method='std')
+        self.assertFalse(Depense.objects.filter(prix=100000, anomalie__contains='aberrante').exists())
+        detect_anomalies(method='mad')
+        self.assertEqual(Depense.objects.filter(prix=100000, anomalie__contains='aberrante').count(), 2)
+        detect_anomalies(method='iqr')
+        self.assertEqual(Depense.objects.filter(prix=100000, anomalie__contains='aberrante').count(), 2)
+
+    def test_stale_auto_labels_are_cleared(self):
+        dep = self._create(100, anomalie='[AUTO] Ancienne annotation')
+        detect_anomalies()
+        dep.refresh_from_db()
+        self.assertEqual(dep.anomalie, '')
+
+
+class AnomalyWorkerTests(DepenseFactoryMixin, TestCase):
+    def test_saves_and_deletes_mark_partitions(self):
+        dep = self._create(100)
+        self.assertEqual(PartitionModifiee.objects.count(), 1)
+        dep.quartier = 'Autre'
+        dep.save()
+        self.assertEqual(set(PartitionModifiee.objects.values_list('quartier', flat=True)), {'Q', 'Autre'})
+        PartitionModifiee.objects.all().delete()
+        dep.delete()
+        self.assertEqual(PartitionModifiee.objects.count(), 1)
+
+    def test_dashboard_does_not_run_detection(self):
+        self._create(100)
+        with mock.patch('core.anomalies.compute_labels') as compute:
+            self.client.get(reverse('dashboard'))
+        compute.assert_not_called()
+
+    def test_debounce_waits_for_quiet_period(self):
+        self._create(100)
+        with self.settings(ECOTRACK_ANOMALY_DEBOUNCE=60, ECOTRACK_ANOMALY_MAX_DELAY=600):
+            self.assertIsNone(process_dirty())
+            PartitionModifiee.objects.update(date_marquage=timezone.now() - timezone.timedelta(seconds=120))
+            run = process_dirty()
+        self.assertIsNotNone(run)
+        self.assertFalse(PartitionModifiee.objects.exists())
+        self.assertIsNone(process_dirty(force=True))
+
+    def test_scoped_run_only_touches_changed_partitions(self):
+        ancienne = timezone.now().date() - timezone.timedelta(days=30)
+        autre = self._create(100, quartier='Loin', type_depense='transport', date=ancienne)
+        Depense.objects.filter(pk=autre.pk).update(anomalie='[AUTO] Ancienne annotation')
+        PartitionModifiee.objects.all().delete()
+        for i in range(30):
+            self._create(100 + i)
+        haut = self._create(5000)
+        run = process_dirty(force=True)
+        haut.refresh_from_db()
+        autre.refresh_from_db()
+        self.assertTrue(haut.anomalie.startswith('[AUTO] Valeur aberrante'))
+        # Partition non marquée (autre date, type et quartier) : pas réannotée
+        self.assertEqual(autre.anomalie, '[AUTO] Ancienne annotation')
+        self.assertEqual(run.lignes_analysees, 31)
+        self.assertGreaterEqual(run.lignes_signalees, 1)
+        self.assertEqual(DetectionAnomalies.objects.count(), 1)
+
+    def test_command_once_records_run(self):
+        for i in range(5):
+            self._create(100 + i)
+        out = StringIO()
+        call_command('anomaly_worker', '--once', stdout=out)
+        self.assertIn('5 lignes analysées', out.getvalue())
+        run = DetectionAnomalies.objects.get()
+        self.assertEqual(run.partitions, 1)
+        self.assertGreaterEqual(run.duree, 0)
+
+
+class AnomalyKindTests(DepenseFactoryMixin, TestCase):
+    def test_detector_writes_kind(self):
+        for i in range(30):
+            self._create(100 + i)
+        haut = self._create(5000)
+        a, b = self._create(700, lieu='Marché'), self._create(701, lieu='marché')
+        detect_anomalies()
+        self.assertEqual(Depense.objects.get(pk=haut.pk).anomalie_kind, Depense.KIND_ABERRANT_HAUT)
+        self.assertEqual(set(Depense.objects.filter(pk__in=[a.pk, b.pk]).values_list('anomalie_kind', flat=True)),
+                         {Depense.KIND_DOUBLON})
+
+    def test_manual_annotation_kind(self):
+        dep = self._create(100, anomalie='Ticket illisible')
+        self.assertEqual(dep.anomalie_kind, Depense.KIND_MANUELLE)
+        dep.anomalie = ''
+        dep.save()
+        self.assertEqual(dep.anomalie_kind, '')
+
+    def test_backfill_migration_classifies_existing_text(self):
+        import importlib
+        from django.apps import apps
+        from django.db import connection
+        backfill = importlib.import_module('core.migrations.0006_depense_anomalie_kind').backfill_kind
+        textes = {
+            '[AUTO] Doublon détecté (même date, lieu et prix similaire)': Depense.KIND_DOUBLON,
+            '[AUTO] Valeur aberrante élevée (prix: 9000 FCFA)': Depense.KIND_ABERRANT_HAUT,
+            '[AUTO] Valeur aberrante basse (prix: 1 FCFA)': Depense.KIND_ABERRANT_BAS,
+            '[AUTO] Valeur aberrante par quartier (prix: 9000 FCFA)': Depense.KIND_ABERRANT_QUARTIER,
+            'Prix saisi en euros': Depense.KIND_MANUELLE,
+            '': '',
+        }
+        ids = {}
+        for i, texte in enumerate(textes):
+            ids[texte] = self._create(100 + i).pk
+            Depense.objects.filter(pk=ids[texte]).update(anomalie=texte, anomalie_kind='')
+        backfill(apps, mock.Mock(connection=connection))
+        for texte, kind in textes.items():
+            self.assertEqual(Depense.objects.get(pk=ids[texte]).anomalie_kind, kind, texte)
+
+    def test_anomalies_view_groups_in_sql(self):
+        self._create(100, anomalie='Ticket illisible')
+        self._create(200, anomalie='[AUTO] Doublon détecté (même date, lieu et prix similaire)')
+        self._create(300, anomalie='[AUTO] Doublon détecté (même date, lieu et prix similaire)')
+        self._create(400)
+        resp = self.client.get(reverse('anomalies'))
+        self.assertEqual(resp.context['total_anomalies'], 3)
+        self.assertEqual(resp.context['auto_anomalies'], 2)
+        self.assertEqual(resp.context['manuelles_anomalies'], 1)
+        self.assertEqual(resp.context['anomalies_par_type'], {'Doublon': 2, 'Manuelle': 1})
+
+
+    def test_dashboard_counts_anomalies_like_the_anomalies_page(self):
+        self._create(100, anomalie='Ticket illisible')
+        note = self._create(200)
+        efface = self._create(300, anomalie='Ticket illisible')
+        # Note sans type (texte seul) et type effacé à la main : hors des deux comptes
+        Depense.objects.filter(pk=note.pk).update(anomalie='Note libre', anomalie_kind='')
+        Depense.objects.filter(pk=efface.pk).update(anomalie_kind='')
+        self.assertEqual(self.client.get(reverse('anomalies')).context['total_anomalies'], 1)
+        self.assertEqual(self.client.get(reverse('dashboard')).context['stats_globales']['anomalies'], 1)
+
+
+class DuplicateGuardTests(TestCase):
+    def setUp(self):
+        self.depense = Depense.objects.create(type_depense='alimentation', quartier='Q', prix=1000,
+                                              lieu='Marché  Central', date=timezone.now().date())
+
+    def _post(self, url, prix=1010, **extra):
+        data = {'type_depense': 'alimentation', 'quartier': 'Q', 'prix': prix, 'lieu': 'marché central ',
+                'date': timezone.now().date().isoformat(), 'commentaire': ''}
+        data.update(extra)
+        return self.client.post(url, data)
+
+    def test_fingerprint_lookup_finds_neighbouring_buckets(self):
+        self.assertTrue(self.depense.empreinte)
+        for prix in (981, 1000, 1019):
+            self.assertEqual(Depense.probable_duplicates(self.depense.date, ' MARCHÉ central', prix), [self.depense])
+        self.assertEqual(Depense.probable_duplicates(self.depense.date, 'Marché Central', 1030), [])
+        self.assertEqual(Depense.probable_duplicates(self.depense.date, 'Marché Central', 1000,
+                                                     exclude_pk=self.depense.pk), [])
+
+    def test_fingerprint_lookup_finds_duplicates_two_buckets_apart(self):
+        from decimal import Decimal
+        from .models import prix_bucket
+        # 1,9985 % d'écart (doublon au sens des 2 %) mais deux tranches d'écart
+        self.assertEqual(prix_bucket(Decimal('53.54')) - prix_bucket(Decimal('52.47')), 2)
+        proche = Depense.objects.create(type_depense='alimentation', quartier='Q', prix=Decimal('52.47'),
+                                        lieu='Kiosque', date=self.depense.date)
+        self.assertEqual(Depense.probable_duplicates(self.depense.date, 'Kiosque', Decimal('53.54')), [proche])
+
+    def test_saisie_warns_then_accepts_confirmation(self):
+        resp = self._post(reverse('saisie'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertContains(resp, 'Une dépense similaire existe déjà')
+        self.assertEqual(Depense.objects.count(), 1)
+        resp = self._post(reverse('saisie'), confirmer_doublon='on')
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(Depense.objects.count(), 2)
+
+    @override_settings(ECOTRACK_DUPLICATE_POLICY='reject')
+    def test_reject_policy_ignores_confirmation(self):
+        self._post(reverse('saisie'), confirmer_doublon='on')
+        self.assertEqual(Depense.objects.count(), 1)
+
+    @override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_admin_add_is_guarded(self):
+        admin = User.objects.create_superuser('admin', 'a@example.com', 'pass')
+        self.client.force_login(admin)
+        resp = self._post(reverse('admin:core_depense_add'), anomalie='')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(Depense.objects.count(), 1)
+        # Modifier la dépense existante ne la compare pas à elle-même
+        resp = self._post(reverse('admin:core_depense_change', args=[self.depense.pk]), prix=1000, anomalie='')
+        self.assertEqual(resp.status_code, 302)
+
+
+@override_settings(ECOTRACK_PHOTO_ASYNC=False)
+class PhotoPipelineTests(TestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp(prefix='ecotrack-media-')
+        self.addCleanup(shutil.rmtree, self.media, ignore_errors=True)
+        override = override_settings(MEDIA_ROOT=self.media)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def _jpeg(self, size=(2400, 1200)):
+        from PIL import Image
+        img = Image.new('RGB', size, (200, 120, 40))
+        exif = Image.Exif()
+        exif[0x010F] = 'PhoneMaker'  # Make
+        exif[0x0112] = 6             # Orientation : rotation de 90°
+        buf = BytesIO()
+        img.save(buf, 'JPEG', exif=exif)
+        return SimpleUploadedFile('ticket.jpg', buf.getvalue(), content_type='image/jpeg')
+
+    def test_saisie_produces_thumbnail_without_exif(self):
+        from PIL import Image
+        with self.captureOnCommitCallbacks(execute=True):
+            resp = self.client.post(reverse('saisie'), {
+                'type_depense': 'alimentation', 'quartier': 'Q', 'prix': 500, 'lieu': 'Marché',
+                'date': timezone.now().date().isoformat(), 'commentaire': '', 'photo': self._jpeg()})
+        self.assertEqual(resp.status_code, 302)
+        dep = Depense.objects.get()
+        self.assertEqual(dep.photo_statut, Depense.PHOTO_PRETE)
+        # Orientation EXIF appliquée avant redimensionnement : portrait 800x1600
+        self.assertEqual((dep.photo_largeur, dep.photo_hauteur), (800, 1600))
+        self.assertFalse(os.path.exists(os.path.join(self.media, 'photos', 'ticket.jpg')))
+        for field in (dep.photo, dep.photo_miniature):
+            with Image.open(field.path) as img:
+                self.assertFalse(img.getexif())
+        with Image.open(dep.photo_miniature.path) as img:
+            self.assertLessEqual(max(img.size), 320)
+        resp = self.client.get(reverse('liste_depenses'))
+        self.assertContains(resp, dep.photo_miniature.url)
+
+    def _pending(self):
+        dep = Depense(type_depense='alimentation', quartier='Q', prix=500, lieu='L', date=timezone.now().date())
+        dep.photo.save('ticket.jpg', self._jpeg(), save=False)
+        dep.photo_statut = Depense.PHOTO_EN_ATTENTE
+        Depense.objects.bulk_create([dep])
+        return Depense.objects.get()
+
+    def test_concurrent_run_on_same_row_is_a_no_op(self):
+        from . import photos
+        dep = self._pending()
+        encode = photos._encode
+        concurrentes = []
+
+        def pendant_le_traitement(*args):
+            # Seconde passe (pool et process_photos, ligne réenregistrée) pendant la première
+            concurrentes.append(photos.process_photo(dep.pk))
+            return encode(*args)
+
+        with mock.patch.object(photos, '_encode', side_effect=pendant_le_traitement):
+            self.assertEqual(photos.process_photo(dep.pk), Depense.PHOTO_PRETE)
+        self.assertEqual(concurrentes, [None, None])
+        # Passe lancée après coup avec l'ancien original : ne réécrit rien
+        self.assertIsNone(photos.process_photo(dep.pk))
+        fini = Depense.objects.get()
+        self.assertEqual(fini.photo_statut, Depense.PHOTO_PRETE)
+        self.assertEqual(len(os.listdir(os.path.join(self.media, 'photos', 'web'))), 1)
+        self.assertFalse(os.path.exists(dep.photo.path))
+
+    def test_claimed_row_is_skipped_and_replaced_photo_keeps_original(self):
+        from . import photos
+        dep = self._pending()
+        Depense.objects.filter(pk=dep.pk).update(photo_statut=Depense.PHOTO_EN_COURS)
+        self.assertIsNone(photos.process_photo(dep.pk))
+        self.assertTrue(os.path.exists(dep.photo.path))
+        Depense.objects.filter(pk=dep.pk).update(photo_statut=Depense.PHOTO_EN_ATTENTE)
+
+        encode = photos._encode
+
+        def remplacee_pendant_le_traitement(*args):
+            Depense.objects.filter(pk=dep.pk).update(photo='photos/autre.jpg', photo_statut=Depense.PHOTO_EN_ATTENTE)
+            return encode(*args)
+
+        with mock.patch.object(photos, '_encode', side_effect=remplacee_pendant_le_traitement):
+            self.assertIsNone(photos.process_photo(dep.pk))
+        self.assertTrue(os.path.exists(dep.photo.path))  # original non supprimé
+        self.assertEqual(os.listdir(os.path.join(self.media, 'photos', 'web')), [])  # copies orphelines retirées
+        self.assertEqual(Depense.objects.get().photo_statut, Depense.PHOTO_EN_ATTENTE)
+
+    def test_list_revalidates_when_photo_becomes_ready(self):
+        from .photos import process_photo
+        dep = self._pending()
+        resp = self.client.get(reverse('liste_depenses'))
+        self.assertContains(resp, 'En cours de traitement')
+        self.assertEqual(self.client.get(reverse('liste_depenses'), HTTP_IF_NONE_MATCH=resp['ETag']).status_code, 304)
+        process_photo(dep.pk)
+        # Le traitement ne touche pas date_modification : l'ETag change quand même
+        again = self.client.get(reverse('liste_depenses'), HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(again.status_code, 200)
+        self.assertNotEqual(again['ETag'], resp['ETag'])
+        self.assertContains(again, Depense.objects.get().photo_miniature.url)
+
+    def test_replaced_cleared_or_deleted_photo_files_are_removed(self):
+        def fichiers():
+            return sorted(os.path.relpath(os.path.join(d, f), self.media)
+                          for d, _, fs in os.walk(self.media) for f in fs)
+
+        dep = Depense(type_depense='alimentation', quartier='Q', prix=500, lieu='L', date=timezone.now().date(),
+                      photo=self._jpeg())
+        with self.captureOnCommitCallbacks(execute=True):
+            dep.save()
+        self.assertEqual(len(fichiers()), 2)
+
+        # Remplacement : la version web et la miniature précédentes disparaissent
+        dep.photo = self._jpeg(size=(600, 400))
+        with self.captureOnCommitCallbacks(execute=True):
+            dep.save()
+        dep.refresh_from_db()
+        self.assertEqual((dep.photo_statut, dep.photo_largeur), (Depense.PHOTO_PRETE, 400))
+        self.assertEqual(len(fichiers()), 2)
+
+        # Enregistrement sans toucher à la photo : rien n'est supprimé
+        dep.prix = 600
+        with self.captureOnCommitCallbacks(execute=True):
+            dep.save()
+        self.assertEqual(len(fichiers()), 2)
+
+        # Retrait de la photo, puis suppression d'une autre dépense avec photo
+        dep.photo = None
+        with self.captureOnCommitCallbacks(execute=True):
+            dep.save()
+        self.assertEqual(fichiers(), [])
+        autre = Depense(type_depense='alimentation', quartier='Q', prix=80, lieu='L', date=timezone.now().date(),
+                        photo=self._jpeg())
+        with self.captureOnCommitCallbacks(execute=True):
+            autre.save()
+        self.assertEqual(len(fichiers()), 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            Depense.objects.filter(pk=autre.pk).delete()
+        self.assertEqual(fichiers(), [])
+
+    def test_unreadable_photo_is_marked(self):
+        upload = SimpleUploadedFile('faux.jpg', b'pas une image', content_type='image/jpeg')
+        dep = Depense(type_depense='alimentation', quartier='Q', prix=500, lieu='L', date=timezone.now().date())
+        dep.photo.save('faux.jpg', upload, save=False)
+        dep.photo_statut = Depense.PHOTO_EN_ATTENTE
+        Depense.objects.bulk_create([dep])
+        out = StringIO()
+        call_command('process_photos', stdout=out)
+        self.assertIn('1 illisible', out.getvalue())
+        self.assertEqual(Depense.objects.get().photo_statut, Depense.PHOTO_ERREUR)
+
+
+class BatchApiTests(TestCase):
+    def _post(self, payload):
+        return self.client.post(reverse('api_batch_depenses'), data=json.dumps(payload),
+                                content_type='application/json')
+
+    def _item(self, cle, **kwargs):
+        item = {'cle': cle, 'type_depense': 'transport', 'quartier': ' centre_ville ', 'prix': 250,
+                'lieu': 'Moto', 'date': timezone.now().date().isoformat()}
+        item.update(kwargs)
+        return item
+
+    def test_batch_creates_valid_items_and_reports_errors(self):
+        futur = (timezone.now().date() + timezone.timedelta(days=3)).isoformat()
+        # SAVEPOINT, clés existantes, INSERT groupé, partitions, RELEASE ; réservoir : SAVEPOINT,
+        # strates (lecture, création, relecture), emplacements, upsert, compteurs, RELEASE
+        with self.assertNumQueries(13):
+            resp = self._post({'depenses': [
+                self._item('a'), self._item('b', prix=300, lieu='Taxi'),
+                self._item('c', date=futur), self._item('d', prix=0), self._item(''),
+            ]})
+        self.assertEqual(resp.status_code, 200)
+        statuts = [r['statut'] for r in resp.json()['resultats']]
+        self.assertEqual(statuts, ['cree', 'cree', 'invalide', 'invalide', 'invalide'])
+        self.assertIn('date', resp.json()['resultats'][2]['erreurs'])
+        self.assertIn('prix', resp.json()['resultats'][3]['erreurs'])
+        dep = Depense.objects.get(cle_idempotence='a')
+        self.assertEqual(dep.quartier, 'Centre Ville')
+        self.assertTrue(dep.empreinte)
+        self.assertTrue(PartitionModifiee.objects.filter(date=dep.date, quartier='Centre Ville').exists())
+
+    def test_resend_is_idempotent(self):
+        first = self._post([self._item('k1'), self._item('k2', prix=400)]).json()['resultats']
+        second = self._post([self._item('k1'), self._item('k2', prix=400), self._item('k2', prix=400)]).json()['resultats']
+        self.assertEqual([r['statut'] for r in second], ['existant', 'existant', 'existant'])
+        self.assertEqual([r['id'] for r in second[:2]], [r['id'] for r in first])
+        self.assertEqual(Depense.objects.count(), 2)
+
+    def test_rejects_malformed_payloads(self):
+        self.assertEqual(self.client.post(reverse('api_batch_depenses'), data='{', content_type='application/json').status_code, 400)
+        self.assertEqual(self._post({'depenses': 'x'}).status_code, 400)
+        with self.settings(ECOTRACK_API_BATCH_MAX=1):
+            self.assertEqual(self._post([self._item('a'), self._item('b')]).status_code, 413)
+        self.assertEqual(self.client.get(reverse('api_batch_depenses')).status_code, 405)
+
+
+@override_settings(ECOTRACK_FEED_LAG=0)
+class ChangeFeedTests(DepenseFactoryMixin, TestCase):
+    type_par_defaut = 'transport'
+
+    def _pull(self, curseur='', **params):
+        resp = self.client.get(reverse('export_changements'), {'curseur': curseur, **params})
+        self.assertEqual(resp.status_code, 200)
+        body = b''.join(resp.streaming_content).decode('utf-8')
+        return resp, body
+
+    def _records(self, curseur='', **params):
+        resp, body = self._pull(curseur, **params)
+        return resp, [json.loads(line) for line in body.splitlines()]
+
+    def test_incremental_pull_with_tombstones(self):
+        a, b = self._create(100), self._create(200)
+        resp, records = self._records()
+        self.assertEqual([(r['operation'], r['id']) for r in records], [('upsert', a.pk), ('upsert', b.pk)])
+        curseur = resp['X-Next-Cursor']
+
+        resp, records = self._records(curseur)
+        self.assertEqual(records, [])
+        self.assertEqual(resp['X-Next-Cursor'], curseur)
+
+        a.prix = 150
+        a.save()
+        b_pk = b.pk
+        b.delete()
+        resp, records = self._records(curseur)
+        self.assertEqual([(r['operation'], r['id']) for r in records], [('upsert', a.pk), ('delete', b_pk)])
+        self.assertEqual(records[0]['prix'], 150.0)
+
+    def test_pagination_follows_cursor(self):
+        ids = [self._create(100 + i).pk for i in range(5)]
+        seen, curseur, more = [], '', True
+        while more:
+            resp, records = self._records(curseur, limite=2)
+            seen += [r['id'] for r in records]
+            curseur, more = resp['X-Next-Cursor'], resp['X-Has-More'] == 'true'
+        self.assertEqual(seen, ids)
+
+    def test_csv_format_and_invalid_cursor(self):
+        self._create(100)
+        resp, body = self._pull(format='csv')
+        self.assertTrue(resp['Content-Type'].startswith('text/csv'))
+        self.assertTrue(body.startswith('operation,id,date_modification'))
+        self.assertIn('upsert,', body)
+        self.assertEqual(self.client.get(reverse('export_changements'), {'curseur': 'xx'}).status_code, 400)
+
+    def test_recent_changes_wait_for_lag(self):
+        self._create(100)
+        with self.settings(ECOTRACK_FEED_LAG=60):
+            _, records = self._records()
+        self.assertEqual(records, [])
+
+    def test_relabel_batches_are_stamped_just_before_commit(self):
+        from datetime import timedelta
+        from . import anomalies
+        for i in range(5):
+            self._create(100 + i, lieu='Même lieu')  # 5 doublons à annoter
+        Depense.objects.update(anomalie='', anomalie_kind='')
+        debut = timezone.now()
+        horloge = iter(debut + timedelta(seconds=10 * i) for i in range(100))
+        with mock.patch.object(anomalies, 'RELABEL_BATCH', 2), \
+                mock.patch.object(anomalies.timezone, 'now', side_effect=lambda: next(horloge)):
+            self.assertEqual(anomalies.detect_anomalies(), 5)
+        # Un horodatage par lot de 2 (transaction courte) plutôt qu'un seul avant toutes les écritures
+        self.assertEqual(Depense.objects.values('date_modification').distinct().count(), 3)
+
+
+class ExportFormatTests(TestCase):
+    def setUp(self):
+        for i in range(5):
+            Depense.objects.create(type_depense='transport', quartier='F1' if i < 3 else 'F2', prix=100 + i,
+                                   lieu=f'L{i}', date=timezone.now().date())
+
+    def _get(self, **params):
+        resp = self.client.get(reverse('export_csv'), params)
+        self.assertEqual(resp.status_code, 200)
+        return resp, b''.join(resp.streaming_content)
+
+    def test_ndjson_applies_filters(self):
+        resp, body = self._get(format='ndjson', quartier='f1')
+        self.assertIn('.ndjson', resp['Content-Disposition'])
+        records = [json.loads(line) for line in body.decode('utf-8').splitlines()]
+        self.assertEqual(len(records), 3)
+        self.assertEqual(records[0]['type'], 'Transport')
+        self.assertIsInstance(records[0]['prix'], float)
+
+    @unittest.skipIf(importlib.util.find_spec('pyarrow') is None, "pyarrow non installé")
+    def test_parquet_written_in_row_groups(self):
+        import pyarrow.parquet as pq
+        with mock.patch('core.exports.PARQUET_ROW_GROUP', 2):
+            _, body = self._get(format='parquet')
+        fichier = pq.ParquetFile(BytesIO(body))
+        self.assertEqual(fichier.metadata.num_rows, 5)
+        self.assertEqual(fichier.num_row_groups, 3)
+        self.assertEqual(fichier.schema_arrow.field('prix').type.bit_width, 64)
+
+    @unittest.skipIf(importlib.util.find_spec('openpyxl') is None, "openpyxl non installé")
+    def test_xlsx_export(self):
+        from openpyxl import load_workbook
+        _, body = self._get(format='xlsx', quartier='F2')
+        rows = list(load_workbook(BytesIO(body), read_only=True).active.values)
+        self.assertEqual(rows[0][:2], ('date', 'type'))
+        self.assertEqual(len(rows), 3)
+
+    def test_unknown_format_and_missing_dependency(self):
+        self.assertEqual(self.client.get(reverse('export_csv'), {'format': 'pdf'}).status_code, 400)
+        with mock.patch.dict('sys.modules', {'pyarrow': None, 'pyarrow.parquet': None}):
+            resp = self.client.get(reverse('export_anomalies_csv'), {'format': 'parquet'})
+        self.assertEqual(resp.status_code, 501)
+
+
+class CompressedExportTests(TestCase):
+    def setUp(self):
+        self.archives = tempfile.mkdtemp(prefix='ecotrack-exports-')
+        self.addCleanup(shutil.rmtree, self.archives, ignore_errors=True)
+        override = override_settings(ECOTRACK_EXPORT_ARCHIVE_DIR=self.archives)
+        override.enable()
+        self.addCleanup(override.disable)
+        for i in range(50):
+            Depense.objects.create(type_depense='loisirs', quartier='Z1', prix=100 + i, lieu=f'L{i}',
+                                   date=timezone.now().date())
+
+    def _body(self, resp):
+        return b''.join(resp.streaming_content)
+
+    def test_gzip_negotiated(self):
+        import gzip
+        resp = self.client.get(reverse('export_csv'), {'quartier': 'z1'}, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(resp['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp['Vary'])
+        content = gzip.decompress(self._body(resp)).decode('utf-8')
+        self.assertEqual(len(content.splitlines()), 51)
+
+        resp = self.client.get(reverse('export_csv'), {'quartier': 'z1'}, HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertFalse(resp.has_header('Content-Encoding'))
+
+    @unittest.skipIf(importlib.util.find_spec('zstandard') is None, "zstandard non installé")
+    def test_zstd_preferred_when_available(self):
+        import zstandard
+        resp = self.client.get(reverse('export_changements'), HTTP_ACCEPT_ENCODING='gzip, zstd')
+        self.assertEqual(resp['Content-Encoding'], 'zstd')
+        zstandard.ZstdDecompressor().decompressobj().decompress(self._body(resp))
+
+    def test_nightly_archive_served_only_while_data_unchanged(self):
+        import gzip
+        from django.http import FileResponse
+        call_command('build_export_archive', stdout=StringIO())
+
+        resp = self.client.get(reverse('export_csv'), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(resp['Content-Encoding'], 'gzip')
+        self.assertIsInstance(resp, FileResponse)  # archive servie telle quelle
+        content = gzip.decompress(self._body(resp)).decode('utf-8')
+        self.assertEqual(len(content.splitlines()), 51)
+
+        # Saisie après la construction : l'archive est périmée, export calculé à la demande
+        Depense.objects.create(type_depense='loisirs', quartier='Z2', prix=999, lieu='Après', date=timezone.now().date())
+        resp = self.client.get(reverse('export_csv'), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertNotIsInstance(resp, FileResponse)
+        content = gzip.decompress(self._body(resp)).decode('utf-8')
+        self.assertIn('Après', content)
+        self.assertEqual(len(content.splitlines()), 52)
+
+        # Reconstruite : de nouveau servie ; trop ancienne : calculée à la demande
+        call_command('build_export_archive', stdout=StringIO())
+        self.assertIsInstance(self.client.get(reverse('export_csv'), HTTP_ACCEPT_ENCODING='gzip'), FileResponse)
+        with self.settings(ECOTRACK_EXPORT_ARCHIVE_MAX_AGE=-1):
+            resp = self.client.get(reverse('export_csv'), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertNotIsInstance(resp, FileResponse)
+        self.assertIn('Après', gzip.decompress(self._body(resp)).decode('utf-8'))
+
+
+class ZipExportTests(TestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp(prefix='ecotrack-media-')
+        self.addCleanup(shutil.rmtree, self.media, ignore_errors=True)
+        override = override_settings(MEDIA_ROOT=self.media)
+        override.enable()
+        self.addCleanup(override.disable)
+        os.makedirs(os.path.join(self.media, 'photos'))
+        self.photo = os.urandom(300 * 1024)
+        with open(os.path.join(self.media, 'photos', 'ticket.jpg'), 'wb') as f:
+            f.write(self.photo)
+        today = timezone.now().date()
+        self.a = Depense.objects.create(type_depense='transport', quartier='Z1', prix=200, lieu='Moto',
+                                        date=today, photo='photos/ticket.jpg')
+        self.b = Depense.objects.create(type_depense='transport', quartier='Z2', prix=300, lieu='Taxi',
+                                        date=today, photo='photos/ticket.jpg')
+        Depense.objects.create(type_depense='transport', quartier='Z1', prix=250, lieu='Bus', date=today)
+        Depense.objects.create(type_depense='loisirs', quartier='Z1', prix=900, lieu='Absente',
+                               date=today, photo='photos/disparue.jpg')
+
+    def _zip(self, params):
+        import zipfile
+        resp = self.client.get(reverse('export_zip'), params)
+        self.assertEqual(resp['Content-Type'], 'application/zip')
+        self.assertTrue(resp.streaming)
+        chunks = list(resp.streaming_content)
+        return chunks, zipfile.ZipFile(BytesIO(b''.join(chunks)))
+
+    def test_csv_and_photos_streamed(self):
+        chunks, zf = self._zip({'quartier': 'z1'})
+        # Photo copiée par morceaux : plusieurs blocs envoyés, pas un seul tampon
+        self.assertGreater(len(chunks), 3)
+        self.assertLess(max(len(c) for c in chunks), 200 * 1024)
+        self.assertEqual(sorted(zf.namelist()), ['depenses.csv', f'photos/{self.a.pk}-ticket.jpg'])
+        self.assertEqual(zf.read(f'photos/{self.a.pk}-ticket.jpg'), self.photo)
+        lines = zf.read('depenses.csv').decode('utf-8').splitlines()
+        self.assertEqual(lines[0], 'id,date,type,quartier,lieu,prix,commentaire,anomalie,photo')
+        self.assertEqual(len(lines), 4)
+        rows = {line.split(',')[4]: line.split(',')[-1] for line in lines[1:]}
+        self.assertEqual(rows['Moto'], f'photos/{self.a.pk}-ticket.jpg')
+        self.assertEqual(rows['Bus'], '')
+        # Fichier manquant sur le disque : ligne conservée, photo absente de l'archive
+        self.assertTrue(rows['Absente'].endswith('disparue.jpg'))
+
+    def test_same_filters_as_csv_export(self):
+        _, zf = self._zip({'type': 'transport', 'prix_min': 280})
+        self.assertEqual(sorted(zf.namelist()), ['depenses.csv', f'photos/{self.b.pk}-ticket.jpg'])
+        self.assertEqual(len(zf.read('depenses.csv').splitlines()), 2)
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.dep = Depense.objects.create(type_depense='loisirs', quartier='Z1', prix=100, lieu='Cinéma',
+                                          date=timezone.now().date())
+
+    def _revalidate(self, name, resp, params=None):
+        return self.client.get(reverse(name), params or {}, HTTP_IF_NONE_MATCH=resp['ETag'])
+
+    def test_304_skips_view_until_data_changes(self):
+        resp = self.client.get(reverse('liste_depenses'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp['ETag'].startswith('W/'))
+        self.assertIn('no-cache', resp['Cache-Control'])
+
+        with mock.patch.object(views, '_dashboard_context', wraps=views._dashboard_context) as compute:
+            resp = self.client.get(reverse('dashboard'))
+            self.assertEqual(compute.call_count, 1)
+            again = self._revalidate('dashboard', resp)
+            self.assertEqual(again.status_code, 304)
+            self.assertEqual(again['ETag'], resp['ETag'])
+            self.assertEqual(compute.call_count, 1)
+
+        # Autres paramètres : autre version
+        self.assertEqual(self._revalidate('liste_depenses', resp, {'quartier': 'z1'}).status_code, 200)
+
+        resp = self.client.get(reverse('anomalies'))
+        self.assertEqual(self._revalidate('anomalies', resp).status_code, 304)
+        self.dep.prix = 150
+        self.dep.save()
+        self.assertEqual(self._revalidate('anomalies', resp).status_code, 200)
+
+    def test_deletion_and_if_modified_since(self):
+        Depense.objects.create(type_depense='loisirs', quartier='Z2', prix=80, lieu='Parc', date=timezone.now().date())
+        resp = self.client.get(reverse('export_csv'), {'quartier': 'z1'})
+        self.assertEqual(resp.status_code, 200)
+        last_modified = resp['Last-Modified']
+        resp = self.client.get(reverse('export_csv'), {'quartier': 'z1'}, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(resp.status_code, 304)
+
+        # Une suppression n'avance pas max(date_modification) mais invalide quand même (pierre tombale)
+        time.sleep(1.1)
+        Depense.objects.filter(lieu='Parc').delete()
+        resp = self.client.get(reverse('export_csv'), {'quartier': 'z1'}, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(resp.status_code, 200)
+
+
+    def test_stale_page_gets_no_validators_and_dashboard_no_last_modified(self):
+        resp = self.client.get(reverse('dashboard'))
+        self.assertFalse(resp.has_header('Last-Modified'))
+        self.assertTrue(self.client.get(reverse('liste_depenses')).has_header('Last-Modified'))
+
+        Depense.objects.create(type_depense='loisirs', quartier='Z1', prix=300, lieu='Parc', date=timezone.now().date())
+        with self.settings(ECOTRACK_STALE_WHILE_REVALIDATE=True), \
+                mock.patch.object(singleflight, '_run_in_background') as refresh:
+            stale = self.client.get(reverse('dashboard'))
+            self.assertEqual(refresh.call_count, 1)
+            self.assertEqual(stale.context['stats_globales']['total_depenses'], 1)
+            # Pas d'ETag des données courantes sur une page périmée : la suivante est recalculée
+            self.assertFalse(stale.has_header('ETag'))
+            self.assertIn('no-cache', stale['Cache-Control'])
+            async_stale = async_to_sync(views_async.dashboard)(RequestFactory().get(reverse('dashboard')))
+            self.assertFalse(async_stale.has_header('ETag'))
+        fresh = self._revalidate('dashboard', resp)
+        self.assertEqual(fresh.status_code, 200)
+        self.assertEqual(fresh.context['stats_globales']['total_depenses'], 2)
+        self.assertTrue(fresh.has_header('ETag'))
+
+
+class DashboardFilterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        today = timezone.localdate()
+        Depense.objects.create(type_depense='transport', quartier='Z1', prix=100, lieu='A', date=today)
+        Depense.objects.create(type_depense='loisirs', quartier='Z2', prix=300, lieu='B', date=today - timezone.timedelta(days=10))
+        Depense.objects.create(type_depense='transport', quartier='Z1', prix=5000, lieu='C', date=today - timezone.timedelta(days=400))
+
+    def test_default_window_is_last_90_days(self):
+        filtres = views.dashboard_filters({})
+        self.assertEqual(filtres['debut'], (timezone.localdate() - timezone.timedelta(days=90)).isoformat())
+        resp = self.client.get(reverse('dashboard'))
+        self.assertEqual(resp.context['stats_globales']['total_depenses'], 2)
+        resp = self.client.get(reverse('dashboard'), {'periode': 'tout'})
+        self.assertEqual(resp.context['stats_globales']['total_depenses'], 3)
+
+    def test_filters_pushed_into_sql(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        filtres = views.dashboard_filters({'type': 'transport', 'quartier': 'z1', 'periode': 'tout'})
+        with CaptureQueriesContext(connection) as ctx:
+            rows = views._load_dashboard_rows(views._dashboard_queryset(filtres))
+        self.assertEqual(len(rows), 2)
+        sql = ctx.captured_queries[0]['sql']
+        self.assertIn('"type_depense" = ', sql)
+        self.assertIn('"quartier" = ', sql)
+
+        context = views._dashboard_context(views.dashboard_filters({'debut': '2000-01-01', 'fin': '2000-12-31'}))
+        self.assertIn('message', context)
+        resp = self.client.get(reverse('dashboard'), {'debut': '2000-01-01', 'fin': '2000-12-31'})
+        self.assertContains(resp, 'Aucune dépense sur cette période')
+
+
+class TimeSeriesTests(unittest.TestCase):
+    def test_lttb_keeps_extremes_and_bounds(self):
+        from .timeseries import lttb
+        x = np.arange(10000)
+        y = np.sin(x / 300.0)
+        y[4321] = 50  # pic isolé
+        idx = lttb(x, y, 200)
+        self.assertEqual(len(idx), 200)
+        self.assertEqual((idx[0], idx[-1]), (0, 9999))
+        self.assertIn(4321, idx)
+        self.assertTrue(np.all(np.diff(idx) > 0))
+        np.testing.assert_array_equal(lttb(x[:50], y[:50], 200), np.arange(50))
+
+    def test_resolution_follows_span(self):
+        from .timeseries import price_series
+        days = pd.date_range('2015-01-01', '2024-12-31', freq='D')
+        df = pd.DataFrame({'date': days, 'prix': np.arange(len(days), dtype=float)})
+        out, resolution, _ = price_series(df, max_points=50)
+        self.assertEqual(resolution, 'mois')
+        self.assertEqual(len(out), 50)
+        self.assertIn('rolling', out)
+        out, resolution, _ = price_series(df.tail(30))
+        self.assertEqual((resolution, len(out)), ('jour', 30))
+        out, resolution, _ = price_series(df.tail(400))
+        self.assertEqual(resolution, 'semaine')
+
+
+@override_settings(ECOTRACK_RESERVOIR_SIZE=20)
+class ReservoirSampleTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        today = timezone.localdate()
+        rng = np.random.default_rng(3)
+        # Strates de tailles très différentes : la pondération compte
+        for prix in rng.normal(1000, 100, 200):
+            Depense.objects.create(type_depense='logement', quartier='Grand', prix=round(prix), lieu='L', date=today)
+        for prix in rng.normal(100, 10, 30):
+            Depense.objects.create(type_depense='transport', quartier='Grand', prix=round(prix), lieu='T', date=today)
+        for prix in rng.normal(300, 30, 10):
+            Depense.objects.create(type_depense='transport', quartier='Petit', prix=round(prix), lieu='P', date=today)
+
+    def test_reservoir_locks_strata_while_counting(self):
+        from django.db.models.query import QuerySet
+        from .models import StrateEchantillon
+        from .sampling import reservoir_add
+        verrouilles = []
+
+        def select_for_update(qs, *args, **kwargs):
+            verrouilles.append(qs.model)
+            return qs
+        vues = StrateEchantillon.objects.get(quartier='Petit', type_depense='transport').vues
+        # bulk_create : pas de signal, le lot n'est proposé qu'une fois
+        depenses = Depense.objects.bulk_create([Depense(type_depense='transport', quartier='Petit', prix=300 + i,
+                                                        lieu='P', date=timezone.localdate()) for i in range(3)])
+        with mock.patch.object(QuerySet, 'select_for_update', autospec=True, side_effect=select_for_update):
+            reservoir_add('default', depenses)
+        self.assertEqual(verrouilles, [StrateEchantillon])
+        self.assertEqual(StrateEchantillon.objects.get(quartier='Petit', type_depense='transport').vues, vues + 3)
+
+    def test_reservoir_maintained_on_insert_and_delete(self):
+        from .models import EchantillonDepense, StrateEchantillon
+        strate = StrateEchantillon.objects.get(quartier='Grand', type_depense='logement')
+        self.assertEqual(strate.vues, 200)
+        self.assertEqual(strate.emplacements.count(), 20)
+        self.assertEqual(StrateEchantillon.objects.get(quartier='Petit').emplacements.count(), 10)
+
+        # Suppression : emplacement libéré, réoccupé par l'insertion suivante
+        Depense.objects.filter(echantillon__strate=strate).first().delete()
+        self.assertEqual(strate.emplacements.count(), 19)
+        nouvelle = Depense.objects.create(type_depense='logement', quartier='Grand', prix=1000, lieu='N',
+                                          date=timezone.localdate())
+        self.assertTrue(EchantillonDepense.objects.filter(depense=nouvelle).exists())
+
+        # Changement de strate : la dépense suit
+        nouvelle.quartier = 'Petit'
+        nouvelle.save()
+        self.assertEqual(EchantillonDepense.objects.get(depense=nouvelle).strate.quartier, 'Petit')
+
+        call_command('rebuild_reservoir', stdout=StringIO())
+        self.assertEqual(EchantillonDepense.objects.count(), 20 + 20 + 11)
+
+    def test_approx_dashboard_with_confidence_intervals(self):
+        from .sampling import sample_frame, stratified_mean
+        sample, population = sample_frame(Depense.objects.all(), ['prix'])
+        self.assertEqual((len(sample), population), (50, 240))
+        moyenne, ic = stratified_mean(sample)
+        exacte = float(pd.Series([float(p) for p in Depense.objects.values_list('prix', flat=True)]).mean())
+        self.assertGreater(ic, 0)
+        self.assertLess(abs(moyenne - exacte), 3 * ic)
+
+        resp = self.client.get(reverse('dashboard'), {'approx': '1'})
+        self.assertContains(resp, 'Mode approximatif')
+        globales = resp.context['stats_globales']
+        self.assertEqual(globales['total_depenses'], 240)
+        grand = next(s for s in resp.context['stats_quartier'] if s['quartier'] == 'Grand')
+        self.assertEqual(grand['nombre'], 230)
+        self.assertGreater(grand['ic'], 0)
+
+        resp = self.client.get(reverse('dashboard'))
+        self.assertNotIn('approx', resp.context)
+        with self.settings(ECOTRACK_APPROX_THRESHOLD=100):
+            cache.clear()
+            resp = self.client.get(reverse('dashboard'))
+            self.assertIn('approx', resp.context)
+            self.assertEqual(self.client.get(reverse('dashboard'), {'approx': '0'}).context.get('approx'), None)
+
+    def test_approx_comparison(self):
+        resp = self.client.get(reverse('comparaison'), {'q1': 'grand', 'q2': 'petit', 'approx': '1'})
+        self.assertEqual(resp.context['stats_q1']['nombre'], 230)
+        self.assertEqual(resp.context['stats_q2']['nombre'], 10)
+        # Strate entièrement échantillonnée : estimation exacte, IC nul
+        self.assertEqual(resp.context['stats_q2']['ic'], 0)
+        self.assertContains(resp, 'Mode approximatif')
+
+
+class StreamingStatsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        rng = np.random.default_rng(5)
+        today = timezone.localdate()
+        self.depenses = [
+            Depense(type_depense=typ, quartier=quartier, prix=int(prix), lieu='S',
+                    date=today - timezone.timedelta(days=int(jour)))
+            for typ, quartier, prix, jour in zip(
+                rng.choice(['logement', 'transport', 'alimentation'], 600), rng.choice(['Alpha', 'Beta', 'Gamma'], 600),
+                rng.lognormal(7, 0.5, 600), rng.integers(0, 60, 600))
+        ]
+        Depense.objects.bulk_create(self.depenses)
+
+    def test_same_stats_as_dataframe(self):
+        qs = Depense.objects.all()
+        exact = views._dashboard_resultats(views._load_dashboard_rows(qs), views._count_anomalies(qs))
+        with self.settings(ECOTRACK_STREAM_CHUNK=64):
+            flux = views._dashboard_streaming_resultats(*views._load_dashboard_streaming(qs))
+        for key in ('stats_quartier', 'stats_type'):
+            self.assertEqual([list(s) for s in flux[key]], [list(s) for s in exact[key]])
+            for a, b in zip(flux[key], exact[key]):
+                self.assertEqual((a['nombre'], a['min'], a['max']), (b['nombre'], b['min'], b['max']))
+                self.assertAlmostEqual(a['moyenne'], b['moyenne'], places=6)
+                self.assertLess(abs(a['mediane'] - b['mediane']) / b['mediane'], 0.03)
+                if 'ecart_type' in b:
+                    self.assertAlmostEqual(a['ecart_type'], b['ecart_type'], places=6)
+        self.assertEqual(list(flux['stats_globales']), list(exact['stats_globales']))
+        self.assertEqual(set(flux['graphs']), set(exact['graphs']))
+
+        with self.settings(ECOTRACK_STREAMING_THRESHOLD=100):
+            resp = self.client.get(reverse('dashboard'))
+        self.assertEqual(resp.context['stats_globales']['total_depenses'], 600)
+
+    def test_partial_states_merge(self):
+        from .streaming import stream_stats
+        qs = Depense.objects.all()
+        complet = stream_stats(qs)
+        partie = stream_stats(qs.filter(quartier='Alpha'))
+        partie.merge(stream_stats(qs.exclude(quartier='Alpha')))
+        self.assertEqual(partie.total.n, complet.total.n)
+        self.assertAlmostEqual(partie.total.mean, complet.total.mean, places=6)
+        self.assertAlmostEqual(partie.total.variance(), complet.total.variance(), places=3)
+        self.assertEqual(partie.total.sketch.quantile(0.5), complet.total.sketch.quantile(0.5))
+        self.assertEqual(partie.type['logement'].n, complet.type['logement'].n)
+
+    @override_settings(ECOTRACK_PARTITION_ROWS=100)
+    def test_parallel_date_partitions(self):
+        from .streaming import daily_means, parallel_stream_stats, partition_bounds, stream_stats
+        qs = Depense.objects.all()
+        bounds = partition_bounds(daily_means(qs), 4)
+        self.assertEqual(len(bounds), 4)
+        self.assertTrue(all(a[1] < b[0] for a, b in zip(bounds, bounds[1:])))
+
+        seul = stream_stats(qs)
+        parallele = parallel_stream_stats(qs, workers=2)
+        self.assertEqual(parallele.total.n, 600)
+        self.assertAlmostEqual(parallele.total.mean, seul.total.mean, places=6)
+        self.assertAlmostEqual(parallele.total.variance(), seul.total.variance(), places=3)
+        for key, stats in seul.quartier.items():
+            self.assertEqual(parallele.quartier[key].n, stats.n)
+            self.assertEqual(parallele.quartier[key].sketch.quantile(0.5), stats.sketch.quantile(0.5))
+            self.assertEqual((parallele.quartier[key].min, parallele.quartier[key].max), (stats.min, stats.max))
+
+        # Tâche d'un processus sur une base partagée : lecture de sa seule plage
+        from .streaming import aggregate_range
+        debut, fin = bounds[1]
+        plage = aggregate_range(qs.filter(type_depense='logement').query, 'default', debut, fin, 0.01, 50)
+        self.assertEqual(plage.total.n, qs.filter(type_depense='logement', date__range=(debut, fin)).count())
+
+    def test_peak_memory_independent_of_row_count(self):
+        import tracemalloc
+        from .streaming import stream_stats
+        copies = [Depense(type_depense=d.type_depense, quartier=d.quartier, prix=d.prix, lieu=d.lieu, date=d.date)
+                  for d in self.depenses * 60]
+        Depense.objects.bulk_create(copies, batch_size=2000)  # 36 000 lignes de plus
+
+        def peak(qs):
+            tracemalloc.start()
+            try:
+                stream_stats(qs, chunk_size=500)
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        borne = Depense.objects.order_by('id').values_list('id', flat=True)[999]
+        petit = peak(Depense.objects.filter(id__lte=borne))
+        grand = peak(Depense.objects.all())
+        # Plafond : quelques morceaux de 500 lignes, pas la table entière
+        self.assertLess(grand, 2 * 1024 * 1024)
+        self.assertLess(grand, 2 * petit)
+
+
+class ComparaisonMatriceTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        today = timezone.localdate()
+        prix = {('Alpha', 'logement'): [1000, 1200], ('Alpha', 'transport'): [100],
+                ('Beta', 'logement'): [500, 700, 600], ('Gamma', 'transport'): [50, 70]}
+        for (quartier, typ), valeurs in prix.items():
+            for p in valeurs:
+                Depense.objects.create(type_depense=typ, quartier=quartier, prix=p, lieu='M', date=today)
+
+    def test_matrix_in_one_grouped_query(self):
+        from .matrix import pairwise_differences
+        qs = views._comparaison_querysets({'mode': 'matrice'})[1]['matrice']
+        with self.assertNumQueries(1):
+            cells = views._load_matrice(qs)
+        self.assertEqual(cells[('Alpha', 'logement')]['n'], 2)
+
+        resp = self.client.get(reverse('comparaison') + '?mode=matrice&quartiers=alpha&quartiers=beta,gamma')
+        self.assertEqual(resp.context['mode'], 'matrice')
+        stats = resp.context['matrice_stats']
+        self.assertEqual([s['quartier'] for s in stats], ['Alpha', 'Beta', 'Gamma'])
+        self.assertAlmostEqual(stats[0]['moyenne'], 2300 / 3)
+        paires = resp.context['matrice_paires']
+        self.assertEqual(len(paires), 3)
+        self.assertEqual((paires[0]['a']['quartier'], paires[0]['b']['quartier']), ('Alpha', 'Gamma'))
+        self.assertEqual([p['ecart'] for p in paires], sorted((p['ecart'] for p in paires), reverse=True))
+        self.assertTrue(resp.context['graph_matrice'])
+        self.assertContains(resp, 'Écarts de moyenne entre quartiers')
+
+        # Types au choix ; mêmes écarts que le calcul paire par paire
+        resp = self.client.get(reverse('comparaison'), {'mode': 'matrice', 'types': 'logement'})
+        stats = resp.context['matrice_stats']
+        self.assertEqual([s['quartier'] for s in stats], ['Alpha', 'Beta'])
+        self.assertEqual(resp.context['matrice_paires'][0]['ecart'], 1100 - 600)
+        self.assertEqual(pairwise_differences(stats[:1]), [])
+
+        context = async_to_sync(views_async._comparaison_context)({'mode': 'matrice', 'quartiers': 'beta,gamma'})
+        self.assertEqual([s['quartier'] for s in context['matrice_stats']], ['Beta', 'Gamma'])
+
+
+class ComparaisonSignificativiteTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_small_groups_are_not_significant(self):
+        from .resampling import compare_groups
+        resultat = compare_groups([100, 300, 200], [150, 250, 260], n_resamples=2000, n_permutations=2000)
+        self.assertFalse(resultat['significatif_moyenne'])
+        self.assertFalse(resultat['significatif_mediane'])
+        self.assertLess(resultat['ic_moyenne'][0], 0)
+        self.assertGreater(resultat['ic_moyenne'][1], 0)
+        self.assertIsNone(compare_groups([100], [100, 200]))
+
+    def test_vectorized_bootstrap_and_permutations(self):
+        import time
+        from .resampling import compare_groups
+        rng = np.random.default_rng(0)
+        a, b = rng.normal(1000, 100, 1500), rng.normal(980, 100, 1200)
+        debut = time.perf_counter()
+        resultat = compare_groups(a, b, n_resamples=10_000, n_permutations=1)
+        duree = time.perf_counter() - debut
+        # Garde-fou large (machines de CI lentes) : environ 85 ms mesurées sur un cœur, voir le README
+        self.assertLess(duree, 2)
+        bas, haut = resultat['ic_moyenne']
+        self.assertLess(bas, resultat['diff_moyenne'])
+        self.assertGreater(haut, resultat['diff_moyenne'])
+        # IC bootstrap proche de l'IC normal (1,96 erreur type)
+        erreur = np.sqrt(a.var(ddof=1) / len(a) + b.var(ddof=1) / len(b))
+        self.assertAlmostEqual(haut - bas, 2 * 1.96 * erreur, delta=0.1 * erreur * 3.92)
+
+        # Groupe plus grand que ECOTRACK_RESAMPLE_MAX_N : même largeur d'IC une fois remise à l'échelle
+        with self.settings(ECOTRACK_RESAMPLE_MAX_N=400):
+            reduit = compare_groups(a, b, n_resamples=4000, n_permutations=500)
+        self.assertAlmostEqual(reduit['ic_moyenne'][1] - reduit['ic_moyenne'][0], haut - bas, delta=0.2 * (haut - bas))
+        self.assertEqual(reduit['significatif_moyenne'], reduit['p_moyenne'] < 0.05)
+
+    def test_comparison_page_reports_significance_once_per_generation(self):
+        from . import resampling
+        today = timezone.localdate()
+        for p in (1000, 1100, 1050, 990, 1200):
+            Depense.objects.create(type_depense='logement', quartier='Haut', prix=p, lieu='H', date=today)
+        for p in (400, 450, 420, 380, 500):
+            Depense.objects.create(type_depense='logement', quartier='Bas', prix=p, lieu='B', date=today)
+        with mock.patch.object(resampling, 'compare_groups', wraps=resampling.compare_groups) as calcul:
+            resp = self.client.get(reverse('comparaison'), {'q1': 'haut', 'q2': 'bas'})
+            self.assertContains(resp, "Significativité de l'écart")
+            s = resp.context['significativite']
+            self.assertTrue(s['significatif_moyenne'])
+            self.assertAlmostEqual(s['diff_moyenne'], 1068 - 430)
+            self.assertEqual(len(s['groupes']), 2)
+            # Autre page, mêmes groupes : résultat repris du cache
+            context = async_to_sync(views_async._comparaison_context)({'q1': 'haut', 'q2': 'bas'})
+            self.assertEqual(context['significativite']['p_moyenne'], s['p_moyenne'])
+            self.assertEqual(calcul.call_count, 1)
+            Depense.objects.create(type_depense='logement', quartier='Bas', prix=460, lieu='B', date=today)
+            views._comparaison_context({'q1': 'haut', 'q2': 'bas'})
+            self.assertEqual(calcul.call_count, 2)
+
+
+class BoxPlotSummaryTests(TestCase):
+    def test_summaries_match_matplotlib(self):
+        from matplotlib import cbook
+        from .boxplots import box_summaries
+        rng = np.random.default_rng(3)
+        prix = rng.lognormal(7, 0.8, 5000).round()
+        quartiers = rng.choice(['Bacongo', 'Poto-Poto', 'Moungali'], 5000)
+        summaries = box_summaries(prix, quartiers, {'Bacongo': 'BACONGO'}, max_fliers=10_000)
+        self.assertEqual(summaries['Bacongo']['label'], 'BACONGO')
+        for quartier in ('Bacongo', 'Poto-Poto', 'Moungali'):
+            attendu = cbook.boxplot_stats(prix[quartiers == quartier])[0]
+            for key in ('mean', 'med', 'q1', 'q3', 'whislo', 'whishi', 'cilo', 'cihi'):
+                self.assertAlmostEqual(summaries[quartier][key], attendu[key])
+            np.testing.assert_array_equal(np.sort(summaries[quartier]['fliers']), np.sort(attendu['fliers']))
+
+    def test_fliers_are_capped_but_keep_extremes(self):
+        from .boxplots import box_summary
+        valeurs = np.concatenate([np.full(1000, 100.0), np.arange(1, 301) * 1000.0, [1.0]])
+        summary = box_summary(valeurs, 'Q', max_fliers=20)
+        self.assertEqual(summary['nb_fliers'], 301)
+        self.assertEqual(len(summary['fliers']), 20)
+        self.assertIn(1.0, summary['fliers'])
+        self.assertIn(300_000.0, summary['fliers'])
+        self.assertIsNone(box_summary([], 'Q'))
+
+    def test_charts_are_drawn_from_summaries(self):
+        from matplotlib.axes import Axes
+        today = timezone.localdate()
+        for q, p in (('Bacongo', 500), ('Bacongo', 700), ('Moungali', 900), ('Moungali', 1100)):
+            Depense.objects.create(type_depense='logement', quartier=q, prix=p, lieu='L', date=today)
+        with mock.patch.object(Axes, 'boxplot', side_effect=AssertionError('boxplot sur les valeurs brutes')), \
+                mock.patch.object(Axes, 'bxp', autospec=True, side_effect=Axes.bxp) as bxp:
+            self.assertEqual(self.client.get(reverse('dashboard')).status_code, 200)
+            resp = self.client.get(reverse('comparaison'), {'q1': 'Bacongo', 'q2': 'Moungali'})
+            self.assertIn('graph_comparaison', resp.context)
+        self.assertEqual(bxp.call_count, 2)
+        self.assertEqual([s['med'] for s in bxp.call_args_list[1].args[1]], [600, 1000])
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class AdminChangelistTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(User.objects.create_superuser('admin', 'a@example.com', 'pass'))
+        today = timezone.localdate()
+        self.depenses = [Depense.objects.create(type_depense='logement', quartier=q, prix=p, lieu=f'Lieu {i}', date=today)
+                         for i, (q, p) in enumerate([('Bacongo', 1000), ('Bacongo', 1100), ('Bacongo', 1050),
+                                                     ('Poto-Poto', 980), ('Poto-Poto', 1020), ('Moungali', 990)])]
+        self.url = reverse('admin:core_depense_changelist')
+
+    def test_facet_counts_are_cached_and_total_not_counted(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        resp = self.client.get(self.url)
+        self.assertContains(resp, 'Logement (6)')
+        self.assertContains(resp, 'Aucune (6)')
+        self.assertContains(resp, 'list="quartier-suggestions"')
+        with CaptureQueriesContext(connection) as requetes:
+            self.client.get(self.url, {'quartier': 'Bacongo'})
+        sql = ' '.join(q['sql'] for q in requetes.captured_queries)
+        self.assertNotIn('GROUP BY', sql)
+        self.assertNotIn('DISTINCT', sql)
+        resp = self.client.get(self.url, {'quartier': 'Bacongo'})
+        self.assertEqual(resp.context['cl'].result_count, 3)
+
+    def test_quartier_suggestions(self):
+        resp = self.client.get(reverse('admin:core_depense_quartiers'), {'term': 'o'})
+        self.assertEqual([r['id'] for r in resp.json()['results']], ['Bacongo', 'Poto Poto', 'Moungali'])
+        self.assertEqual(resp.json()['results'][0]['text'], 'Bacongo (3)')
+
+    def test_estimated_counts_above_threshold(self):
+        with self.settings(ECOTRACK_ADMIN_COUNT_THRESHOLD=2):
+            resp = self.client.get(self.url)
+            self.assertContains(resp, 'environ')
+            self.assertGreaterEqual(resp.context['cl'].result_count, 6)
+            resp = self.client.get(self.url, {'quartier': 'Bacongo'})
+            self.assertEqual(resp.context['cl'].result_count, 2)
+            self.assertContains(resp, 'plus de')
+            resp = self.client.get(self.url, {'q': 'moungali'})
+            self.assertEqual(resp.context['cl'].result_count, 1)  # quartier exact, insensible à la casse
+            resp = self.client.get(self.url, {'quartier': 'poto-poto'})
+            self.assertEqual(resp.context['cl'].result_count, 2)
+            self.assertNotContains(resp, 'plus de')
+
+    def test_action_redetects_only_selected_rows(self):
+        today = timezone.localdate()
+        cher = Depense.objects.create(type_depense='logement', quartier='Bacongo', prix=100000, lieu='X', date=today)
+        autre = Depense.objects.create(type_depense='logement', quartier='Moungali', prix=90000, lieu='Y', date=today)
+        Depense.objects.filter(pk__in=[cher.pk, autre.pk]).update(anomalie='', anomalie_kind='')
+        passes = DetectionAnomalies.objects.count()
+        resp = self.client.post(self.url, {'action': 'redetecter_anomalies_iqr', '_selected_action': [cher.pk]}, follow=True)
+        self.assertContains(resp, 'Anomalies re-détectées (iqr)')
+        cher.refresh_from_db()
+        autre.refresh_from_db()
+        self.assertTrue(cher.anomalie.startswith('[AUTO]'))
+        self.assertEqual(autre.anomalie, '')
+        passe = DetectionAnomalies.objects.latest('id')
+        self.assertEqual(DetectionAnomalies.objects.count(), passes + 1)
+        self.assertEqual((passe.methode, passe.lignes_analysees), ('iqr', 1))
@@ -0,0 +1,75 @@
+"""
+Série temporelle des prix pour le dashboard, à taille bornée.
+
+- résolution choisie selon l'étendue : jour, semaine ou mois ;
+- moyenne mobile calculée sur la série rééchantillonnée ;
+- réduction LTTB (Largest-Triangle-Three-Buckets) à ECOTRACK_SERIES_MAX_POINTS
+  points, qui garde la forme de la courbe (pics et creux) contrairement à
+  un simple sous-échantillonnage régulier.
+
+Le coût du tracé dépend donc du nombre de points affichés, pas de la durée
+de l'historique.
+"""
+import numpy as np
+import pandas as pd
+from django.conf import settings
+
+# (étendue maximale en jours, fréquence pandas, fenêtre de moyenne mobile, libellés)
+RESOLUTIONS = [
+    (120, 'D', 7, 'jour', '7j'),
+    (730, 'W-MON', 4, 'semaine', '4 sem.'),
+    (None, 'MS', 3, 'mois', '3 mois'),
+]
+
+
+def lttb(x, y, n_out):
+    """Indices des points retenus par LTTB (le premier et le dernier sont toujours gardés)."""
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    # n_out - 2 seaux entre le premier et le dernier point
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    indices = np.empty(n_out, dtype=int)
+    indices[0], indices[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        # Aire du triangle (point retenu précédent, candidat, moyenne du seau suivant)
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+    return indices
+
+
+def price_series(df, max_points=None):
+    """
+    Prix moyens rééchantillonnés et réduits pour le graphique. `df` contient
+    des dépenses (date, prix), ou des moyennes déjà agrégées avec leur
+    effectif dans une colonne `n` (pondération au rééchantillonnage).
+    Retourne (DataFrame date/prix/rolling, résolution, libellé de la moyenne mobile).
+    """
+    if max_points is None:
+        max_points = getattr(settings, 'ECOTRACK_SERIES_MAX_POINTS', 300)
+    frame = df.set_index('date').sort_index()
+    prix = frame['prix']
+    span = (prix.index.max() - prix.index.min()).days
+    for max_span, freq, window, resolution, rolling_label in RESOLUTIONS:
+        if max_span is None or span <= max_span:
+            break
+    if 'n' in frame:
+        n = frame['n'].astype(float)
+        series = ((prix * n).resample(freq).sum() / n.resample(freq).sum()).dropna()
+    else:
+        series = prix.resample(freq).mean().dropna()
+    out = pd.DataFrame({'date': series.index, 'prix': series.values})
+    if len(out) > 1:
+        out['rolling'] = out['prix'].rolling(window=min(window, len(out)), center=True).mean()
+    if len(out) > max_points:
+        keep = lttb(out['date'].values.astype('int64'), out['prix'].values, max_points)
+        out = out.iloc[keep].reset_index(drop=True)
+    return out, resolution, rolling_label
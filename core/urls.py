@@ -1,18 +1,25 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import api, feed, views, views_async
+
+# Sous ASGI (uvicorn), ECOTRACK_ASYNC_VIEWS sert les versions asynchrones des pages d'analyse
+analytics_views = views_async if settings.ECOTRACK_ASYNC_VIEWS else views
 
 urlpatterns = [
     # Page d'accueil
-    path('', views.accueil, name='accueil'),
+    path('', analytics_views.accueil, name='accueil'),
     
     # Formulaire de saisie
     path('saisie/', views.saisie, name='saisie'),
     
     # Dashboard de visualisation
-    path('dashboard/', views.dashboard, name='dashboard'),
+    path('dashboard/', analytics_views.dashboard, name='dashboard'),
     
     # Comparaisons interactives
-    path('comparaison/', views.comparaison, name='comparaison'),
+    path('comparaison/', analytics_views.comparaison, name='comparaison'),
+    
+    # Comparaison inter-villes (déploiement multi-villes)
+    path('villes/', views.comparaison_villes, name='comparaison_villes'),
     
     # Anomalies
     path('anomalies/', views.anomalies, name='anomalies'),
@@ -21,6 +28,11 @@ urlpatterns = [
     path('depenses/', views.liste_depenses, name='liste_depenses'),
     # Exports
     path('export/csv/', views.export_csv, name='export_csv'),
+    path('export/zip/', views.export_zip, name='export_zip'),
     path('export/anomalies/csv/', views.export_anomalies_csv, name='export_anomalies_csv'),
     path('export/comparaison/csv/', views.export_comparaison_csv, name='export_comparaison_csv'),
+    path('export/changements/', feed.changements, name='export_changements'),
+
+    # API de synchronisation (collecte hors ligne)
+    path('api/depenses/batch/', api.batch_depenses, name='api_batch_depenses'),
 ]
\ No newline at end of file
@@ -1,8 +1,23 @@
 # Create your views here.
+from django.conf import settings
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
 from .forms import DepenseForm
 from .models import Depense
+from .boxplots import box_summaries, box_summary
+from .cities import (cities, city_label, current_city, fan_out, finalize,
+                     merge_partials, partial_aggregates)
+from .conditional import conditional_view, data_state, state_token
+from .exports import (DEPENSE_COLUMNS, archived_response, depense_rows, depenses_zip_response,
+                      export_response)
+from .resampling import cached_compare_groups
+from .routers import analytics_view
+from .sampling import approx_mode, population_of, sample_frame, stratified_mean, weighted_resample
+from .matrix import cell_partials, matrix_stats, pairwise_differences
+from .singleflight import coalesce
+from .streaming import aggregation_workers, daily_means, parallel_stream_stats, stream_stats
+from .timeseries import price_series
+from .write_queue import write_queue
 import pandas as pd
 import matplotlib
 matplotlib.use('Agg')  # Backend non-interactif
@@ -12,9 +27,12 @@ import numpy as np
 from matplotlib.ticker import FuncFormatter
 from io import BytesIO
 import base64
-from django.db.models import Avg, Min, Max, Count, Q
+from django.db.models import Avg, Min, Max, Count
 from django.http import JsonResponse, HttpResponse
+from django.utils import timezone
 from collections import defaultdict
+from datetime import date, timedelta
+from itertools import chain
 
 # Configuration matplotlib pour français
 plt.rcParams['font.size'] = 10
@@ -51,6 +69,9 @@ def get_type_depense_label(value):
     return TYPE_DEPENSE_LABELS.get(value, value)
 
 
+ACCUEIL_TITLE = 'EcoTrack Local - Suivi des coûts étudiants'
+
+
 def accueil(request):
     """Page d'accueil de l'application"""
     total_depenses = Depense.objects.count()
@@ -58,7 +79,7 @@ def accueil(request):
     total_types = Depense.objects.values('type_depense').distinct().count()
     
     context = {
-        'title': 'EcoTrack Local - Suivi des coûts étudiants',
+        'title': ACCUEIL_TITLE,
         'total_depenses': total_depenses,
         'total_quartiers': total_quartiers,
         'total_types': total_types,
@@ -71,7 +92,11 @@ def saisie(request):
     if request.method == 'POST':
         form = DepenseForm(request.POST, request.FILES)
         if form.is_valid():
-            depense = form.save()
+            if settings.ECOTRACK_WRITE_QUEUE and not form.cleaned_data.get('photo'):
+                # Insertion regroupée avec les saisies concurrentes (une transaction par lot)
+                depense = write_queue.save(form.save(commit=False))
+            else:
+                depense = form.save()
             messages.success(request, f'Dépense enregistrée avec succès ! ({depense.type_depense} - {depense.prix} FCFA)')
             return redirect('saisie')
     else:
@@ -80,119 +105,200 @@ def saisie(request):
     return render(request, 'saisie.html', {'form': form})
 
 
-def detect_anomalies():
-    """Détection automatique des anomalies (doublons et valeurs aberrantes)"""
-    deps = Depense.objects.all()
-    if not deps.exists():
-        return
-    
-    df = pd.DataFrame(list(deps.values()))
-    df['prix'] = df['prix'].astype(float)
-    
-    # Réinitialiser les anomalies existantes (sauf celles manuellement annotées)
-    Depense.objects.filter(anomalie__startswith="[AUTO]").update(anomalie="")
-    
-    # Détection des doublons basés sur date, lieu, prix (tolérance de 2% pour le prix)
-    doublons_detectes = set()
-    for i, row1 in df.iterrows():
-        for j, row2 in df.iterrows():
-            if i < j:  # Éviter les comparaisons doubles
-                # Vérifier si même date
-                if pd.to_datetime(row1['date']).date() == pd.to_datetime(row2['date']).date():
-                    # Vérifier si même lieu (comparaison insensible à la casse)
-                    if str(row1['lieu']).strip().lower() == str(row2['lieu']).strip().lower():
-                        # Vérifier si prix similaire (tolérance de 2%)
-                        prix1 = float(row1['prix'])
-                        prix2 = float(row2['prix'])
-                        diff_relative = abs(prix1 - prix2) / max(prix1, prix2, 0.01)
-                        if diff_relative < 0.02:  # 2% de tolérance
-                            doublons_detectes.add(row1['id'])
-                            doublons_detectes.add(row2['id'])
-    
-    for dep_id in doublons_detectes:
-        dep = Depense.objects.get(id=dep_id)
-        if not dep.anomalie or dep.anomalie.startswith("[AUTO]"):
-            dep.anomalie = "[AUTO] Doublon détecté (même date, lieu et prix similaire)"
-            dep.save()
-    
-    # Détection des valeurs aberrantes : prix > 3*écart-type + moyenne par type ET par quartier
-    for typ in df['type_depense'].unique():
-        sub_df = df[df['type_depense'] == typ]
-        if len(sub_df) < 3:  # Besoin d'au moins 3 valeurs pour calculer l'écart-type
-            continue
-        
-        mean = sub_df['prix'].mean()
-        std = sub_df['prix'].std()
-        
-        if std == 0 or pd.isna(std):  # Éviter division par zéro
-            continue
-        
-        # Seuil supérieur : moyenne + 3 écarts-types
-        seuil_sup = mean + 3 * std
-        # Seuil inférieur : moyenne - 3 écarts-types (pour détecter les prix anormalement bas)
-        seuil_inf = max(0, mean - 3 * std)
-        
-        # Valeurs aberrantes supérieures
-        aberrants_sup = sub_df[sub_df['prix'] > seuil_sup]
-        for index, row in aberrants_sup.iterrows():
-            dep = Depense.objects.get(id=row['id'])
-            if not dep.anomalie or dep.anomalie.startswith("[AUTO]"):
-                dep.anomalie = f"[AUTO] Valeur aberrante élevée (prix: {row['prix']:.0f} FCFA, moyenne: {mean:.0f} FCFA, écart-type: {std:.0f} FCFA)"
-                dep.save()
-        
-        # Valeurs aberrantes inférieures (si significativement plus bas)
-        if seuil_inf > 0:
-            aberrants_inf = sub_df[(sub_df['prix'] < seuil_inf) & (sub_df['prix'] > 0)]
-            for index, row in aberrants_inf.iterrows():
-                dep = Depense.objects.get(id=row['id'])
-                if not dep.anomalie or dep.anomalie.startswith("[AUTO]"):
-                    dep.anomalie = f"[AUTO] Valeur aberrante basse (prix: {row['prix']:.0f} FCFA, moyenne: {mean:.0f} FCFA, écart-type: {std:.0f} FCFA)"
-                    dep.save()
-    
-    # Détection par quartier également
-    for quartier in df['quartier'].unique():
-        sub_df = df[df['quartier'] == quartier]
-        if len(sub_df) < 3:
-            continue
-        
-        mean = sub_df['prix'].mean()
-        std = sub_df['prix'].std()
-        
-        if std == 0 or pd.isna(std):
-            continue
-        
-        seuil_sup = mean + 3 * std
-        aberrants = sub_df[sub_df['prix'] > seuil_sup]
-        
-        for index, row in aberrants.iterrows():
-            dep = Depense.objects.get(id=row['id'])
-            # Ne pas écraser une anomalie déjà détectée par type
-            if not dep.anomalie or (dep.anomalie.startswith("[AUTO]") and "Valeur aberrante" not in dep.anomalie):
-                dep.anomalie = f"[AUTO] Valeur aberrante par quartier (prix: {row['prix']:.0f} FCFA, moyenne quartier: {mean:.0f} FCFA)"
-                dep.save()
-
-
+@analytics_view
+@conditional_view(last_modified=False)
 def dashboard(request):
     """Dashboard de visualisation avec statistiques et graphiques améliorés"""
-    detect_anomalies()
-
-    deps = Depense.objects.all()
-    if not deps.exists():
-        return render(request, 'dashboard.html', {
-            'message': 'Aucune dépense enregistrée. Commencez par saisir des données.',
-            'stats': None,
-            'graphs': {}
-        })
+    filtres = dashboard_filters(request.GET)
+    # Un seul calcul à la fois par jeu de paramètres ; les requêtes
+    # simultanées attendent (ou reçoivent le résultat précédent) au lieu de
+    # relancer pandas/matplotlib chacune de leur côté.
+    # Clé = filtres résolus : la fenêtre par défaut glisse avec la date du jour.
+    context = coalesce('dashboard', filtres, lambda: _dashboard_context(filtres))
+    return render(request, 'dashboard.html', _dashboard_page(context, filtres))
+
+
+DASHBOARD_COLUMNS = ['date', 'prix', 'quartier', 'type_depense']
+DASHBOARD_VIDE = {
+    'message': 'Aucune dépense enregistrée. Commencez par saisir des données.',
+    'stats': None,
+    'graphs': {}
+}
+DASHBOARD_VIDE_FILTRE = "Aucune dépense sur cette période ou avec ces filtres. Élargissez la période ou saisissez des données."
+
+
+def _parse_date(value):
+    try:
+        return date.fromisoformat(value) if value else None
+    except ValueError:
+        return None
+
+
+def dashboard_filters(params):
+    """
+    Filtres du dashboard résolus en valeurs explicites : `debut` et `fin`
+    (AAAA-MM-JJ), `type`, `quartier`. Sans `debut`, la fenêtre couvre les
+    ECOTRACK_DASHBOARD_DAYS derniers jours ; `periode=tout` affiche tout
+    l'historique.
+    """
+    tout = params.get('periode') == 'tout'
+    fin = _parse_date(params.get('fin'))
+    debut = _parse_date(params.get('debut'))
+    if debut is None and not tout:
+        fin = fin or timezone.localdate()
+        debut = fin - timedelta(days=getattr(settings, 'ECOTRACK_DASHBOARD_DAYS', 90))
+    types = dict(Depense.TYPE_DEPENSE_CHOICES)
+    return {
+        'debut': debut.isoformat() if debut else '',
+        'fin': fin.isoformat() if fin else '',
+        'type': params.get('type', '') if params.get('type', '') in types else '',
+        'quartier': _normalize_input(params.get('quartier', '')),
+        'periode': 'tout' if tout else '',
+        # '1' / '0' : mode approximatif forcé ; vide : selon ECOTRACK_APPROX_THRESHOLD
+        'approx': params.get('approx', '') if params.get('approx', '') in ('0', '1') else '',
+    }
+
+
+def _dashboard_queryset(filtres):
+    """Filtres appliqués en SQL (index date) : seules les lignes de la fenêtre sont lues."""
+    qs = Depense.objects.all()
+    if filtres['debut']:
+        qs = qs.filter(date__gte=filtres['debut'])
+    if filtres['fin']:
+        qs = qs.filter(date__lte=filtres['fin'])
+    if filtres['type']:
+        qs = qs.filter(type_depense=filtres['type'])
+    if filtres['quartier']:
+        qs = qs.filter(quartier=filtres['quartier'])
+    return qs
+
+
+def _dashboard_context(filtres=None):
+    """
+    Calcule le contexte complet du dashboard (statistiques + graphiques).
+    Les anomalies sont seulement lues : elles sont annotées par `manage.py anomaly_worker`.
+    """
+    filtres = filtres or dashboard_filters({})
+    qs = _dashboard_queryset(filtres)
+    if approx_mode(filtres['approx'], qs):
+        sample, population = _load_dashboard_sample(qs)
+        if sample is not None:
+            return _dashboard_approx_resultats(sample, population)
+    if _use_streaming(qs):
+        return _dashboard_streaming_resultats(*_load_dashboard_streaming(qs))
+    return _dashboard_resultats(_load_dashboard_rows(qs), _count_anomalies(qs))
+
+
+def _use_streaming(queryset):
+    """Au-delà de ECOTRACK_STREAMING_THRESHOLD lignes, statistiques en flux plutôt qu'en DataFrame."""
+    return queryset.count() > getattr(settings, 'ECOTRACK_STREAMING_THRESHOLD', 200_000)
+
+
+def _load_dashboard_streaming(queryset):
+    """
+    Passe par morceaux sur la table (mémoire bornée) et moyennes par jour
+    agrégées en SQL ; avec plusieurs processus, agrégation par plages de dates.
+    """
+    daily = daily_means(queryset)
+    if aggregation_workers() > 1:
+        stats = parallel_stream_stats(queryset, daily=daily)
+    else:
+        stats = stream_stats(queryset)
+    return stats, daily, _count_anomalies(queryset)
+
+
+def _dashboard_streaming_resultats(stats, daily, nb_anomalies):
+    """
+    Dashboard exact à partir des états en flux : mêmes tableaux que
+    `_dashboard_resultats` ; médianes et quartiles lus dans l'esquisse
+    (erreur relative ECOTRACK_SKETCH_ACCURACY).
+    """
+    if not stats.total.n:
+        return dict(DASHBOARD_VIDE)
+    stats_quartier = [{'quartier': q, 'quartier_label': get_quartier_label(q), **s.summary()}
+                      for q, s in sorted(stats.quartier.items())]
+    stats_type = []
+    for typ, s in sorted(stats.type.items()):
+        summary = s.summary()
+        del summary['ecart_type']
+        stats_type.append({'type': typ, 'type_label': get_type_depense_label(typ), **summary})
+    box_stats = [stats.quartier[s['quartier']].box_stats(s['quartier_label']) for s in stats_quartier]
+    total = stats.total.summary()
+    graphs = _dashboard_graphs(price_series(daily), total['mediane'], stats_quartier, stats_type, box_stats)
+    stats_globales = {
+        'total_depenses': total['nombre'],
+        'prix_moyen_global': total['moyenne'],
+        'prix_median_global': total['mediane'],
+        'prix_min_global': total['min'],
+        'prix_max_global': total['max'],
+        'nombre_quartiers': len(stats_quartier),
+        'nombre_types': len(stats_type),
+        'anomalies': nb_anomalies,
+    }
+    return {
+        'stats_quartier': stats_quartier,
+        'stats_type': stats_type,
+        'stats_globales': stats_globales,
+        'graphs': graphs,
+    }
+
+
+def _load_dashboard_sample(queryset):
+    return sample_frame(queryset, [*DASHBOARD_COLUMNS, 'anomalie_kind'])
+
+
+def _dashboard_approx_resultats(sample, population):
+    """
+    Dashboard estimé sur l'échantillon réservoir : graphiques et médianes sur
+    un rééchantillonnage pondéré, moyennes stratifiées avec IC à 95 %,
+    effectifs exacts.
+    """
+    nb_anomalies = int(round(sample.loc[sample['anomalie_kind'] != '', 'poids'].sum()))
+    rows = weighted_resample(sample)[DASHBOARD_COLUMNS].to_dict('records')
+    context = _dashboard_resultats(rows, nb_anomalies)
+    for key, label_key, column in (('stats_quartier', 'quartier', 'quartier'), ('stats_type', 'type', 'type_depense')):
+        for stat in context[key]:
+            sub = sample[sample[column] == stat[label_key]]
+            stat['moyenne'], stat['ic'] = stratified_mean(sub)
+            stat['nombre'] = population_of(sub)
+    globales = context['stats_globales']
+    globales['prix_moyen_global'], globales['ic_moyenne'] = stratified_mean(sample)
+    globales['total_depenses'] = population
+    context['approx'] = {'echantillon': len(sample), 'population': population}
+    return context
+
+
+def _dashboard_page(context, filtres):
+    """Ajoute au contexte calculé (et partagé en cache) le formulaire de filtres."""
+    context = dict(context, filtres=filtres, types_depense=Depense.TYPE_DEPENSE_CHOICES)
+    if context.get('message') and any(filtres[k] for k in ('debut', 'fin', 'type', 'quartier')):
+        context['message'] = DASHBOARD_VIDE_FILTRE
+    return context
+
+
+def _load_dashboard_rows(queryset=None):
+    """Charge les colonnes utiles au dashboard"""
+    queryset = Depense.objects.all() if queryset is None else queryset
+    return list(queryset.order_by().values(*DASHBOARD_COLUMNS))
+
+
+def _count_anomalies(queryset=None):
+    # Même critère (indexé) que la page Anomalies
+    queryset = Depense.objects.all() if queryset is None else queryset
+    return queryset.exclude(anomalie_kind='').count()
+
 
-    df = pd.DataFrame(list(deps.values()))
+def _dashboard_resultats(rows, nb_anomalies):
+    """Statistiques et graphiques du dashboard (aucun accès base de données)"""
+    if not rows:
+        return dict(DASHBOARD_VIDE)
+
+    df = pd.DataFrame(rows, columns=DASHBOARD_COLUMNS)
     # Robustness: ensure date and prix exist and are numeric
     df['date'] = pd.to_datetime(df['date'])
     df['prix'] = pd.to_numeric(df['prix'], errors='coerce')
     df = df.dropna(subset=['date', 'prix'])
 
-    # Formatter pour axes (espaces pour milliers)
-    thousands_formatter = FuncFormatter(lambda x, pos: f"{int(x):,}".replace(',', ' '))
-
     # Statistiques par quartier (moyenne, min, max, médiane, nombre)
     stats_quartier = []
     for quartier in sorted(df['quartier'].dropna().unique()):
@@ -226,19 +332,52 @@ def dashboard(request):
             'nombre': int(len(sub_df)),
         })
 
+    mediane_globale = float(df['prix'].median()) if not pd.isna(df['prix'].median()) else 0.0
+    # Box plot : résumés de boîte de tous les quartiers en un seul tri (moustaches à 1,5 IQR)
+    summaries = box_summaries(df['prix'].to_numpy(), df['quartier'].to_numpy(),
+                              {s['quartier']: s['quartier_label'] for s in stats_quartier})
+    box_stats = [summaries[s['quartier']] for s in stats_quartier]
+    graphs = _dashboard_graphs(price_series(df), mediane_globale, stats_quartier, stats_type, box_stats)
+
+    # Statistiques globales
+    stats_globales = {
+        'total_depenses': len(df),
+        'prix_moyen_global': float(df['prix'].mean()) if len(df) > 0 else 0.0,
+        'prix_median_global': float(df['prix'].median()) if len(df) > 0 else 0.0,
+        'prix_min_global': float(df['prix'].min()) if len(df) > 0 else 0.0,
+        'prix_max_global': float(df['prix'].max()) if len(df) > 0 else 0.0,
+        'nombre_quartiers': int(df['quartier'].nunique()),
+        'nombre_types': int(df['type_depense'].nunique()),
+        'anomalies': nb_anomalies,
+    }
+
+    return {
+        'stats_quartier': stats_quartier,
+        'stats_type': stats_type,
+        'stats_globales': stats_globales,
+        'graphs': graphs,
+    }
+
+
+def _dashboard_graphs(serie, mediane_globale, stats_quartier, stats_type, box_stats):
+    """
+    Les quatre graphiques du dashboard, à partir de résultats déjà agrégés :
+    série `price_series`, tableaux par quartier et par type, statistiques de
+    boîte (`Axes.bxp`). Le coût ne dépend pas du nombre de dépenses.
+    """
     graphs = {}
+    # Formatter pour axes (espaces pour milliers)
+    thousands_formatter = FuncFormatter(lambda x, pos: f"{int(x):,}".replace(',', ' '))
 
     # 1. Série temporelle des prix moyens (avec rolling mean et médiane globale)
-    time_series = df.groupby(df['date'].dt.date)['prix'].mean().reset_index()
-    time_series['date'] = pd.to_datetime(time_series['date'])
-    if len(time_series) > 1:
-        time_series['rolling7'] = time_series['prix'].rolling(window=min(7, len(time_series)), center=True).mean()
+    # Résolution jour/semaine/mois selon l'étendue, puis réduction LTTB : tracé borné
+    time_series, resolution, rolling_label = serie
+    marker = 'o' if len(time_series) <= 60 else None
 
     fig, ax = plt.subplots(figsize=(14, 7))
-    ax.plot(time_series['date'], time_series['prix'], marker='o', linewidth=2.5, markersize=6, color='#1f77b4', label='Prix moyen (jour)')
-    if 'rolling7' in time_series:
-        ax.plot(time_series['date'], time_series['rolling7'], linewidth=2, color='#ff7f0e', label='Moyenne mobile (7j)')
-    mediane_globale = float(df['prix'].median()) if not pd.isna(df['prix'].median()) else 0.0
+    ax.plot(time_series['date'], time_series['prix'], marker=marker, linewidth=2.5, markersize=6, color='#1f77b4', label=f'Prix moyen ({resolution})')
+    if 'rolling' in time_series:
+        ax.plot(time_series['date'], time_series['rolling'], linewidth=2, color='#ff7f0e', label=f'Moyenne mobile ({rolling_label})')
     ax.axhline(mediane_globale, color='#7b3294', linestyle='--', linewidth=1.5, label=f'Médiane globale {mediane_globale:.0f} FCFA')
 
     ax.set_title('Évolution des prix moyens dans le temps', fontsize=18, fontweight='bold', pad=20)
@@ -259,15 +398,14 @@ def dashboard(request):
     plt.close()
 
     # 2. Graphique par quartier (moyennes + médianes annotées)
-    quartier_stats = df.groupby('quartier')['prix'].agg(['mean', 'median', 'count']).reset_index()
-    quartier_stats = quartier_stats.sort_values('mean', ascending=False).reset_index(drop=True)
-    quartier_stats['quartier_label'] = quartier_stats['quartier'].apply(get_quartier_label)
+    quartier_stats = pd.DataFrame(sorted(stats_quartier, key=lambda s: s['moyenne'], reverse=True),
+                                  columns=['quartier_label', 'moyenne', 'mediane'])
 
     fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(16, 7))
     # Use main brand color for bars; keep viridis for boxplots later
     main_color = '#1f77b4'
 
-    bars1 = ax1.bar(range(len(quartier_stats)), quartier_stats['mean'], color=main_color, alpha=0.95, edgecolor='white', linewidth=1.2)
+    bars1 = ax1.bar(range(len(quartier_stats)), quartier_stats['moyenne'], color=main_color, alpha=0.95, edgecolor='white', linewidth=1.2)
     ax1.set_xticks(range(len(quartier_stats)))
     ax1.set_xticklabels(quartier_stats['quartier_label'], rotation=45, ha='right')
     ax1.set_title('Prix moyens par quartier', fontweight='bold', fontsize=14, pad=15)
@@ -275,11 +413,11 @@ def dashboard(request):
     ax1.yaxis.set_major_formatter(thousands_formatter)
     ax1.grid(True, alpha=0.2, axis='y', linestyle='--')
     ax1.tick_params(axis='both', which='major', labelsize=10)
-    for bar, val in zip(bars1, quartier_stats['mean']):
+    for bar, val in zip(bars1, quartier_stats['moyenne']):
         ax1.text(bar.get_x() + bar.get_width()/2., val, f'{val:.0f}', ha='center', va='bottom', fontsize=10)
 
     # Medians panel using same brand color for consistency
-    bars2 = ax2.bar(range(len(quartier_stats)), quartier_stats['median'], color=main_color, alpha=0.95, edgecolor='white', linewidth=1.2)
+    bars2 = ax2.bar(range(len(quartier_stats)), quartier_stats['mediane'], color=main_color, alpha=0.95, edgecolor='white', linewidth=1.2)
     ax2.set_xticks(range(len(quartier_stats)))
     ax2.set_xticklabels(quartier_stats['quartier_label'], rotation=45, ha='right')
     ax2.set_title('Prix médians par quartier', fontweight='bold', fontsize=14, pad=15)
@@ -287,7 +425,7 @@ def dashboard(request):
     ax2.yaxis.set_major_formatter(thousands_formatter)
     ax2.grid(True, alpha=0.2, axis='y', linestyle='--')
     ax2.tick_params(axis='both', which='major', labelsize=10)
-    for bar, val in zip(bars2, quartier_stats['median']):
+    for bar, val in zip(bars2, quartier_stats['mediane']):
         ax2.text(bar.get_x() + bar.get_width()/2., val, f'{val:.0f}', ha='center', va='bottom', fontsize=10)
 
     plt.tight_layout()
@@ -298,14 +436,15 @@ def dashboard(request):
     plt.close()
 
     # 3. Graphique par type de dépense
-    type_stats = df.groupby('type_depense')['prix'].agg(['mean', 'median']).sort_values('mean', ascending=False)
-    type_labels = [get_type_depense_label(t) for t in type_stats.index]
+    type_stats = pd.DataFrame(sorted(stats_type, key=lambda s: s['moyenne'], reverse=True),
+                              columns=['type_label', 'moyenne', 'mediane'])
+    type_labels = list(type_stats['type_label'])
 
     fig, ax = plt.subplots(figsize=(12, 7))
     # Use brand color for type bars as well
     main_color = '#1f77b4'
     colors = plt.cm.Set3(np.linspace(0, 1, len(type_stats)))
-    bars = ax.bar(range(len(type_stats)), type_stats['mean'].values, color=main_color, alpha=0.95, edgecolor='white', linewidth=1.2)
+    bars = ax.bar(range(len(type_stats)), type_stats['moyenne'].values, color=main_color, alpha=0.95, edgecolor='white', linewidth=1.2)
     ax.set_xticks(range(len(type_stats)))
     ax.set_xticklabels(type_labels, rotation=45, ha='right')
     ax.set_title('Prix moyens par type de dépense', fontsize=14, fontweight='bold', pad=20)
@@ -314,7 +453,7 @@ def dashboard(request):
     ax.yaxis.set_major_formatter(thousands_formatter)
     ax.grid(True, alpha=0.2, axis='y', linestyle='--')
     ax.tick_params(axis='both', which='major', labelsize=10)
-    for bar, val in zip(bars, type_stats['mean'].values):
+    for bar, val in zip(bars, type_stats['moyenne'].values):
         ax.text(bar.get_x() + bar.get_width()/2., val, f'{val:.0f}', ha='center', va='bottom', fontsize=10)
 
     plt.tight_layout()
@@ -325,12 +464,8 @@ def dashboard(request):
     plt.close()
 
     # 4. Box plot par quartier (avec médiane annotée)
-    quartiers_list = df['quartier'].dropna().unique()
-    quartiers_labels = [get_quartier_label(q) for q in quartiers_list]
-    data_for_box = [df[df['quartier'] == q]['prix'].values for q in quartiers_list]
-
     fig, ax = plt.subplots(figsize=(14, 7))
-    bp = ax.boxplot(data_for_box, labels=quartiers_labels, patch_artist=True, showmeans=True, meanline=True)
+    bp = ax.bxp(box_stats, patch_artist=True, showmeans=True, meanline=True)
 
     # Color and style
     colors = plt.cm.viridis(np.linspace(0, 1, len(bp['boxes'])))
@@ -338,9 +473,8 @@ def dashboard(request):
         patch.set_facecolor(color)
         patch.set_alpha(0.75)
     # Annotate medians
-    medians = [np.median(d) if len(d) else 0 for d in data_for_box]
-    for i, m in enumerate(medians):
-        ax.text(i+1, m, f'{m:.0f}', ha='center', va='bottom', fontsize=9, fontweight='bold')
+    for i, stats in enumerate(box_stats):
+        ax.text(i+1, stats['med'], f"{stats['med']:.0f}", ha='center', va='bottom', fontsize=9, fontweight='bold')
 
     ax.set_title('Distribution des prix par quartier (Box Plot)', fontsize=16, fontweight='bold', pad=20)
     ax.set_xlabel('Quartier', fontsize=12, fontweight='bold')
@@ -357,352 +491,481 @@ def dashboard(request):
     graphs['boxplot'] = base64.b64encode(buf.read()).decode('utf-8')
     plt.close()
 
-    # Statistiques globales
-    stats_globales = {
-        'total_depenses': len(df),
-        'prix_moyen_global': float(df['prix'].mean()) if len(df) > 0 else 0.0,
-        'prix_median_global': float(df['prix'].median()) if len(df) > 0 else 0.0,
-        'prix_min_global': float(df['prix'].min()) if len(df) > 0 else 0.0,
-        'prix_max_global': float(df['prix'].max()) if len(df) > 0 else 0.0,
-        'nombre_quartiers': int(df['quartier'].nunique()),
-        'nombre_types': int(df['type_depense'].nunique()),
-        'anomalies': Depense.objects.exclude(anomalie='').count(),
-    }
-
-    return render(request, 'dashboard.html', {
-        'stats_quartier': stats_quartier,
-        'stats_type': stats_type,
-        'stats_globales': stats_globales,
-        'graphs': graphs,
-    })
+    return graphs
 
 
+@analytics_view
+@conditional_view
 def comparaison(request):
     """Page de comparaison interactive"""
-    quartiers = Depense.objects.values_list('quartier', flat=True).distinct()
-    types_depense = Depense.objects.values_list('type_depense', flat=True).distinct()
-    
+    context = coalesce('comparaison', request.GET, lambda: _comparaison_context(request.GET))
+    return render(request, 'comparaison.html', context)
+
+
+def _comparaison_context(params):
+    """Calcule le contexte de la page de comparaison pour les paramètres donnés"""
+    context = _comparaison_base_context(
+        Depense.objects.values_list('quartier', flat=True).distinct(),
+        Depense.objects.values_list('type_depense', flat=True).distinct(),
+    )
+    mode, querysets = _comparaison_querysets(params)
+    if mode == 'matrice':
+        # Une requête groupée : pas de mode approximatif nécessaire
+        context.update(_comparaison_matrice_resultats(_load_matrice(querysets['matrice']), params))
+        return context
+    if mode:
+        if approx_mode(params.get('approx', ''), Depense.objects.all()):
+            samples = {k: sample_frame(qs, ['prix']) for k, qs in querysets.items()}
+            if all(sample is not None for sample, _ in samples.values()):
+                context.update(_comparaison_approx_resultats(mode, samples, params))
+                return context
+        frames = {k: _load_prix_frame(qs) for k, qs in querysets.items()}
+        context.update(_comparaison_resultats(mode, frames, params))
+        if context.get('mode'):
+            context['significativite'] = _comparaison_significativite(mode, frames, params)
+    return context
+
+
+COMPARAISON_GROUPES = {
+    'quartier_vs_quartier': ('q1', 'q2'),
+    'quartier_vs_ville': ('quartier', 'ville'),
+    'campus_vs_env': ('campus', 'env'),
+}
+
+
+def _comparaison_significativite(mode, frames, params):
+    """
+    L'écart entre les deux groupes est-il réel ? IC bootstrap et test de
+    permutation sur la moyenne et la médiane (mis en cache avec les données).
+    """
+    a, b = COMPARAISON_GROUPES[mode]
+    resultat = cached_compare_groups(frames[a]['prix'].to_numpy(dtype=float), frames[b]['prix'].to_numpy(dtype=float))
+    if not resultat:
+        return None
+    groupes = {
+        'quartier_vs_quartier': (get_quartier_label(params.get('q1', '')), get_quartier_label(params.get('q2', ''))),
+        'quartier_vs_ville': (get_quartier_label(params.get('quartier', '')), 'Ville'),
+        'campus_vs_env': ('Campus', 'Environnement immédiat'),
+    }[mode]
+    return dict(resultat, groupes=groupes)
+
+
+def _comparaison_approx_resultats(mode, samples, params):
+    """Comparaison estimée sur l'échantillon réservoir (moyennes stratifiées avec IC, effectifs exacts)."""
+    frames = {k: weighted_resample(sample)[['prix']] for k, (sample, _) in samples.items()}
+    resultats = _comparaison_resultats(mode, frames, params)
+    if not resultats:
+        return resultats
+    for key, (sample, population) in samples.items():
+        stats = resultats[f'stats_{key}']
+        stats['moyenne'], stats['ic'] = stratified_mean(sample)
+        stats['nombre'] = population
+    if mode == 'quartier_vs_quartier':
+        m1, m2 = resultats['stats_q1']['moyenne'], resultats['stats_q2']['moyenne']
+        resultats['diff_moyenne'] = abs(m1 - m2)
+        resultats['plus_cher'] = params['q1'] if m1 > m2 else params['q2']
+    resultats['approx'] = {'echantillon': sum(len(sample) for sample, _ in samples.values())}
+    return resultats
+
+
+def _comparaison_base_context(quartiers, types_depense):
     # Ensure quartiers are presented sorted and non-empty
-    quartiers = [q for q in sorted(quartiers) if q]
-    
-    context = {
-        'quartiers': quartiers,
-        'types_depense': types_depense,
+    return {
+        'quartiers': [q for q in sorted(quartiers) if q],
+        'types_depense': list(types_depense),
+        'types_choices': Depense.TYPE_DEPENSE_CHOICES,
     }
-    
+
+
+def _param_list(params, name):
+    """Valeurs d'un paramètre répété (`?quartiers=a&quartiers=b`) ou séparées par des virgules."""
+    values = params.getlist(name) if hasattr(params, 'getlist') else [params.get(name, '')]
+    return [v.strip() for value in values for v in str(value).split(',') if v.strip()]
+
+
+def _matrice_selection(params):
+    types = dict(Depense.TYPE_DEPENSE_CHOICES)
+    return {
+        'quartiers': list(dict.fromkeys(_normalize_input(q) for q in _param_list(params, 'quartiers'))),
+        'types': [t for t in dict.fromkeys(_param_list(params, 'types')) if t in types],
+    }
+
+
+def _comparaison_querysets(params):
+    """Détermine le mode de comparaison et les querysets des deux groupes comparés"""
     # Comparaison Quartier vs Quartier
-    if request.GET.get('q1') and request.GET.get('q2'):
-        q1 = request.GET['q1']
-        q2 = request.GET['q2']
+    if params.get('q1') and params.get('q2'):
         # Normalize query input to match stored normalized values
-        def _norm(v):
-            if not v:
-                return v
-            import re
-            v = v.strip()
-            v = re.sub(r"[\-_]+", " ", v)
-            v = re.sub(r"\s+", " ", v)
-            return v.title()
-        q1_norm = _norm(q1)
-        q2_norm = _norm(q2)
-        
-        deps_q1 = Depense.objects.filter(quartier=q1_norm)
-        deps_q2 = Depense.objects.filter(quartier=q2_norm)
-        
-        if deps_q1.exists() and deps_q2.exists():
-            df_q1 = pd.DataFrame(list(deps_q1.values()))
-            df_q2 = pd.DataFrame(list(deps_q2.values()))
-            # Ensure price columns are numeric floats for plotting
-            df_q1['prix'] = df_q1['prix'].astype(float)
-            df_q2['prix'] = df_q2['prix'].astype(float)
-            stats_q1 = {
-                'quartier': q1,
-                'quartier_label': get_quartier_label(q1),
-                'moyenne': df_q1['prix'].mean(),
-                'mediane': df_q1['prix'].median(),
-                'min': df_q1['prix'].min(),
-                'max': df_q1['prix'].max(),
-                'nombre': len(df_q1),
-                'ecart_type': df_q1['prix'].std() if len(df_q1) > 1 else 0,
-            }
-            
-            stats_q2 = {
-                'quartier': q2,
-                'quartier_label': get_quartier_label(q2),
-                'moyenne': df_q2['prix'].mean(),
-                'mediane': df_q2['prix'].median(),
-                'min': df_q2['prix'].min(),
-                'max': df_q2['prix'].max(),
-                'nombre': len(df_q2),
-                'ecart_type': df_q2['prix'].std() if len(df_q2) > 1 else 0,
-            }
-            
-            # Graphique de comparaison
-            fig, axes = plt.subplots(1, 2, figsize=(16, 7))
-            
-            # Graphique en barres
-            categories = ['Moyenne', 'Médiane', 'Min', 'Max']
-            valeurs_q1 = [stats_q1['moyenne'], stats_q1['mediane'], stats_q1['min'], stats_q1['max']]
-            valeurs_q2 = [stats_q2['moyenne'], stats_q2['mediane'], stats_q2['min'], stats_q2['max']]
-            
-            x = np.arange(len(categories))
-            width = 0.35
-            
-            q1_label = get_quartier_label(q1)
-            q2_label = get_quartier_label(q2)
-            
-            bars1 = axes[0].bar(x - width/2, valeurs_q1, width, label=q1_label, 
-                                alpha=0.8, color='#4facfe', edgecolor='white', linewidth=2)
-            bars2 = axes[0].bar(x + width/2, valeurs_q2, width, label=q2_label, 
-                                alpha=0.8, color='#f5576c', edgecolor='white', linewidth=2)
-            
-            # Ajouter les valeurs sur les barres
-            for bars in [bars1, bars2]:
-                for bar in bars:
-                    height = bar.get_height()
-                    axes[0].text(bar.get_x() + bar.get_width()/2., height,
-                                f'{height:.0f}',
-                                ha='center', va='bottom', fontsize=9, fontweight='bold')
-            
-            axes[0].set_xlabel('Statistiques', fontsize=12, fontweight='bold')
-            axes[0].set_ylabel('Prix (FCFA)', fontsize=12, fontweight='bold')
-            axes[0].set_title('Comparaison Quartier vs Quartier', fontweight='bold', fontsize=14, pad=15)
-            axes[0].set_xticks(x)
-            axes[0].set_xticklabels(categories, fontsize=11)
-            axes[0].legend(fontsize=11, loc='upper left')
-            axes[0].grid(True, alpha=0.3, axis='y', linestyle='--')
-            axes[0].spines['top'].set_visible(False)
-            axes[0].spines['right'].set_visible(False)
-            
-            # Box plot comparatif
-            data_for_box = [df_q1['prix'].values, df_q2['prix'].values]
-            bp = axes[1].boxplot(data_for_box, labels=[q1_label, q2_label], 
-                                patch_artist=True, showmeans=True, meanline=True)
-            
-            # Colorier les box plots
-            colors_box = ['#4facfe', '#f5576c']
-            for patch, color in zip(bp['boxes'], colors_box):
-                patch.set_facecolor(color)
-                patch.set_alpha(0.7)
-            
-            axes[1].set_ylabel('Prix (FCFA)', fontsize=12, fontweight='bold')
-            axes[1].set_title('Distribution des prix', fontweight='bold', fontsize=14, pad=15)
-            axes[1].grid(True, alpha=0.3, axis='y', linestyle='--')
-            axes[1].spines['top'].set_visible(False)
-            axes[1].spines['right'].set_visible(False)
-            
-            plt.tight_layout()
-            buf = BytesIO()
-            plt.savefig(buf, format='png', dpi=120, bbox_inches='tight', facecolor='white')
-            buf.seek(0)
-            graph_comparaison = base64.b64encode(buf.read()).decode('utf-8')
-            plt.close()
-            
-            # Calcul de la différence
-            diff_moyenne = abs(stats_q1['moyenne'] - stats_q2['moyenne'])
-            plus_cher = q1 if stats_q1['moyenne'] > stats_q2['moyenne'] else q2
-            
-            context.update({
-                'mode': 'quartier_vs_quartier',
-                'stats_q1': stats_q1,
-                'stats_q2': stats_q2,
-                'graph_comparaison': graph_comparaison,
-                'diff_moyenne': diff_moyenne,
-                'plus_cher': plus_cher,
-            })
-    
+        return 'quartier_vs_quartier', {
+            'q1': Depense.objects.filter(quartier=_normalize_input(params['q1'])),
+            'q2': Depense.objects.filter(quartier=_normalize_input(params['q2'])),
+        }
+
     # Comparaison Quartier vs Ville (moyenne globale)
-    elif request.GET.get('mode') == 'quartier_ville' and request.GET.get('quartier'):
-        quartier = request.GET['quartier']
-        # Normalize quartier input
-        import re
-        quartier_norm = quartier.strip()
-        quartier_norm = re.sub(r"[\-_]+", " ", quartier_norm)
-        quartier_norm = re.sub(r"\s+", " ", quartier_norm).title()
-        deps_quartier = Depense.objects.filter(quartier=quartier_norm)
-        deps_ville = Depense.objects.all()
-        
-        if deps_quartier.exists() and deps_ville.exists():
-            df_quartier = pd.DataFrame(list(deps_quartier.values()))
-            df_ville = pd.DataFrame(list(deps_ville.values()))
-            
-            stats_quartier = {
-                'quartier': quartier,
-                'quartier_label': get_quartier_label(quartier),
-                'moyenne': df_quartier['prix'].mean(),
-                'mediane': df_quartier['prix'].median(),
-                'min': df_quartier['prix'].min(),
-                'max': df_quartier['prix'].max(),
-                'nombre': len(df_quartier),
-            }
-            
-            stats_ville = {
-                'moyenne': df_ville['prix'].mean(),
-                'mediane': df_ville['prix'].median(),
-                'min': df_ville['prix'].min(),
-                'max': df_ville['prix'].max(),
-                'nombre': len(df_ville),
-            }
-            
-            # Graphique
-            quartier_label = get_quartier_label(quartier)
-            fig, ax = plt.subplots(figsize=(12, 7))
-            categories = ['Moyenne', 'Médiane', 'Min', 'Max']
-            valeurs_quartier = [stats_quartier['moyenne'], stats_quartier['mediane'], 
-                               stats_quartier['min'], stats_quartier['max']]
-            valeurs_ville = [stats_ville['moyenne'], stats_ville['mediane'], 
-                            stats_ville['min'], stats_ville['max']]
-            
-            x = np.arange(len(categories))
-            width = 0.35
-            
-            bars1 = ax.bar(x - width/2, valeurs_quartier, width, label=quartier_label, 
-                          alpha=0.8, color='#4facfe', edgecolor='white', linewidth=2)
-            bars2 = ax.bar(x + width/2, valeurs_ville, width, label='Ville (moyenne)', 
-                          alpha=0.8, color='#f5576c', edgecolor='white', linewidth=2)
-            
-            # Ajouter les valeurs sur les barres
-            for bars in [bars1, bars2]:
-                for bar in bars:
-                    height = bar.get_height()
-                    ax.text(bar.get_x() + bar.get_width()/2., height,
-                            f'{height:.0f}',
-                            ha='center', va='bottom', fontsize=10, fontweight='bold')
-            
-            ax.set_xlabel('Statistiques', fontsize=12, fontweight='bold')
-            ax.set_ylabel('Prix (FCFA)', fontsize=12, fontweight='bold')
-            ax.set_title(f'Comparaison {quartier_label} vs Ville', fontweight='bold', fontsize=16, pad=20)
-            ax.set_xticks(x)
-            ax.set_xticklabels(categories, fontsize=11)
-            ax.legend(fontsize=12, loc='upper left')
-            ax.grid(True, alpha=0.3, axis='y', linestyle='--')
-            ax.spines['top'].set_visible(False)
-            ax.spines['right'].set_visible(False)
-            
-            plt.tight_layout()
-            buf = BytesIO()
-            plt.savefig(buf, format='png', dpi=120, bbox_inches='tight', facecolor='white')
-            buf.seek(0)
-            graph_comparaison = base64.b64encode(buf.read()).decode('utf-8')
-            plt.close()
-            
-            context.update({
-                'mode': 'quartier_vs_ville',
-                'stats_quartier': stats_quartier,
-                'stats_ville': stats_ville,
-                'graph_comparaison': graph_comparaison,
-            })
-    
+    if params.get('mode') == 'quartier_ville' and params.get('quartier'):
+        return 'quartier_vs_ville', {
+            'quartier': Depense.objects.filter(quartier=_normalize_input(params['quartier'])),
+            'ville': Depense.objects.all(),
+        }
+
     # Comparaison Campus vs Environnement immédiat
-    elif request.GET.get('mode') == 'campus_env':
+    if params.get('mode') == 'campus_env':
         # Use optional campus param or default to 'Campus'
-        campus_param = request.GET.get('campus')
-        if campus_param:
-            campus_norm = _normalize_input(campus_param)
-        else:
-            campus_norm = _normalize_input('campus')
-        deps_campus = Depense.objects.filter(quartier=campus_norm)
-        deps_env = Depense.objects.exclude(quartier=campus_norm)
-
-        if deps_campus.exists() and deps_env.exists():
-            df_campus = pd.DataFrame(list(deps_campus.values()))
-            df_env = pd.DataFrame(list(deps_env.values()))
-            # Convert prix to float for numeric operations
-            df_campus['prix'] = df_campus['prix'].astype(float)
-            df_env['prix'] = df_env['prix'].astype(float)
-
-            stats_campus = {
-                'moyenne': df_campus['prix'].mean(),
-                'mediane': df_campus['prix'].median(),
-                'min': df_campus['prix'].min(),
-                'max': df_campus['prix'].max(),
-                'nombre': len(df_campus),
-            }
-
-            stats_env = {
-                'moyenne': df_env['prix'].mean(),
-                'mediane': df_env['prix'].median(),
-                'min': df_env['prix'].min(),
-                'max': df_env['prix'].max(),
-                'nombre': len(df_env),
-            }
-            
-            # Graphique
-            fig, ax = plt.subplots(figsize=(12, 7))
-            categories = ['Moyenne', 'Médiane', 'Min', 'Max']
-            valeurs_campus = [stats_campus['moyenne'], stats_campus['mediane'], 
-                             stats_campus['min'], stats_campus['max']]
-            valeurs_env = [stats_env['moyenne'], stats_env['mediane'], 
-                          stats_env['min'], stats_env['max']]
-            
-            x = np.arange(len(categories))
-            width = 0.35
-            
-            bars1 = ax.bar(x - width/2, valeurs_campus, width, label='Campus', 
-                          alpha=0.8, color='#f39c12', edgecolor='white', linewidth=2)
-            bars2 = ax.bar(x + width/2, valeurs_env, width, label='Environnement immédiat', 
-                          alpha=0.8, color='#6c757d', edgecolor='white', linewidth=2)
-            
-            # Ajouter les valeurs sur les barres
-            for bars in [bars1, bars2]:
-                for bar in bars:
-                    height = bar.get_height()
-                    ax.text(bar.get_x() + bar.get_width()/2., height,
+        campus_norm = _normalize_input(params.get('campus') or 'campus')
+        return 'campus_vs_env', {
+            'campus': Depense.objects.filter(quartier=campus_norm),
+            'env': Depense.objects.exclude(quartier=campus_norm),
+        }
+
+    # Matrice : N quartiers (tous par défaut), types au choix
+    if params.get('mode') == 'matrice':
+        selection = _matrice_selection(params)
+        qs = Depense.objects.all()
+        if selection['quartiers']:
+            qs = qs.filter(quartier__in=selection['quartiers'])
+        if selection['types']:
+            qs = qs.filter(type_depense__in=selection['types'])
+        return 'matrice', {'matrice': qs}
+
+    return None, {}
+
+
+def _load_matrice(qs):
+    return cell_partials(qs)
+
+
+MATRICE_MAX_QUARTIERS = 40
+MATRICE_MAX_PAIRES = 100
+
+
+def _comparaison_matrice_resultats(cells, params):
+    """
+    Matrice quartiers × types (aucun accès base de données) : heatmap des
+    prix moyens et classement des écarts de moyenne entre quartiers.
+    """
+    selection = _matrice_selection(params)
+    if not cells:
+        return {'mode': 'matrice', 'matrice_selection': selection}
+    # Au-delà de MATRICE_MAX_QUARTIERS, les quartiers les plus renseignés
+    effectifs = defaultdict(int)
+    for (quartier, _), p in cells.items():
+        effectifs[quartier] += p['n']
+    gardes = set(sorted(effectifs, key=lambda q: (-effectifs[q], q))[:MATRICE_MAX_QUARTIERS])
+    quartiers, types, moyennes, nombres, totaux = matrix_stats(
+        {k: p for k, p in cells.items() if k[0] in gardes})
+    stats = [{'quartier': q, 'quartier_label': get_quartier_label(q), **t} for q, t in zip(quartiers, totaux)]
+
+    # Heatmap : une colonne par type, plus l'ensemble des types retenus
+    valeurs = np.column_stack([moyennes, [t['moyenne'] for t in totaux]])
+    colonnes = [get_type_depense_label(t) for t in types] + ['Ensemble']
+    lignes = [s['quartier_label'] for s in stats]
+    fig, ax = plt.subplots(figsize=(max(8, 1.4 * len(colonnes) + 3), max(4, 0.55 * len(lignes) + 2)))
+    image = ax.imshow(np.ma.masked_invalid(valeurs), cmap='YlOrRd', aspect='auto')
+    fig.colorbar(image, ax=ax, label='Prix moyen (FCFA)')
+    limite = np.nanmax(valeurs) * 0.6 if np.isfinite(valeurs).any() else 0
+    for i in range(valeurs.shape[0]):
+        for j in range(valeurs.shape[1]):
+            if np.isfinite(valeurs[i, j]):
+                n = nombres[i, j] if j < len(types) else totaux[i]['nombre']
+                ax.text(j, i, f"{valeurs[i, j]:.0f}\n(n={n})", ha='center', va='center', fontsize=8,
+                        color='white' if valeurs[i, j] > limite else 'black')
+    ax.set_xticks(range(len(colonnes)))
+    ax.set_xticklabels(colonnes, rotation=45, ha='right')
+    ax.set_yticks(range(len(lignes)))
+    ax.set_yticklabels(lignes)
+    ax.axvline(len(types) - 0.5, color='white', linewidth=3)
+    ax.set_title('Prix moyens par quartier et type de dépense', fontsize=14, fontweight='bold', pad=15)
+    plt.tight_layout()
+    buf = BytesIO()
+    plt.savefig(buf, format='png', dpi=120, bbox_inches='tight', facecolor='white')
+    buf.seek(0)
+    graph_matrice = base64.b64encode(buf.read()).decode('utf-8')
+    plt.close()
+
+    paires = pairwise_differences(totaux)
+    for paire in paires:
+        paire['a'], paire['b'] = stats[paire['a']], stats[paire['b']]
+    return {
+        'mode': 'matrice',
+        'matrice_selection': selection,
+        'matrice_stats': stats,
+        'matrice_paires': paires[:MATRICE_MAX_PAIRES],
+        'matrice_nb_paires': len(paires),
+        'matrice_tronquee': len(effectifs) > len(gardes),
+        'graph_matrice': graph_matrice,
+    }
+
+
+def _load_prix_frame(qs):
+    """Charge uniquement la colonne prix d'un queryset, convertie en float"""
+    df = pd.DataFrame(list(qs.values('prix')), columns=['prix'])
+    df['prix'] = df['prix'].astype(float)
+    return df
+
+
+def _comparaison_resultats(mode, frames, params):
+    """Statistiques et graphique d'une comparaison (aucun accès base de données)"""
+    if any(df.empty for df in frames.values()):
+        return {}
+
+    if mode == 'quartier_vs_quartier':
+        q1 = params['q1']
+        q2 = params['q2']
+        df_q1 = frames['q1']
+        df_q2 = frames['q2']
+        stats_q1 = {
+            'quartier': q1,
+            'quartier_label': get_quartier_label(q1),
+            'moyenne': df_q1['prix'].mean(),
+            'mediane': df_q1['prix'].median(),
+            'min': df_q1['prix'].min(),
+            'max': df_q1['prix'].max(),
+            'nombre': len(df_q1),
+            'ecart_type': df_q1['prix'].std() if len(df_q1) > 1 else 0,
+        }
+        
+        stats_q2 = {
+            'quartier': q2,
+            'quartier_label': get_quartier_label(q2),
+            'moyenne': df_q2['prix'].mean(),
+            'mediane': df_q2['prix'].median(),
+            'min': df_q2['prix'].min(),
+            'max': df_q2['prix'].max(),
+            'nombre': len(df_q2),
+            'ecart_type': df_q2['prix'].std() if len(df_q2) > 1 else 0,
+        }
+        
+        # Graphique de comparaison
+        fig, axes = plt.subplots(1, 2, figsize=(16, 7))
+        
+        # Graphique en barres
+        categories = ['Moyenne', 'Médiane', 'Min', 'Max']
+        valeurs_q1 = [stats_q1['moyenne'], stats_q1['mediane'], stats_q1['min'], stats_q1['max']]
+        valeurs_q2 = [stats_q2['moyenne'], stats_q2['mediane'], stats_q2['min'], stats_q2['max']]
+        
+        x = np.arange(len(categories))
+        width = 0.35
+        
+        q1_label = get_quartier_label(q1)
+        q2_label = get_quartier_label(q2)
+        
+        bars1 = axes[0].bar(x - width/2, valeurs_q1, width, label=q1_label, 
+                            alpha=0.8, color='#4facfe', edgecolor='white', linewidth=2)
+        bars2 = axes[0].bar(x + width/2, valeurs_q2, width, label=q2_label, 
+                            alpha=0.8, color='#f5576c', edgecolor='white', linewidth=2)
+        
+        # Ajouter les valeurs sur les barres
+        for bars in [bars1, bars2]:
+            for bar in bars:
+                height = bar.get_height()
+                axes[0].text(bar.get_x() + bar.get_width()/2., height,
                             f'{height:.0f}',
-                            ha='center', va='bottom', fontsize=10, fontweight='bold')
-            
-            ax.set_xlabel('Statistiques', fontsize=12, fontweight='bold')
-            ax.set_ylabel('Prix (FCFA)', fontsize=12, fontweight='bold')
-            ax.set_title('Comparaison Campus vs Environnement immédiat', 
-                        fontweight='bold', fontsize=16, pad=20)
-            ax.set_xticks(x)
-            ax.set_xticklabels(categories, fontsize=11)
-            ax.legend(fontsize=12, loc='upper left')
-            ax.grid(True, alpha=0.3, axis='y', linestyle='--')
-            ax.spines['top'].set_visible(False)
-            ax.spines['right'].set_visible(False)
-            
-            plt.tight_layout()
-            buf = BytesIO()
-            plt.savefig(buf, format='png', dpi=120, bbox_inches='tight', facecolor='white')
-            buf.seek(0)
-            graph_comparaison = base64.b64encode(buf.read()).decode('utf-8')
-            plt.close()
-            
-            context.update({
-                'mode': 'campus_vs_env',
-                'stats_campus': stats_campus,
-                'stats_env': stats_env,
-                'graph_comparaison': graph_comparaison,
-            })
-    
-    return render(request, 'comparaison.html', context)
+                            ha='center', va='bottom', fontsize=9, fontweight='bold')
+        
+        axes[0].set_xlabel('Statistiques', fontsize=12, fontweight='bold')
+        axes[0].set_ylabel('Prix (FCFA)', fontsize=12, fontweight='bold')
+        axes[0].set_title('Comparaison Quartier vs Quartier', fontweight='bold', fontsize=14, pad=15)
+        axes[0].set_xticks(x)
+        axes[0].set_xticklabels(categories, fontsize=11)
+        axes[0].legend(fontsize=11, loc='upper left')
+        axes[0].grid(True, alpha=0.3, axis='y', linestyle='--')
+        axes[0].spines['top'].set_visible(False)
+        axes[0].spines['right'].set_visible(False)
+        
+        # Box plot comparatif
+        box_stats = [box_summary(df_q1['prix'].to_numpy(), q1_label), box_summary(df_q2['prix'].to_numpy(), q2_label)]
+        bp = axes[1].bxp(box_stats, patch_artist=True, showmeans=True, meanline=True)
+        
+        # Colorier les box plots
+        colors_box = ['#4facfe', '#f5576c']
+        for patch, color in zip(bp['boxes'], colors_box):
+            patch.set_facecolor(color)
+            patch.set_alpha(0.7)
+        
+        axes[1].set_ylabel('Prix (FCFA)', fontsize=12, fontweight='bold')
+        axes[1].set_title('Distribution des prix', fontweight='bold', fontsize=14, pad=15)
+        axes[1].grid(True, alpha=0.3, axis='y', linestyle='--')
+        axes[1].spines['top'].set_visible(False)
+        axes[1].spines['right'].set_visible(False)
+        
+        plt.tight_layout()
+        buf = BytesIO()
+        plt.savefig(buf, format='png', dpi=120, bbox_inches='tight', facecolor='white')
+        buf.seek(0)
+        graph_comparaison = base64.b64encode(buf.read()).decode('utf-8')
+        plt.close()
+        
+        # Calcul de la différence
+        diff_moyenne = abs(stats_q1['moyenne'] - stats_q2['moyenne'])
+        plus_cher = q1 if stats_q1['moyenne'] > stats_q2['moyenne'] else q2
+        
+        return {
+            'mode': 'quartier_vs_quartier',
+            'stats_q1': stats_q1,
+            'stats_q2': stats_q2,
+            'graph_comparaison': graph_comparaison,
+            'diff_moyenne': diff_moyenne,
+            'plus_cher': plus_cher,
+        }
+
+    if mode == 'quartier_vs_ville':
+        quartier = params['quartier']
+        df_quartier = frames['quartier']
+        df_ville = frames['ville']
+
+        stats_quartier = {
+            'quartier': quartier,
+            'quartier_label': get_quartier_label(quartier),
+            'moyenne': df_quartier['prix'].mean(),
+            'mediane': df_quartier['prix'].median(),
+            'min': df_quartier['prix'].min(),
+            'max': df_quartier['prix'].max(),
+            'nombre': len(df_quartier),
+        }
+        
+        stats_ville = {
+            'moyenne': df_ville['prix'].mean(),
+            'mediane': df_ville['prix'].median(),
+            'min': df_ville['prix'].min(),
+            'max': df_ville['prix'].max(),
+            'nombre': len(df_ville),
+        }
+        
+        # Graphique
+        quartier_label = get_quartier_label(quartier)
+        fig, ax = plt.subplots(figsize=(12, 7))
+        categories = ['Moyenne', 'Médiane', 'Min', 'Max']
+        valeurs_quartier = [stats_quartier['moyenne'], stats_quartier['mediane'], 
+                           stats_quartier['min'], stats_quartier['max']]
+        valeurs_ville = [stats_ville['moyenne'], stats_ville['mediane'], 
+                        stats_ville['min'], stats_ville['max']]
+        
+        x = np.arange(len(categories))
+        width = 0.35
+        
+        bars1 = ax.bar(x - width/2, valeurs_quartier, width, label=quartier_label, 
+                      alpha=0.8, color='#4facfe', edgecolor='white', linewidth=2)
+        bars2 = ax.bar(x + width/2, valeurs_ville, width, label='Ville (moyenne)', 
+                      alpha=0.8, color='#f5576c', edgecolor='white', linewidth=2)
+        
+        # Ajouter les valeurs sur les barres
+        for bars in [bars1, bars2]:
+            for bar in bars:
+                height = bar.get_height()
+                ax.text(bar.get_x() + bar.get_width()/2., height,
+                        f'{height:.0f}',
+                        ha='center', va='bottom', fontsize=10, fontweight='bold')
+        
+        ax.set_xlabel('Statistiques', fontsize=12, fontweight='bold')
+        ax.set_ylabel('Prix (FCFA)', fontsize=12, fontweight='bold')
+        ax.set_title(f'Comparaison {quartier_label} vs Ville', fontweight='bold', fontsize=16, pad=20)
+        ax.set_xticks(x)
+        ax.set_xticklabels(categories, fontsize=11)
+        ax.legend(fontsize=12, loc='upper left')
+        ax.grid(True, alpha=0.3, axis='y', linestyle='--')
+        ax.spines['top'].set_visible(False)
+        ax.spines['right'].set_visible(False)
+        
+        plt.tight_layout()
+        buf = BytesIO()
+        plt.savefig(buf, format='png', dpi=120, bbox_inches='tight', facecolor='white')
+        buf.seek(0)
+        graph_comparaison = base64.b64encode(buf.read()).decode('utf-8')
+        plt.close()
+        
+        return {
+            'mode': 'quartier_vs_ville',
+            'stats_quartier': stats_quartier,
+            'stats_ville': stats_ville,
+            'graph_comparaison': graph_comparaison,
+        }
+
+    if mode == 'campus_vs_env':
+        df_campus = frames['campus']
+        df_env = frames['env']
+
+        stats_campus = {
+            'moyenne': df_campus['prix'].mean(),
+            'mediane': df_campus['prix'].median(),
+            'min': df_campus['prix'].min(),
+            'max': df_campus['prix'].max(),
+            'nombre': len(df_campus),
+        }
+
+        stats_env = {
+            'moyenne': df_env['prix'].mean(),
+            'mediane': df_env['prix'].median(),
+            'min': df_env['prix'].min(),
+            'max': df_env['prix'].max(),
+            'nombre': len(df_env),
+        }
+        
+        # Graphique
+        fig, ax = plt.subplots(figsize=(12, 7))
+        categories = ['Moyenne', 'Médiane', 'Min', 'Max']
+        valeurs_campus = [stats_campus['moyenne'], stats_campus['mediane'], 
+                         stats_campus['min'], stats_campus['max']]
+        valeurs_env = [stats_env['moyenne'], stats_env['mediane'], 
+                      stats_env['min'], stats_env['max']]
+        
+        x = np.arange(len(categories))
+        width = 0.35
+        
+        bars1 = ax.bar(x - width/2, valeurs_campus, width, label='Campus', 
+                      alpha=0.8, color='#f39c12', edgecolor='white', linewidth=2)
+        bars2 = ax.bar(x + width/2, valeurs_env, width, label='Environnement immédiat', 
+                      alpha=0.8, color='#6c757d', edgecolor='white', linewidth=2)
+        
+        # Ajouter les valeurs sur les barres
+        for bars in [bars1, bars2]:
+            for bar in bars:
+                height = bar.get_height()
+                ax.text(bar.get_x() + bar.get_width()/2., height,
+                        f'{height:.0f}',
+                        ha='center', va='bottom', fontsize=10, fontweight='bold')
+        
+        ax.set_xlabel('Statistiques', fontsize=12, fontweight='bold')
+        ax.set_ylabel('Prix (FCFA)', fontsize=12, fontweight='bold')
+        ax.set_title('Comparaison Campus vs Environnement immédiat', 
+                    fontweight='bold', fontsize=16, pad=20)
+        ax.set_xticks(x)
+        ax.set_xticklabels(categories, fontsize=11)
+        ax.legend(fontsize=12, loc='upper left')
+        ax.grid(True, alpha=0.3, axis='y', linestyle='--')
+        ax.spines['top'].set_visible(False)
+        ax.spines['right'].set_visible(False)
+        
+        plt.tight_layout()
+        buf = BytesIO()
+        plt.savefig(buf, format='png', dpi=120, bbox_inches='tight', facecolor='white')
+        buf.seek(0)
+        graph_comparaison = base64.b64encode(buf.read()).decode('utf-8')
+        plt.close()
+        
+        return {
+            'mode': 'campus_vs_env',
+            'stats_campus': stats_campus,
+            'stats_env': stats_env,
+            'graph_comparaison': graph_comparaison,
+        }
+
+    return {}
 
 
+@analytics_view
+@conditional_view
 def anomalies(request):
     """Page de visualisation des anomalies détectées"""
     # Apply optional filters to anomalies view as well
-    anomalies_list = _apply_filters(Depense.objects.exclude(anomalie='').order_by('-date_creation'), request.GET)
-
-    # Statistiques sur les anomalies
-    total_anomalies = anomalies_list.count()
-    auto_anomalies = anomalies_list.filter(anomalie__startswith='[AUTO]').count()
-    manuelles_anomalies = total_anomalies - auto_anomalies
-
-    # Anomalies par type
-    anomalies_par_type = {}
-    for dep in anomalies_list:
-        if dep.anomalie.startswith('[AUTO]'):
-            if 'Doublon' in dep.anomalie:
-                type_anomalie = 'Doublon'
-            elif 'Valeur aberrante' in dep.anomalie:
-                type_anomalie = 'Valeur aberrante'
-            else:
-                type_anomalie = 'Autre'
-        else:
-            type_anomalie = 'Manuelle'
+    anomalies_list = _apply_filters(Depense.objects.exclude(anomalie_kind='').order_by('-date_creation'), request.GET)
 
-        anomalies_par_type[type_anomalie] = anomalies_par_type.get(type_anomalie, 0) + 1
+    # Anomalies par type et totaux : une seule requête GROUP BY sur la colonne indexée
+    par_kind = dict(anomalies_list.order_by().values_list('anomalie_kind').annotate(n=Count('id')))
+    labels = dict(Depense.ANOMALIE_KIND_CHOICES)
+    anomalies_par_type = {labels.get(kind, kind): n for kind, n in sorted(par_kind.items())}
+    total_anomalies = sum(par_kind.values())
+    manuelles_anomalies = par_kind.get(Depense.KIND_MANUELLE, 0)
+    auto_anomalies = total_anomalies - manuelles_anomalies
 
     context = {
         'anomalies': anomalies_list,
@@ -725,6 +988,9 @@ def _normalize_input(val: str) -> str:
     return v.title()
 
 
+FILTER_PARAMS = ('quartier', 'type', 'anomalie', 'month', 'prix_min', 'prix_max')
+
+
 def _apply_filters(queryset, params):
     quartier_filter = params.get('quartier', '')
     type_filter = params.get('type', '')
@@ -764,6 +1030,7 @@ def _apply_filters(queryset, params):
     return queryset
 
 
+@conditional_view
 def liste_depenses(request):
     """Page de liste des dépenses avec filtres"""
     depenses = Depense.objects.all().order_by('-date')
@@ -798,67 +1065,72 @@ def liste_depenses(request):
     return render(request, 'liste_depenses.html', context)
 
 
+def _export_filename(prefix, extension='csv'):
+    # Le nom de la ville distingue les exports d'un déploiement multi-villes
+    city = current_city()
+    city_part = f"{city}_" if city else ''
+    return f"{prefix}_{city_part}{timezone.now().strftime('%Y%m%d_%H%M%S')}.{extension}"
+
+
+def _has_filters(params):
+    return any(params.get(name) for name in FILTER_PARAMS)
+
+
+def export_depenses_rows(queryset=None):
+    """Lignes de l'export des dépenses (aussi utilisé par l'archive nocturne)."""
+    queryset = Depense.objects.all() if queryset is None else queryset
+    return depense_rows(queryset.order_by('-date'), DEPENSE_COLUMNS)
+
+
+@analytics_view
+@conditional_view
 def export_csv(request):
-    """Export filtered dépenses as CSV"""
-    qs = _apply_filters(Depense.objects.all().order_by('-date'), request.GET)
-    import csv
-    from django.utils import timezone
-    filename = f"depenses_{timezone.now().strftime('%Y%m%d_%H%M%S')}.csv"
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = f'attachment; filename="{filename}"'
-    writer = csv.writer(response)
-    writer.writerow(['date', 'type', 'quartier', 'lieu', 'prix', 'commentaire', 'anomalie'])
-    for d in qs:
-        writer.writerow([
-            d.date.strftime('%Y-%m-%d'),
-            d.get_type_depense_display(),
-            d.quartier,
-            d.lieu,
-            float(d.prix),
-            d.commentaire or '',
-            d.anomalie or '',
-        ])
-    return response
+    """Export filtered dépenses (?format=csv|ndjson|parquet|xlsx)"""
+    if not _has_filters(request.GET) and request.GET.get('format', 'csv') == 'csv':
+        # Export complet : archive compressée pré-construite (manage.py build_export_archive),
+        # seulement si les données n'ont pas changé depuis sa construction
+        archived = archived_response(request, 'depenses', current_city(), _export_filename('depenses'),
+                                     state=state_token(data_state()))
+        if archived is not None:
+            return archived
+    qs = _apply_filters(Depense.objects.all(), request.GET)
+    return export_response(request, lambda ext: _export_filename('depenses', ext),
+                           DEPENSE_COLUMNS, export_depenses_rows(qs))
 
 
+@analytics_view
+@conditional_view
+def export_zip(request):
+    """Export filtered dépenses with their justification photos (ZIP, streamed)"""
+    qs = _apply_filters(Depense.objects.all(), request.GET).order_by('-date')
+    return depenses_zip_response(qs, _export_filename('depenses', 'zip'))
+
+
+ANOMALIES_COLUMNS = [DEPENSE_COLUMNS[i] for i in (0, 1, 2, 3, 4, 6, 5)]
+
+
+@analytics_view
+@conditional_view
 def export_anomalies_csv(request):
-    """Export filtered anomalies as CSV"""
-    qs = _apply_filters(Depense.objects.exclude(anomalie='').order_by('-date_creation'), request.GET)
-    import csv
-    from django.utils import timezone
-    filename = f"anomalies_{timezone.now().strftime('%Y%m%d_%H%M%S')}.csv"
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = f'attachment; filename="{filename}"'
-    writer = csv.writer(response)
-    writer.writerow(['date', 'type', 'quartier', 'lieu', 'prix', 'anomalie', 'commentaire'])
-    for d in qs:
-        writer.writerow([
-            d.date.strftime('%Y-%m-%d'),
-            d.get_type_depense_display(),
-            d.quartier,
-            d.lieu,
-            float(d.prix),
-            d.anomalie or '',
-            d.commentaire or '',
-        ])
-    return response
+    """Export filtered anomalies (?format=csv|ndjson|parquet|xlsx)"""
+    qs = _apply_filters(Depense.objects.exclude(anomalie_kind='').order_by('-date_creation'), request.GET)
+    return export_response(request, lambda ext: _export_filename('anomalies', ext),
+                           ANOMALIES_COLUMNS, depense_rows(qs, ANOMALIES_COLUMNS))
+
+
+COMPARAISON_COLUMNS = [('groupe', 'str'), *DEPENSE_COLUMNS]
 
 
+@analytics_view
+@conditional_view
 def export_comparaison_csv(request):
-    """Export the records used in a comparison as CSV with a 'groupe' column"""
-    import csv
-    from django.utils import timezone
+    """Export the records used in a comparison with a 'groupe' column (?format=csv|ndjson|parquet|xlsx)"""
     mode = request.GET.get('mode')
-    writer_rows = []
 
     if mode == 'quartier_ville':
         quartier = _normalize_input(request.GET.get('quartier', ''))
-        qs_quartier = Depense.objects.filter(quartier=quartier)
-        qs_ville = Depense.objects.all()
-        for d in qs_quartier:
-            writer_rows.append(('quartier', d))
-        for d in qs_ville:
-            writer_rows.append(('ville', d))
+        groupes = [('quartier', Depense.objects.filter(quartier=quartier)),
+                   ('ville', Depense.objects.all())]
     elif mode == 'campus_env':
         # accept explicit campus param or default to 'Campus'
         campus_param = request.GET.get('campus')
@@ -866,35 +1138,50 @@ def export_comparaison_csv(request):
             campus = _normalize_input(campus_param)
         else:
             campus = _normalize_input('campus')
-        qs_campus = Depense.objects.filter(quartier=campus)
-        qs_env = Depense.objects.exclude(quartier=campus)
-        for d in qs_campus:
-            writer_rows.append(('campus', d))
-        for d in qs_env:
-            writer_rows.append(('environnement', d))
+        groupes = [('campus', Depense.objects.filter(quartier=campus)),
+                   ('environnement', Depense.objects.exclude(quartier=campus))]
     else:
         # default: quartier_vs_quartier
         q1 = _normalize_input(request.GET.get('q1', ''))
         q2 = _normalize_input(request.GET.get('q2', ''))
-        qs = Depense.objects.filter(quartier__in=[q1, q2])
-        for d in qs:
-            grp = 'q1' if d.quartier == q1 else 'q2'
-            writer_rows.append((grp, d))
-
-    filename = f"comparaison_{timezone.now().strftime('%Y%m%d_%H%M%S')}.csv"
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = f'attachment; filename="{filename}"'
-    writer = csv.writer(response)
-    writer.writerow(['groupe', 'date', 'type', 'quartier', 'lieu', 'prix', 'commentaire', 'anomalie'])
-    for grp, d in writer_rows:
-        writer.writerow([
-            grp,
-            d.date.strftime('%Y-%m-%d'),
-            d.get_type_depense_display(),
-            d.quartier,
-            d.lieu,
-            float(d.prix),
-            d.commentaire or '',
-            d.anomalie or '',
-        ])
-    return response
+        groupes = [('q1', Depense.objects.filter(quartier=q1))]
+        if q2 != q1:
+            groupes.append(('q2', Depense.objects.filter(quartier=q2)))
+
+    rows = chain.from_iterable(depense_rows(qs, DEPENSE_COLUMNS, prefix=(grp,)) for grp, qs in groupes)
+    return export_response(request, lambda ext: _export_filename('comparaison', ext), COMPARAISON_COLUMNS, rows)
+
+
+def comparaison_villes(request):
+    """Comparaison inter-villes : agrégats partiels calculés en parallèle sur chaque base puis fusionnés"""
+    villes = cities()
+    if not villes:
+        return render(request, 'comparaison_villes.html', {
+            'message': 'Aucune ville configurée (ECOTRACK_CITIES).',
+        })
+
+    partiels = fan_out(partial_aggregates, villes.values())
+
+    stats_villes = []
+    par_type = defaultdict(list)
+    for ville, alias in villes.items():
+        partiel = partiels[alias]
+        for typ, agg in partiel.items():
+            par_type[typ].append(agg)
+        stats_villes.append({
+            'ville': ville,
+            'ville_label': city_label(ville),
+            **finalize(merge_partials(partiel.values())),
+        })
+
+    stats_type = [
+        {'type': typ, 'type_label': get_type_depense_label(typ), **finalize(merge_partials(parts))}
+        for typ, parts in sorted(par_type.items())
+    ]
+    stats_globales = finalize(merge_partials(agg for parts in par_type.values() for agg in parts))
+
+    return render(request, 'comparaison_villes.html', {
+        'stats_villes': stats_villes,
+        'stats_type': stats_type,
+        'stats_globales': stats_globales,
+    })
@@ -0,0 +1,193 @@
+"""
+Versions asynchrones des pages d'accueil, dashboard et comparaison.
+
+Servies sous ASGI (uvicorn) quand ECOTRACK_ASYNC_VIEWS est activé : les
+requêtes indépendantes partent en parallèle via `asyncio.gather`, et le
+calcul pandas/matplotlib est déporté dans un exécuteur pour ne pas bloquer
+la boucle d'événements.
+
+Les requêtes simultanées d'une même page sont regroupées sur la boucle
+d'événements (un `asyncio.Future` par clé) : seule la première entre dans
+`coalesce()`, dont l'attente des verrous occupe un exécuteur dédié. Les
+threads de l'exécuteur par défaut restent libres pour les requêtes SQL du
+calcul.
+"""
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.db import close_old_connections
+from django.shortcuts import render
+
+from .conditional import conditional_view
+from .db import parallel_queries_enabled
+from .models import Depense
+from .routers import analytics_view
+from .sampling import approx_mode, sample_frame
+from .singleflight import coalesce, make_key, mark_stale, track_stale
+from . import views
+
+# pyplot n'est pas thread-safe : un seul rendu de graphique à la fois,
+# mais hors de la boucle d'événements.
+_CHART_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ecotrack-charts')
+
+# Threads bloqués dans coalesce() (verrous single-flight), jamais ceux des requêtes SQL
+_FLIGHT_EXECUTOR = ThreadPoolExecutor(thread_name_prefix='ecotrack-flights')
+
+# (boucle, clé) -> Future du calcul en cours, résolu en (valeur, périmée)
+_inflight = {}
+
+
+def _db(fn, *args):
+    """Exécute `fn` dans un thread dédié avec sa propre connexion."""
+    if not parallel_queries_enabled():
+        return sync_to_async(fn, thread_sensitive=True)(*args)
+
+    def run():
+        try:
+            return fn(*args)
+        finally:
+            close_old_connections()
+    return sync_to_async(run, thread_sensitive=False)()
+
+
+async def _lead(name, params, compute):
+    # coalesce() est synchrone (verrous) : il tourne dans un thread et
+    # revient sur la boucle d'événements pour le calcul lui-même.
+    if not parallel_queries_enabled():
+        return await sync_to_async(coalesce, thread_sensitive=True)(name, params, async_to_sync(compute))
+    loop = asyncio.get_running_loop()
+
+    def run():
+        try:
+            return coalesce(name, params, lambda: asyncio.run_coroutine_threadsafe(compute(), loop).result())
+        finally:
+            close_old_connections()
+    # Le thread (puis le calcul renvoyé sur la boucle) garde le contexte de la requête (ville, réplique)
+    return await loop.run_in_executor(_FLIGHT_EXECUTOR, contextvars.copy_context().run, run)
+
+
+async def _coalesce(name, params, compute):
+    """`coalesce` pour les vues asynchrones : un seul appel par clé et par boucle, les autres attendent."""
+    loop = asyncio.get_running_loop()
+    flight = (loop, make_key(name, params))
+    while (future := _inflight.get(flight)) is not None:
+        try:
+            value, stale = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # Premier appel annulé (client parti) : on reprend le calcul
+            if not future.cancelled():
+                raise
+        else:
+            if stale:
+                mark_stale()
+            return value
+    future = _inflight[flight] = loop.create_future()
+    try:
+        with track_stale() as stale:
+            value = await _lead(name, params, compute)
+    except Exception as exc:
+        future.set_exception(exc)
+        future.exception()  # consultée : pas d'avertissement s'il n'y a aucun autre appel
+        raise
+    else:
+        future.set_result((value, bool(stale)))
+    finally:
+        if not future.done():
+            future.cancel()
+        del _inflight[flight]
+    if stale:
+        mark_stale()
+    return value
+
+
+async def _render_chart(fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_CHART_EXECUTOR, fn, *args)
+
+
+async def accueil(request):
+    """Page d'accueil : les trois comptages partent en parallèle"""
+    total_depenses, total_quartiers, total_types = await asyncio.gather(
+        _db(lambda: Depense.objects.count()),
+        _db(lambda: Depense.objects.values('quartier').distinct().count()),
+        _db(lambda: Depense.objects.values('type_depense').distinct().count()),
+    )
+    context = {
+        'title': views.ACCUEIL_TITLE,
+        'total_depenses': total_depenses,
+        'total_quartiers': total_quartiers,
+        'total_types': total_types,
+    }
+    return render(request, 'accueil.html', context)
+
+
+async def _dashboard_context(filtres=None):
+    filtres = filtres or views.dashboard_filters({})
+    qs = views._dashboard_queryset(filtres)
+    if await _db(approx_mode, filtres['approx'], qs):
+        sample, population = await _db(views._load_dashboard_sample, qs)
+        if sample is not None:
+            return await _render_chart(views._dashboard_approx_resultats, sample, population)
+    if await _db(views._use_streaming, qs):
+        data = await _db(views._load_dashboard_streaming, qs)
+        return await _render_chart(views._dashboard_streaming_resultats, *data)
+    rows, nb_anomalies = await asyncio.gather(
+        _db(views._load_dashboard_rows, qs),
+        _db(views._count_anomalies, qs),
+    )
+    return await _render_chart(views._dashboard_resultats, rows, nb_anomalies)
+
+
+@analytics_view
+@conditional_view(last_modified=False)
+async def dashboard(request):
+    """Dashboard : agrégats en parallèle, graphiques dans l'exécuteur"""
+    filtres = views.dashboard_filters(request.GET)
+    context = await _coalesce('dashboard', filtres, partial(_dashboard_context, filtres))
+    return render(request, 'dashboard.html', views._dashboard_page(context, filtres))
+
+
+async def _comparaison_context(params):
+    mode, querysets = views._comparaison_querysets(params)
+    if mode == 'matrice':
+        quartiers, types_depense, cells = await asyncio.gather(
+            _db(lambda: list(Depense.objects.values_list('quartier', flat=True).distinct())),
+            _db(lambda: list(Depense.objects.values_list('type_depense', flat=True).distinct())),
+            _db(views._load_matrice, querysets['matrice']),
+        )
+        context = views._comparaison_base_context(quartiers, types_depense)
+        context.update(await _render_chart(views._comparaison_matrice_resultats, cells, params))
+        return context
+    keys = list(querysets)
+    # Mode approximatif décidé d'abord : les groupes complets ne sont alors pas chargés
+    approx = bool(mode) and await _db(approx_mode, params.get('approx', ''), Depense.objects.all())
+    load = partial(sample_frame, columns=['prix']) if approx else views._load_prix_frame
+    quartiers, types_depense, *frames = await asyncio.gather(
+        _db(lambda: list(Depense.objects.values_list('quartier', flat=True).distinct())),
+        _db(lambda: list(Depense.objects.values_list('type_depense', flat=True).distinct())),
+        *(_db(load, querysets[k]) for k in keys),
+    )
+    context = views._comparaison_base_context(quartiers, types_depense)
+    if approx and any(sample is None for sample, _ in frames):
+        # Réservoir vide : calcul exact
+        approx = False
+        frames = await asyncio.gather(*(_db(views._load_prix_frame, querysets[k]) for k in keys))
+    if approx:
+        context.update(await _render_chart(views._comparaison_approx_resultats, mode, dict(zip(keys, frames)), params))
+    elif mode:
+        frames = dict(zip(keys, frames))
+        context.update(await _render_chart(views._comparaison_resultats, mode, frames, params))
+        if context.get('mode'):
+            context['significativite'] = await _render_chart(views._comparaison_significativite, mode, frames, params)
+    return context
+
+
+@analytics_view
+@conditional_view
+async def comparaison(request):
+    """Comparaison : chargements des groupes en parallèle"""
+    context = await _coalesce('comparaison', request.GET, partial(_comparaison_context, request.GET))
+    return render(request, 'comparaison.html', context)
@@ -0,0 +1,114 @@
+"""
+File d'écriture en processus pour les insertions de `Depense`.
+
+Sous SQLite, chaque transaction validée coûte une synchronisation disque et
+prend le verrou d'écriture. Lors des pics de saisie, la file regroupe les
+insertions concurrentes en une seule transaction : chaque requête attend
+que son lot soit validé (le résultat reste donc durable avant la réponse),
+mais les lots réduisent le nombre de commits et de conflits de verrou.
+
+Activée par ECOTRACK_WRITE_QUEUE ; taille et fenêtre de regroupement via
+ECOTRACK_WRITE_QUEUE_BATCH et ECOTRACK_WRITE_QUEUE_WAIT_MS. Avec une fenêtre
+de 0 ms (défaut), un lot contient tout ce qui s'est accumulé pendant la
+validation du lot précédent.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import close_old_connections, router, transaction
+
+
+class DepenseWriteQueue:
+    def __init__(self, batch_size=None, max_wait_ms=None):
+        self.batch_size = batch_size or getattr(settings, 'ECOTRACK_WRITE_QUEUE_BATCH', 50)
+        self.max_wait = (max_wait_ms if max_wait_ms is not None
+                         else getattr(settings, 'ECOTRACK_WRITE_QUEUE_WAIT_MS', 0)) / 1000
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.batches_committed = 0
+
+    def submit(self, depense, autostart=True):
+        """Ajoute une dépense non sauvegardée à la file ; retourne un Future."""
+        future = Future()
+        # Base cible résolue maintenant : le thread d'écriture n'a pas le contexte de la requête
+        alias = router.db_for_write(type(depense), instance=depense)
+        self._queue.put((depense, alias, future))
+        if autostart:
+            self._ensure_worker()
+        return future
+
+    def save(self, depense, timeout=30):
+        """Soumet la dépense et attend la validation de son lot."""
+        return self.submit(depense).result(timeout=timeout)
+
+    def flush(self):
+        """Vide la file dans le thread courant (commande de gestion, tests)."""
+        while True:
+            batch = self._collect(block=False)
+            if not batch:
+                return
+            self._commit(batch)
+
+    def _ensure_worker(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='ecotrack-write-queue', daemon=True)
+                self._thread.start()
+
+    def _collect(self, block=True):
+        try:
+            first = self._queue.get(block=block)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(block=block and remaining > 0, timeout=max(remaining, 0) if block else None))
+            except queue.Empty:
+                break
+        return batch
+
+    def _commit(self, batch):
+        by_alias = {}
+        for item in batch:
+            by_alias.setdefault(item[1], []).append(item)
+        for alias, items in by_alias.items():
+            erreurs = {}
+            try:
+                with transaction.atomic(using=alias):
+                    for i, (depense, _, _) in enumerate(items):
+                        # Un point de sauvegarde par dépense : une saisie invalide
+                        # n'annule pas celles des autres requêtes du lot
+                        try:
+                            with transaction.atomic(using=alias):
+                                depense.save(using=alias)
+                        except Exception as exc:
+                            erreurs[i] = exc
+            except Exception as exc:
+                # Échec de la validation elle-même : rien n'est écrit
+                for _, _, future in items:
+                    future.set_exception(exc)
+                continue
+            self.batches_committed += 1
+            for i, (depense, _, future) in enumerate(items):
+                if i in erreurs:
+                    future.set_exception(erreurs[i])
+                else:
+                    future.set_result(depense)
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            self._commit(batch)
+            close_old_connections()
+
+
+write_queue = DepenseWriteQueue()
@@ -52,6 +52,8 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
+    # Ville courante (préfixe /ville/<slug>/ ou sous-domaine), avant la résolution des URL
+    "core.cities.CityMiddleware",
     # WhiteNoise can serve static files efficiently in simple deployments. Optional on PythonAnywhere (they provide static mapping).
     "whitenoise.middleware.WhiteNoiseMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -74,6 +76,7 @@ TEMPLATES = [
                 "django.template.context_processors.request",
                 "django.contrib.auth.context_processors.auth",
                 "django.contrib.messages.context_processors.messages",
+                "core.context_processors.ecotrack",
             ],
         },
     },
@@ -104,10 +107,160 @@ else:
     DATABASES = {
         "default": {
             "ENGINE": "django.db.backends.sqlite3",
-            "NAME": BASE_DIR / "db.sqlite3",
+            # DJANGO_SQLITE_PATH permet de placer la base sur un disque persistant
+            "NAME": os.environ.get('DJANGO_SQLITE_PATH', BASE_DIR / "db.sqlite3"),
+            "OPTIONS": {
+                # Attente du verrou d'écriture (secondes) côté driver Python
+                "timeout": int(os.environ.get('DJANGO_SQLITE_TIMEOUT', '20')),
+            },
         }
     }
 
+# Réplique de lecture pour les vues d'analyse (voir core/routers.py)
+# - DJANGO_REPLICA_DATABASE_URL : réplique gérée par l'hébergeur (ex: PostgreSQL en lecture seule)
+# - ECOTRACK_SQLITE_REPLICA : chemin d'une copie SQLite rafraîchie par `manage.py refresh_replica`
+ECOTRACK_REPLICA_ALIAS = 'replica'
+# Âge maximal (secondes) d'une réplique SQLite avant repli sur la base principale
+ECOTRACK_REPLICA_MAX_STALENESS = int(os.environ.get('ECOTRACK_REPLICA_MAX_STALENESS', '300'))
+REPLICA_DATABASE_URL = os.environ.get('DJANGO_REPLICA_DATABASE_URL')
+SQLITE_REPLICA = os.environ.get('ECOTRACK_SQLITE_REPLICA')
+if REPLICA_DATABASE_URL:
+    import dj_database_url
+    DATABASES[ECOTRACK_REPLICA_ALIAS] = dj_database_url.parse(REPLICA_DATABASE_URL, conn_max_age=600)
+elif SQLITE_REPLICA:
+    DATABASES[ECOTRACK_REPLICA_ALIAS] = {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": SQLITE_REPLICA,
+    }
+if ECOTRACK_REPLICA_ALIAS in DATABASES:
+    # Les tests lisent la base principale
+    DATABASES[ECOTRACK_REPLICA_ALIAS]["TEST"] = {"MIRROR": "default"}
+
+# Déploiement multi-villes (voir core/cities.py) : une base par ville, choisie par
+# l'URL /ville/<slug>/... ou le sous-domaine <slug>.<domaine>.
+# ECOTRACK_CITIES="douala,yaounde" crée les alias city_douala, city_yaounde
+# (fichiers SQLite db_<slug>.sqlite3 dans ECOTRACK_CITY_DB_DIR, défaut BASE_DIR).
+# Une base PostgreSQL par ville : DJANGO_CITY_<SLUG>_DATABASE_URL.
+ECOTRACK_CITIES = {}
+CITY_DB_DIR = Path(os.environ.get('ECOTRACK_CITY_DB_DIR', BASE_DIR))
+for _city in filter(None, (c.strip().lower() for c in os.environ.get('ECOTRACK_CITIES', '').split(','))):
+    _alias = f"city_{_city.replace('-', '_')}"
+    _url = os.environ.get(f"DJANGO_CITY_{_city.replace('-', '_').upper()}_DATABASE_URL")
+    if _url:
+        import dj_database_url
+        DATABASES[_alias] = dj_database_url.parse(_url, conn_max_age=600)
+    else:
+        DATABASES[_alias] = {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": CITY_DB_DIR / f"db_{_city}.sqlite3",
+            "OPTIONS": {"timeout": int(os.environ.get('DJANGO_SQLITE_TIMEOUT', '20'))},
+        }
+    ECOTRACK_CITIES[_city] = _alias
+
+DATABASE_ROUTERS = ['core.routers.CityRouter', 'core.routers.AnalyticsReplicaRouter']
+
+# Profil SQLite de production : PRAGMA appliqués à chaque connexion (voir core/db.py).
+# Actif par défaut quand DEBUG est désactivé.
+ECOTRACK_SQLITE_PRODUCTION = os.environ.get('ECOTRACK_SQLITE_PRODUCTION', str(not DEBUG)).lower() in ('1', 'true', 'yes')
+ECOTRACK_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': int(os.environ.get('ECOTRACK_SQLITE_BUSY_TIMEOUT_MS', '5000')),
+    'mmap_size': int(os.environ.get('ECOTRACK_SQLITE_MMAP_SIZE', str(256 * 1024 * 1024))),
+    # Valeur négative = taille en KiB (ici 64 Mo)
+    'cache_size': int(os.environ.get('ECOTRACK_SQLITE_CACHE_SIZE', '-64000')),
+    'temp_store': 'MEMORY',
+}
+
+# File d'écriture : regroupe les saisies concurrentes en transactions (voir core/write_queue.py)
+ECOTRACK_WRITE_QUEUE = os.environ.get('ECOTRACK_WRITE_QUEUE', 'False').lower() in ('1', 'true', 'yes')
+ECOTRACK_WRITE_QUEUE_BATCH = int(os.environ.get('ECOTRACK_WRITE_QUEUE_BATCH', '50'))
+ECOTRACK_WRITE_QUEUE_WAIT_MS = int(os.environ.get('ECOTRACK_WRITE_QUEUE_WAIT_MS', '0'))
+
+
+# Cache
+# LocMem par défaut (propre à chaque worker). Définir DJANGO_CACHE_DIR pour un cache
+# fichier partagé entre workers gunicorn (résultats des pages d'analyse coalescées).
+CACHE_DIR = os.environ.get('DJANGO_CACHE_DIR')
+if CACHE_DIR:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": CACHE_DIR,
+        }
+    }
+
+# Single-flight des pages d'analyse (voir core/singleflight.py)
+ECOTRACK_SINGLEFLIGHT_TTL = int(os.environ.get('ECOTRACK_SINGLEFLIGHT_TTL', '300'))
+# Servir le résultat précédent pendant qu'un thread recalcule la nouvelle version
+ECOTRACK_STALE_WHILE_REVALIDATE = os.environ.get('ECOTRACK_STALE_WHILE_REVALIDATE', 'False').lower() in ('1', 'true', 'yes')
+# Répertoire des verrous fichier inter-workers (défaut : dossier temporaire du système)
+ECOTRACK_LOCK_DIR = os.environ.get('ECOTRACK_LOCK_DIR')
+
+# Fenêtre par défaut du dashboard, en jours (`?periode=tout` pour tout l'historique)
+ECOTRACK_DASHBOARD_DAYS = int(os.environ.get('ECOTRACK_DASHBOARD_DAYS', '90'))
+# Nombre maximal de points de la série temporelle (réduction LTTB au-delà)
+ECOTRACK_SERIES_MAX_POINTS = int(os.environ.get('ECOTRACK_SERIES_MAX_POINTS', '300'))
+
+# Mode approximatif (voir core/sampling.py) : dépenses gardées par strate (quartier, type)
+ECOTRACK_RESERVOIR_SIZE = int(os.environ.get('ECOTRACK_RESERVOIR_SIZE', '500'))
+# Au-delà de ce nombre de lignes, dashboard et comparaison passent en mode approximatif (?approx=0 pour forcer l'exact)
+ECOTRACK_APPROX_THRESHOLD = int(os.environ.get('ECOTRACK_APPROX_THRESHOLD', '1000000'))
+
+# Statistiques en flux (voir core/streaming.py) : au-delà de ce nombre de lignes, le dashboard
+# exact parcourt la table par morceaux au lieu de la charger dans un DataFrame
+ECOTRACK_STREAMING_THRESHOLD = int(os.environ.get('ECOTRACK_STREAMING_THRESHOLD', '200000'))
+ECOTRACK_STREAM_CHUNK = int(os.environ.get('ECOTRACK_STREAM_CHUNK', '5000'))
+# Erreur relative des médianes et quartiles estimés par l'esquisse
+ECOTRACK_SKETCH_ACCURACY = float(os.environ.get('ECOTRACK_SKETCH_ACCURACY', '0.01'))
+# Processus d'agrégation (plages de dates en parallèle) ; 1 (défaut) = dans le processus du serveur.
+# Chaque processus du pool charge Django (~150 Mo) et chaque worker web a son propre pool :
+# à activer seulement si la mémoire le permet (borné aux cœurs réellement attribués)
+ECOTRACK_AGGREGATION_WORKERS = int(os.environ.get('ECOTRACK_AGGREGATION_WORKERS', '1'))
+# Lignes au plus par plage envoyée au pool
+ECOTRACK_PARTITION_ROWS = int(os.environ.get('ECOTRACK_PARTITION_ROWS', '100000'))
+
+# Significativité des comparaisons (voir core/resampling.py)
+ECOTRACK_BOOTSTRAP_RESAMPLES = int(os.environ.get('ECOTRACK_BOOTSTRAP_RESAMPLES', '10000'))
+ECOTRACK_PERMUTATIONS = int(os.environ.get('ECOTRACK_PERMUTATIONS', '2000'))
+# Au-delà, un groupe est rééchantillonné à cette taille (bootstrap « m parmi n »)
+ECOTRACK_RESAMPLE_MAX_N = int(os.environ.get('ECOTRACK_RESAMPLE_MAX_N', '1000'))
+
+# Box plots (voir core/boxplots.py) : points isolés dessinés au plus par boîte, extrêmes toujours gardés
+ECOTRACK_BOX_MAX_FLIERS = int(os.environ.get('ECOTRACK_BOX_MAX_FLIERS', '50'))
+
+# Admin des dépenses (voir core/admin.py) : au-delà de ce nombre de lignes, décomptes
+# estimés et recherche par préfixe ; durée de cache des décomptes des filtres
+ECOTRACK_ADMIN_COUNT_THRESHOLD = int(os.environ.get('ECOTRACK_ADMIN_COUNT_THRESHOLD', '100000'))
+ECOTRACK_ADMIN_FACET_TTL = int(os.environ.get('ECOTRACK_ADMIN_FACET_TTL', '300'))
+
+
+# Méthode de détection des valeurs aberrantes (voir core/anomalies.py) : std, mad ou iqr
+ECOTRACK_OUTLIER_METHOD = os.environ.get('ECOTRACK_OUTLIER_METHOD', 'std')
+# Doublons à la saisie (formulaire et admin) : 'warn' demande une confirmation,
+# 'reject' refuse l'enregistrement, 'off' désactive la vérification
+ECOTRACK_DUPLICATE_POLICY = os.environ.get('ECOTRACK_DUPLICATE_POLICY', 'warn')
+# API de synchronisation : nombre maximal de dépenses par lot
+ECOTRACK_API_BATCH_MAX = int(os.environ.get('ECOTRACK_API_BATCH_MAX', '500'))
+
+# Flux de changements (export/changements/) : délai avant publication d'une modification
+# (transactions encore en cours) et taille maximale d'une page
+ECOTRACK_FEED_LAG = float(os.environ.get('ECOTRACK_FEED_LAG', '2'))
+ECOTRACK_FEED_MAX_PAGE = int(os.environ.get('ECOTRACK_FEED_MAX_PAGE', '50000'))
+
+# Archive nocturne de l'export complet (manage.py build_export_archive) : dossier et
+# âge maximal (secondes) au-delà duquel l'export est recalculé à la demande
+ECOTRACK_EXPORT_ARCHIVE_DIR = os.environ.get('ECOTRACK_EXPORT_ARCHIVE_DIR', str(BASE_DIR / 'exports'))
+ECOTRACK_EXPORT_ARCHIVE_MAX_AGE = int(os.environ.get('ECOTRACK_EXPORT_ARCHIVE_MAX_AGE', str(26 * 3600)))
+
+# Worker d'anomalies (manage.py anomaly_worker) : délai de calme après la dernière
+# modification avant de re-détecter, et attente maximale pendant une rafale de saisies
+ECOTRACK_ANOMALY_DEBOUNCE = float(os.environ.get('ECOTRACK_ANOMALY_DEBOUNCE', '5'))
+ECOTRACK_ANOMALY_MAX_DELAY = float(os.environ.get('ECOTRACK_ANOMALY_MAX_DELAY', '60'))
+
+# Vues asynchrones (accueil, dashboard, comparaison) pour un déploiement ASGI (uvicorn)
+ECOTRACK_ASYNC_VIEWS = os.environ.get('ECOTRACK_ASYNC_VIEWS', 'False').lower() in ('1', 'true', 'yes')
+
 
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
@@ -168,4 +321,13 @@ if not DEBUG:
 
 # Media files (uploaded files)
 MEDIA_URL = '/media/'
-MEDIA_ROOT = BASE_DIR / 'media'
\ No newline at end of file
+MEDIA_ROOT = BASE_DIR / 'media'
+
+# Photos : écrites sur disque par morceaux pendant l'upload (jamais entièrement en mémoire),
+# puis redimensionnées hors requête par un pool borné (core/photos.py)
+FILE_UPLOAD_HANDLERS = ['django.core.files.uploadhandler.TemporaryFileUploadHandler']
+ECOTRACK_PHOTO_ASYNC = os.environ.get('ECOTRACK_PHOTO_ASYNC', 'True').lower() in ('1', 'true', 'yes')
+ECOTRACK_PHOTO_WORKERS = int(os.environ.get('ECOTRACK_PHOTO_WORKERS', '2'))
+ECOTRACK_PHOTO_MAX_PENDING = int(os.environ.get('ECOTRACK_PHOTO_MAX_PENDING', '32'))
+ECOTRACK_PHOTO_WEB_SIZE = int(os.environ.get('ECOTRACK_PHOTO_WEB_SIZE', '1600'))
+ECOTRACK_PHOTO_THUMB_SIZE = int(os.environ.get('ECOTRACK_PHOTO_THUMB_SIZE', '320'))
\ No newline at end of file